@@ -0,0 +1,340 @@
+# -*- encoding: utf-8 -*-
+"""
+Fetcher benchmarks.
+
+Runs every fetcher against a local BenchServer, with and without cache, and
+reports requests per second, p50/p99 latency, peak memory allocated during
+the run and errors:
+
+    python3 -m benchmarks.fetchers --requests 500 --latency 0.005 --gzip
+
+Latency is measured for each request from the moment it starts: asyncio
+fetchers start all of them at once so it includes waiting for a connection
+slot, threaded-urllib starts them as workers get free so it doesn't.
+
+Results can be saved with --save and checked against a saved run with
+--compare, exiting with status 1 if any benchmark is slower (or uses more
+memory) than --tolerance allows.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from ldotcommons import cache, fetchers, tracing, utils
+
+from .server import ERROR_BODY, BenchServer
+
+
+class Result:
+    def __init__(self, name, latencies, elapsed, errors, memory):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.elapsed = elapsed
+        self.errors = errors
+        self.memory = memory
+
+    @property
+    def rps(self):
+        return len(self.latencies) / self.elapsed if self.elapsed else 0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0
+
+        idx = min(len(self.latencies) - 1,
+                  int(round(p / 100 * (len(self.latencies) - 1))))
+        return self.latencies[idx]
+
+    def as_dict(self):
+        return {
+            'rps': self.rps,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'memory': self.memory,
+            'errors': self.errors,
+        }
+
+
+def _measure(name, run, trace_memory=True):
+    # run() returns (latencies, errors)
+    if trace_memory:
+        tracemalloc.start()
+
+    t0 = time.perf_counter()
+    try:
+        (latencies, errors) = run()
+        elapsed = time.perf_counter() - t0
+        memory = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    return Result(name, latencies, elapsed, errors, memory)
+
+
+def _sync_run(fetcher, urls):
+    def run():
+        latencies = []
+        errors = 0
+        for url in urls:
+            t0 = time.perf_counter()
+            try:
+                fetcher.fetch(url)
+            except fetchers.FetchError:
+                errors += 1
+            latencies.append(time.perf_counter() - t0)
+
+        return (latencies, errors)
+
+    return run
+
+
+def _async_run(loop, fetcher, urls):
+    @asyncio.coroutine
+    def timed(url, latencies):
+        t0 = time.perf_counter()
+        try:
+            buff = yield from fetcher.fetch(url)
+            ok = buff != ERROR_BODY
+        except Exception:
+            ok = False
+        latencies.append(time.perf_counter() - t0)
+
+        return ok
+
+    def run():
+        latencies = []
+        ret = loop.run_until_complete(
+            asyncio.gather(*[timed(url, latencies) for url in urls]))
+
+        return (latencies, ret.count(False))
+
+    return run
+
+
+def _build(loop, name, concurrency, cache_dir, tracer=None):
+    # Fetchers must be created inside the loop, aiohttp sessions need it
+    @asyncio.coroutine
+    def build():
+        c = cache.DiskCache(basedir=cache_dir) if cache_dir else None
+
+        if name == 'urllib':
+            fetcher = fetchers.UrllibFetcher(pool_size=1, cache=c)
+
+        elif name == 'threaded-urllib':
+            fetcher = fetchers.ThreadedUrllibFetcher(
+                workers=concurrency, cache=c, tracer=tracer)
+
+        elif name == 'aiohttp':
+            fetcher = fetchers.AIOHttpFetcher(limit=concurrency, cache=c)
+
+        elif name == 'async':
+            fetcher = fetchers.AsyncFetcher(max_requests=concurrency,
+                                            cache=c)
+
+        else:
+            raise ValueError(name)
+
+        return fetcher
+
+    return loop.run_until_complete(build())
+
+
+def _close(loop, fetcher):
+    ret = fetcher.close()
+    if asyncio.iscoroutine(ret):
+        loop.run_until_complete(ret)
+
+
+def _threaded_run(fetcher, urls, tracer):
+    # Latencies are taken from the TOTAL event of each fetch, so they don't
+    # include waiting for a free worker
+    def run():
+        latencies = []
+
+        def hook(event):
+            if event.phase == tracing.TOTAL:
+                latencies.append(event.elapsed)
+
+        tracer.add_hook(hook)
+        try:
+            errors = 0
+            for (url, ret) in fetcher.fetch_many(urls,
+                                                 return_exceptions=True):
+                if isinstance(ret, Exception):
+                    errors += 1
+        finally:
+            tracer.remove_hook(hook)
+
+        return (latencies, errors)
+
+    return run
+
+
+def bench_fetchers(server, requests, concurrency, names, trace_memory=True):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    results = []
+    for name in names:
+        for cached in (False, True):
+            cache_dir = tempfile.mkdtemp() if cached else None
+            urls = [server.url('/{name}/{cached}/{n}'.format(
+                    name=name, cached=int(cached), n=n))
+                    for n in range(requests)]
+
+            tracer = tracing.Tracer(clock=time.perf_counter)
+            fetcher = _build(loop, name, concurrency, cache_dir, tracer)
+            if name == 'urllib':
+                run = _sync_run(fetcher, urls)
+            elif name == 'threaded-urllib':
+                run = _threaded_run(fetcher, urls, tracer)
+            else:
+                run = _async_run(loop, fetcher, urls)
+
+            try:
+                if cached:
+                    # Warm up the cache, measure hits
+                    run()
+
+                label = '{name} ({mode})'.format(
+                    name=name, mode='cached' if cached else 'uncached')
+                results.append(_measure(label, run, trace_memory))
+
+            finally:
+                _close(loop, fetcher)
+                if cache_dir:
+                    shutil.rmtree(cache_dir)
+
+    loop.close()
+    return results
+
+
+def bench_mock(server, requests, trace_memory=True):
+    basedir = tempfile.mkdtemp()
+    try:
+        urls = [server.url('/mock/{n}'.format(n=n)) for n in range(requests)]
+        for url in urls:
+            with open(os.path.join(basedir, utils.slugify(url)), 'wb') as fh:
+                fh.write(server.body)
+
+        ret = []
+        for preload in (False, True):
+            fetcher = fetchers.MockFetcher(basedir=basedir, preload=preload)
+            # Indexing (and preloading) is not measured
+            fetcher.index
+
+            name = 'mock (preload)' if preload else 'mock'
+            ret.append(
+                _measure(name, _sync_run(fetcher, urls), trace_memory))
+
+        return ret
+
+    finally:
+        shutil.rmtree(basedir)
+
+
+def report(results, fh=sys.stdout):
+    fmt = '{:<28} {:>10} {:>10} {:>10} {:>10} {:>7}\n'
+    fh.write(fmt.format('benchmark', 'req/s', 'p50 (ms)', 'p99 (ms)',
+                        'mem (KiB)', 'errors'))
+    for r in results:
+        fh.write(fmt.format(
+            r.name,
+            '{:.1f}'.format(r.rps),
+            '{:.2f}'.format(r.percentile(50) * 1000),
+            '{:.2f}'.format(r.percentile(99) * 1000),
+            '{:.0f}'.format(r.memory / 1024),
+            r.errors))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of messages describing regressions against baseline (as
+    saved by --save)
+    """
+    ret = []
+    for r in results:
+        if r.name not in baseline:
+            continue
+
+        old = baseline[r.name]
+        new = r.as_dict()
+        checks = [
+            ('rps', new['rps'] < old['rps'] * (1 - tolerance)),
+            ('p99', new['p99'] > old['p99'] * (1 + tolerance)),
+            ('memory', old['memory'] and
+             new['memory'] > old['memory'] * (1 + tolerance)),
+        ]
+        for (metric, regressed) in checks:
+            if regressed:
+                msg = "{name}: {metric} regressed from {old:.4g} to {new:.4g}"
+                msg = msg.format(name=r.name, metric=metric,
+                                 old=old[metric], new=new[metric])
+                ret.append(msg)
+
+    return ret
+
+
+FETCHERS = ('urllib', 'threaded-urllib', 'aiohttp', 'async')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fetcher benchmarks.')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Server latency in seconds')
+    parser.add_argument('--size', type=int, default=16 * 1024,
+                        help='Body size in bytes')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Gzip bodies')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Ratio of requests failing with 500')
+    parser.add_argument('--fetcher', action='append', choices=FETCHERS,
+                        dest='fetchers',
+                        help='Fetchers to run (default: all)')
+    parser.add_argument('--no-mock', action='store_true')
+    parser.add_argument('--no-memory', action='store_true',
+                        help="Don't trace memory (it slows down runs)")
+    parser.add_argument('--save', help='Save results as JSON')
+    parser.add_argument('--compare', help='Compare with saved results')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    trace_memory = not args.no_memory
+    with BenchServer(latency=args.latency, size=args.size, gzip=args.gzip,
+                     error_rate=args.error_rate) as server:
+        results = bench_fetchers(server, args.requests, args.concurrency,
+                                 args.fetchers or FETCHERS, trace_memory)
+        if not args.no_mock:
+            results += bench_mock(server, args.requests, trace_memory)
+
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump({r.name: r.as_dict() for r in results}, fh, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+
+        for msg in regressions:
+            print(msg, file=sys.stderr)
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+# -*- encoding: utf-8 -*-
+
+import gzip
+import http.server
+import random
+import socketserver
+import threading
+import time
+
+
+# Body of failed requests
+ERROR_BODY = b'error'
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body are written separately, without TCP_NODELAY
+    # keep-alive clients would wait for delayed ACKs on every request
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        with server.lock:
+            failed = server.random.random() < server.error_rate
+
+        if failed:
+            (status, headers, body) = (500, {}, ERROR_BODY)
+        else:
+            (status, headers, body) = (200, {}, server.body)
+            accept = self.headers.get('Accept-Encoding') or ''
+            if server.gzipped and 'gzip' in accept:
+                headers['Content-Encoding'] = 'gzip'
+                body = server.gzipped
+
+        self.send_response(status)
+        for (k, v) in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class BenchServer:
+    """
+    Local HTTP server answering every GET with a size bytes body after
+    latency seconds. If gzip is True bodies are gzipped for clients
+    accepting it, error_rate (0 to 1) of the requests fail with a 500.
+
+        with BenchServer(latency=0.01) as server:
+            fetcher.fetch(server.url('/foo'))
+    """
+    def __init__(self, latency=0, size=16 * 1024, gzip=False, error_rate=0,
+                 seed=0):
+        # Text-like body, so gzip has something to do
+        words = [b'lorem', b'ipsum', b'dolor', b'sit', b'amet']
+        rnd = random.Random(seed)
+        body = b' '.join(rnd.choice(words) for x in range(size // 4))
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.latency = latency
+        self._server.body = body[:size]
+        self._server.gzipped = \
+            _gzip_compress(self._server.body) if gzip else None
+        self._server.error_rate = error_rate
+        self._server.random = rnd
+        self._server.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def body(self):
+        return self._server.body
+
+    def url(self, path):
+        return 'http://127.0.0.1:{port}{path}'.format(
+            port=self._server.server_address[1], path=path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _gzip_compress(buff):
+    return gzip.compress(buff)
@@ -0,0 +1,340 @@
+# -*- encoding: utf-8 -*-
+
+import collections
+import json
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+
+# File: magic followed by records. Record: header, method, url, meta (JSON
+# with headers) and body, compressed with zlib if FLAG_ZLIB is set
+_MAGIC = b'LDCARC\x00\x01'
+# flags, time, status, method, url, meta, body
+_RECORD = struct.Struct('<BdHBIIQ')
+
+FLAG_ZLIB = 1
+
+INDEX_SUFFIX = '.idx'
+_INDEX_VERSION = 2
+
+# Bytes checksummed at both ends of the indexed part of the archive to tell
+# it apart from other archives at the same path
+_CHECKSUM_SIZE = 64 * 1024
+
+
+class ArchiveError(Exception):
+    pass
+
+
+Record = collections.namedtuple(
+    'Record', ['url', 'method', 'status', 'headers', 'body', 'timestamp'])
+
+
+def _scan(buff, offset, index):
+    """
+    Adds records in buff from offset to index ((method, url) -> offset,
+    later records win). Returns the end of the last complete record
+    """
+    size = len(buff)
+    while offset + _RECORD.size <= size:
+        (flags, ts, status, method_len, url_len, meta_len, body_len) = \
+            _RECORD.unpack_from(buff, offset)
+
+        end = (offset + _RECORD.size + method_len + url_len + meta_len +
+               body_len)
+        if end > size:
+            break
+
+        idx = offset + _RECORD.size
+        try:
+            method = bytes(buff[idx:idx + method_len]).decode('ascii')
+            idx += method_len
+            url = bytes(buff[idx:idx + url_len]).decode('utf-8')
+        except UnicodeDecodeError:
+            # Garbage, not a record
+            break
+
+        index[(method, url)] = offset
+        offset = end
+
+    return offset
+
+
+def _identity(fh, end):
+    # Identifies the first end bytes of the archive open as fh: its inode
+    # and checksums of both ends of that range. Appending records doesn't
+    # change it, replacing the archive does
+    st = os.fstat(fh.fileno())
+
+    fh.seek(0)
+    crc = zlib.crc32(fh.read(min(end, _CHECKSUM_SIZE)))
+    fh.seek(max(0, end - _CHECKSUM_SIZE))
+    crc = zlib.crc32(fh.read(end - fh.tell()), crc)
+
+    return (st.st_dev, st.st_ino, crc)
+
+
+def _load_index(path, fh):
+    # Returns (index, end) from the index file of the archive at path (open
+    # as fh), it's discarded unless it was built from this archive or a
+    # grown version of it
+    empty = ({}, len(_MAGIC))
+    try:
+        with open(path + INDEX_SUFFIX, 'rb') as ifh:
+            data = pickle.load(ifh)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return empty
+
+    try:
+        if data['version'] != _INDEX_VERSION or \
+           data['end'] > os.fstat(fh.fileno()).st_size or \
+           data['identity'] != _identity(fh, data['end']):
+            return empty
+    except (KeyError, TypeError):
+        return empty
+
+    return (data['index'], data['end'])
+
+
+def _check_magic(fh, path):
+    if fh.read(len(_MAGIC)) != _MAGIC:
+        msg = "Not an archive: '{path}'"
+        msg = msg.format(path=path)
+        raise ArchiveError(msg)
+
+
+def _valid_end(path):
+    # End of the last complete record, trailing garbage comes from
+    # interrupted writes
+    with open(path, 'rb') as fh:
+        _check_magic(fh, path)
+
+        size = os.fstat(fh.fileno()).st_size
+        (index, end) = _load_index(path, fh)
+        if end == size:
+            return end
+
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _scan(mm, end, index)
+
+
+class ArchiveWriter:
+    """
+    Appends request/response records to the archive at path, creating it if
+    needed. Bodies of at least compress_threshold bytes are compressed with
+    zlib when that makes them smaller.
+
+    Writers are thread-safe but there must be only one per archive. Records
+    are flushed as they are written, a record interrupted by a crash is
+    discarded when the archive is opened again.
+    """
+    def __init__(self, path, compress=True, compress_threshold=1024):
+        self.path = path
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self._lock = threading.Lock()
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            end = _valid_end(path)
+            self._fh = open(path, 'r+b')
+            self._fh.truncate(end)
+            self._fh.seek(end)
+        else:
+            # An index left by a removed archive must not be used for this
+            # one
+            try:
+                os.unlink(path + INDEX_SUFFIX)
+            except FileNotFoundError:
+                pass
+
+            self._fh = open(path, 'wb')
+            self._fh.write(_MAGIC)
+            self._fh.flush()
+
+    def write(self, url, status, headers, body, method='GET',
+              timestamp=None):
+        """
+        Appends a record, returns its offset
+        """
+        flags = 0
+        if self.compress and len(body) >= self.compress_threshold:
+            compressed = zlib.compress(body)
+            if len(compressed) < len(body):
+                (body, flags) = (compressed, FLAG_ZLIB)
+
+        method = method.upper().encode('ascii')
+        url = url.encode('utf-8')
+        meta = json.dumps({'headers': dict(headers)}).encode('utf-8')
+        header = _RECORD.pack(
+            flags, time.time() if timestamp is None else timestamp, status,
+            len(method), len(url), len(meta), len(body))
+
+        with self._lock:
+            if self._fh is None:
+                raise ArchiveError('Archive writer is closed')
+
+            offset = self._fh.tell()
+            self._fh.write(b''.join([header, method, url, meta]))
+            self._fh.write(body)
+            self._fh.flush()
+
+        return offset
+
+    def close(self):
+        with self._lock:
+            if self._fh:
+                self._fh.close()
+                self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Archive:
+    """
+    Read access to an archive written by ArchiveWriter.
+
+    Records are indexed by method and url (the last one written for each
+    wins), the index is kept next to the archive (path + INDEX_SUFFIX) and
+    updated with records appended since it was written. Indexes built from
+    other archives (like a removed one at the same path) are ignored.
+    Records are read from a mmap of the archive, call refresh() to see
+    records appended after opening it.
+    """
+    def __init__(self, path, save_index=True):
+        self.path = path
+        self.save_index = save_index
+        self._fh = None
+        self._mm = None
+        self._index = {}
+        self._end = len(_MAGIC)
+
+        self._fh = open(path, 'rb')
+        try:
+            _check_magic(self._fh, path)
+        except ArchiveError:
+            self._fh.close()
+            raise
+
+        (self._index, self._end) = _load_index(path, self._fh)
+        self.refresh()
+
+    @property
+    def _index_path(self):
+        return self.path + INDEX_SUFFIX
+
+    def _index_save(self):
+        tmp = self._index_path + '.tmp'
+        with open(tmp, 'wb') as fh:
+            pickle.dump({'version': _INDEX_VERSION, 'end': self._end,
+                         'identity': _identity(self._fh, self._end),
+                         'index': self._index}, fh)
+        os.replace(tmp, self._index_path)
+
+    def refresh(self):
+        """
+        Indexes records appended since last refresh
+        """
+        size = os.fstat(self._fh.fileno()).st_size
+        if self._mm is not None and size == len(self._mm):
+            return
+
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+        if size > len(_MAGIC):
+            self._mm = mmap.mmap(self._fh.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+        if self._mm is None or self._end >= len(self._mm):
+            return
+
+        end = _scan(self._mm, self._end, self._index)
+        if end != self._end:
+            self._end = end
+            if self.save_index:
+                try:
+                    self._index_save()
+                except (IOError, OSError):
+                    pass
+
+    def _read(self, offset):
+        mm = self._mm
+        (flags, ts, status, method_len, url_len, meta_len, body_len) = \
+            _RECORD.unpack_from(mm, offset)
+
+        idx = offset + _RECORD.size
+        method = mm[idx:idx + method_len].decode('ascii')
+        idx += method_len
+        url = mm[idx:idx + url_len].decode('utf-8')
+        idx += url_len
+        meta = json.loads(mm[idx:idx + meta_len].decode('utf-8'))
+        idx += meta_len
+        body = mm[idx:idx + body_len]
+
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+
+        return Record(url, method, status, meta['headers'], body, ts)
+
+    def get(self, url, method='GET'):
+        """
+        Returns the Record for method and url or None
+        """
+        try:
+            offset = self._index[(method.upper(), url)]
+        except KeyError:
+            return None
+
+        return self._read(offset)
+
+    def keys(self):
+        """
+        Returns the (method, url) tuples in the archive
+        """
+        return list(self._index)
+
+    def urls(self):
+        return sorted(set(url for (method, url) in self._index))
+
+    def __contains__(self, url):
+        return ('GET', url) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        """
+        Iterates over all records (including overwritten ones) in write
+        order
+        """
+        offset = len(_MAGIC)
+        while offset < self._end:
+            record = self._read(offset)
+            yield record
+            offset += _RECORD.size + sum(
+                _RECORD.unpack_from(self._mm, offset)[3:])
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
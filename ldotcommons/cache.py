@@ -2,89 +2,1948 @@
 
 from ldotcommons import utils
 
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import io
+import json
+import lzma
+import marshal
+import mmap
 import os
 import pickle
 import shutil
+import sqlite3
+import struct
 import tempfile
+import threading
 import time
+import zlib
 
 from hashlib import sha1
 
+try:
+    import zstandard
+    _has_zstd = True
+except ImportError:
+    _has_zstd = False
+
+try:
+    import fcntl
+    _has_fcntl = True
+except ImportError:
+    _has_fcntl = False
+
 
 def hashfunc(key):
     return sha1(key.encode('utf-8')).hexdigest()
 
 
-class NullCache:
-    def __init__(self, *args, **kwargs):
+def _raw_dumps(value):
+    if not isinstance(value, (bytes, bytearray, memoryview)):
+        msg = "Raw serializer only accepts bytes-like values: {type}"
+        msg = msg.format(type=type(value).__name__)
+        raise TypeError(msg)
+
+    return value
+
+
+def _raw_loads(buff):
+    return memoryview(buff)
+
+
+def _pickle_dumps(value):
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _pickle_oob_dumps(value):
+    # Protocol 5 with out-of-band buffers: buffers are stored after the
+    # pickle stream so they can be loaded from the mmap without copies
+    buffers = []
+    stream = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    buffers = [x.raw() for x in buffers]
+
+    lengths = [len(stream)] + [x.nbytes for x in buffers]
+    return b''.join(
+        [struct.pack('<I{}Q'.format(len(lengths)), len(buffers), *lengths),
+         stream] + buffers)
+
+
+def _pickle_oob_loads(buff):
+    buff = memoryview(buff)
+    (n,) = struct.unpack_from('<I', buff)
+    lengths = struct.unpack_from('<{}Q'.format(n + 1), buff, 4)
+
+    offset = 4 + 8 * (n + 1)
+    chunks = []
+    for length in lengths:
+        chunks.append(buff[offset:offset + length])
+        offset += length
+
+    return pickle.loads(chunks[0], buffers=chunks[1:])
+
+
+def _json_dumps(value):
+    return json.dumps(value).encode('utf-8')
+
+
+def _json_loads(buff):
+    return json.loads(bytes(buff).decode('utf-8'))
+
+
+# Serializers and compressors are identified on disk by its id, never
+# change them
+SERIALIZERS = {
+    'raw': (0, _raw_dumps, _raw_loads),
+    'pickle': (1, _pickle_dumps, pickle.loads),
+    'marshal': (3, marshal.dumps, marshal.loads),
+    'json': (4, _json_dumps, _json_loads),
+}
+if pickle.HIGHEST_PROTOCOL >= 5:
+    SERIALIZERS['pickle5'] = (2, _pickle_oob_dumps, _pickle_oob_loads)
+
+COMPRESSORS = {
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'lzma': (2, lzma.compress, lzma.decompress),
+}
+if _has_zstd:
+    COMPRESSORS['zstd'] = (
+        3,
+        lambda x: zstandard.ZstdCompressor().compress(x),
+        lambda x: zstandard.ZstdDecompressor().decompress(x))
+
+# Header: magic, format version, serializer id, compressor id
+_HEADER = struct.Struct('<4sBBB')
+_HEADER_MAGIC = b'\xffLDC'
+_HEADER_VERSION = 1
+
+
+def _encode(value, serializer='pickle', compression=None,
+            compress_threshold=0):
+    (serializer_id, dumps, _) = SERIALIZERS[serializer]
+    buff = dumps(value)
+
+    compressor_id = 0
+    if compression and len(buff) >= compress_threshold:
+        (codec_id, compress, _) = COMPRESSORS[compression]
+        compressed = compress(buff)
+        if len(compressed) < len(buff):
+            (buff, compressor_id) = (compressed, codec_id)
+
+    header = _HEADER.pack(
+        _HEADER_MAGIC, _HEADER_VERSION, serializer_id, compressor_id)
+
+    return header + buff
+
+
+def _decode(buff, fallback='pickle'):
+    """
+    Decodes an _encode'd buffer. Buffers without header (written by older
+    versions) are loaded with the fallback serializer
+    """
+    buff = memoryview(buff)
+    if bytes(buff[:len(_HEADER_MAGIC)]) != _HEADER_MAGIC:
+        return SERIALIZERS[fallback][2](buff)
+
+    (_, version, serializer_id, compressor_id) = _HEADER.unpack_from(buff)
+    if version != _HEADER_VERSION:
+        msg = "Unknown format version: {version}"
+        msg = msg.format(version=version)
+        raise ValueError(msg)
+
+    buff = buff[_HEADER.size:]
+
+    if compressor_id:
+        decompress = _by_id(COMPRESSORS, compressor_id)[2]
+        buff = decompress(buff)
+
+    return _by_id(SERIALIZERS, serializer_id)[2](buff)
+
+
+def _is_zero_copy(header, fallback='pickle'):
+    # Whether values decoded from the buffer starting with header can
+    # reference it instead of copying it
+    if header[:len(_HEADER_MAGIC)] != _HEADER_MAGIC:
+        return fallback == 'raw'
+
+    if len(header) < _HEADER.size:
+        return False
+
+    (_, version, serializer_id, compressor_id) = _HEADER.unpack(header)
+    return compressor_id == 0 and serializer_id in [
+        SERIALIZERS[x][0] for x in ('raw', 'pickle5') if x in SERIALIZERS]
+
+
+def _by_id(table, id_):
+    for (name, entry) in table.items():
+        if entry[0] == id_:
+            return entry
+
+    msg = "Unsupported codec id: {id}"
+    msg = msg.format(id=id_)
+    raise ValueError(msg)
+
+
+# Eviction policies get called with (size, atime, hits) for each entry in the
+# index and return a sort key, entries with lower keys are evicted first
+EVICTION_POLICIES = {
+    'lru': lambda size, atime, hits: atime,
+    'lfu': lambda size, atime, hits: (hits, atime),
+}
+
+
+class CacheStats:
+    """
+    Counters and latency histograms for a cache.
+
+    If hook is set it's called as hook(name, value) for every recorded
+    counter increment and latency observation, use it to export stats to
+    other systems.
+    """
+    COUNTERS = ('hits', 'misses', 'expirations', 'errors',
+                'bytes_read', 'bytes_written')
+    OPERATIONS = ('get', 'set', 'get_many', 'set_many')
+
+    # Upper bounds (in seconds) of latency histogram buckets
+    LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                       1, float('inf'))
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self._lock = threading.Lock()
+        self.reset()
+
+    def incr(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+        if self.hook:
+            self.hook(counter, n)
+
+    def observe(self, operation, seconds):
+        idx = bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+        with self._lock:
+            self._latency[operation][idx] += 1
+
+        if self.hook:
+            self.hook(operation, seconds)
+
+    def snapshot(self):
+        """
+        Returns a copy of current stats as a dict
+        """
+        with self._lock:
+            ret = dict(self._counters)
+            ret['latency'] = {k: list(v) for (k, v) in self._latency.items()}
+
+        return ret
+
+    def reset(self):
+        with self._lock:
+            self._counters = {k: 0 for k in self.COUNTERS}
+            self._latency = {k: [0] * len(self.LATENCY_BUCKETS)
+                             for k in self.OPERATIONS}
+
+    @property
+    def hit_ratio(self):
+        total = self._counters['hits'] + self._counters['misses']
+        return self._counters['hits'] / total if total else 0
+
+
+class CacheWriter:
+    """
+    Stores a value written in chunks (bytes-like objects) under key.
+
+    The value is stored on commit(), abort() discards it. Used as a context
+    manager it commits unless an exception was raised. This implementation
+    collects chunks in memory, backends can provide better ones.
+    """
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self._chunks = []
+
+    def write(self, chunk):
+        self._chunks.append(bytes(chunk))
+
+    def commit(self):
+        self.cache.set(self.key, b''.join(self._chunks))
+        self._chunks = []
+
+    def abort(self):
+        self._chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class _NullWriter(CacheWriter):
+    def write(self, chunk):
         pass
 
+    def commit(self):
+        pass
+
+
+class _DiskCacheWriter(CacheWriter):
+    # Chunks go straight to a temporary file (as a 'raw' entry) which is
+    # renamed into place on commit
+    def __init__(self, cache, key):
+        super().__init__(cache, key)
+        self._path = cache._on_disk_path(key)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+
+        (self._fh, self._tmp) = cache._open_tmp(self._path)
+        self.write(_encode(b'', serializer='raw'))
+
+    def write(self, chunk):
+        self._fh.write(chunk)
+
+    def commit(self):
+        if self._fh is None:
+            return
+
+        (fh, self._fh) = (self._fh, None)
+        size = fh.tell()
+        self.cache._commit_tmp(fh, self._tmp, self._path)
+
+        self.cache._index_touch(os.path.basename(self._path), size=size)
+        self.cache.stats.incr('bytes_written', size)
+        self.cache.evict()
+
+    def abort(self):
+        if self._fh is None:
+            return
+
+        self.cache._abort_tmp(self._fh, self._tmp)
+        self._fh = None
+
+
+class BaseCache:
+    """
+    Base class for cache backends.
+
+    Backends implement _get() and _set(), and optionally _get_many() and
+    _set_many(). Public methods wrap them to keep stats updated.
+    """
+    @property
+    def stats(self):
+        try:
+            return self._stats
+        except AttributeError:
+            self._stats = CacheStats()
+            return self._stats
+
     def get(self, key):
+        t0 = time.perf_counter()
+        value = self._get(key)
+        self.stats.observe('get', time.perf_counter() - t0)
+        self.stats.incr('misses' if value is None else 'hits')
+
+        return value
+
+    def set(self, key, value):
+        t0 = time.perf_counter()
+        self._set(key, value)
+        self.stats.observe('set', time.perf_counter() - t0)
+
+    def get_entry(self, key):
+        """
+        Like get() but returns a (value, mtime) tuple, mtime is when value
+        was stored (None if backend doesn't know it). Returns None for
+        missing keys.
+        """
+        t0 = time.perf_counter()
+        entry = self._get_entry(key)
+        self.stats.observe('get', time.perf_counter() - t0)
+        self.stats.incr('misses' if entry is None else 'hits')
+
+        return entry
+
+    def get_many(self, keys):
+        """
+        Returns a dict with the values found for keys, missing keys are not
+        included.
+        """
+        keys = list(keys)
+
+        t0 = time.perf_counter()
+        ret = self._get_many(keys)
+        self.stats.observe('get_many', time.perf_counter() - t0)
+        self.stats.incr('hits', len(ret))
+        self.stats.incr('misses', len(keys) - len(ret))
+
+        return ret
+
+    def get_many_entries(self, keys):
+        """
+        Like get_many() but values are (value, mtime) tuples, see
+        get_entry().
+        """
+        keys = list(keys)
+
+        t0 = time.perf_counter()
+        ret = self._get_many_entries(keys)
+        self.stats.observe('get_many', time.perf_counter() - t0)
+        self.stats.incr('hits', len(ret))
+        self.stats.incr('misses', len(keys) - len(ret))
+
+        return ret
+
+    def set_many(self, mapping):
+        t0 = time.perf_counter()
+        self._set_many(mapping)
+        self.stats.observe('set_many', time.perf_counter() - t0)
+
+    def _get(self, key):
+        raise NotImplementedError('Method not implemented')
+
+    def _set(self, key, value):
+        raise NotImplementedError('Method not implemented')
+
+    def _get_entry(self, key):
+        value = self._get(key)
+        return None if value is None else (value, None)
+
+    def _get_many(self, keys):
+        ret = {}
+        for key in keys:
+            value = self._get(key)
+            if value is not None:
+                ret[key] = value
+
+        return ret
+
+    def _get_many_entries(self, keys):
+        return {key: (value, None)
+                for (key, value) in self._get_many(keys).items()}
+
+    def _set_many(self, mapping):
+        for (key, value) in mapping.items():
+            self._set(key, value)
+
+    def open_writer(self, key):
+        """
+        Returns a CacheWriter to store a bytes value under key in chunks.
+        """
+        return CacheWriter(self, key)
+
+    def sweep(self, limit=0):
+        """
+        Deletes outdated entries, examining at most limit entries (0 means
+        no limit) per call. Calls resume where the previous one stopped.
+
+        Returns a (removed entries, reclaimed bytes) tuple.
+        """
+        return (0, 0)
+
+    def close(self):
+        """
+        Releases resources held by the cache, it must not be used after
+        that.
+        """
+        pass
+
+
+class NullCache(BaseCache):
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def open_writer(self, key):
+        return _NullWriter(self, key)
+
+    def _get(self, key):
         return None
 
-    def set(self, key, data):
+    def _set(self, key, data):
         pass
 
+    def _get_many(self, keys):
+        return {}
 
-class DiskCache:
-    def __init__(self, basedir=None, delta=-1, hashfunc=hashfunc,
+    def _set_many(self, mapping):
+        pass
+
+
+class MemoryCache(BaseCache):
+    """
+    Bounded in-memory LRU cache.
+
+    Values are stored as is, not copied, so callers must not modify them.
+    """
+    def __init__(self, max_entries=1024, delta=-1, hashfunc=hashfunc,
                  logger=None):
+        self.max_entries = max_entries
+        self.delta = delta
+        self.hashfunc = hashfunc
+        self._logger = logger or utils.NullSingleton()
+        self._data = collections.OrderedDict()
+
+    def set(self, key, value, mtime=None):
+        """
+        Stores value, if mtime is given value is considered to be stored at
+        that time (to expire it along with a copy in other cache)
+        """
+        t0 = time.perf_counter()
+        self._set(key, value, mtime)
+        self.stats.observe('set', time.perf_counter() - t0)
+
+    def _get(self, key):
+        entry = self._get_entry(key)
+        return None if entry is None else entry[0]
+
+    def _get_entry(self, key):
+        hashed = self.hashfunc(key)
+        try:
+            (mtime, value) = self._data[hashed]
+        except KeyError:
+            return None
+
+        if self.delta >= 0 and time.time() - mtime > self.delta:
+            msg = "Key «{key}» is outdated"
+            msg = msg.format(key=key)
+            self._logger.debug(msg)
+            del self._data[hashed]
+            self.stats.incr('expirations')
+            return None
+
+        self._data.move_to_end(hashed)
+        return (value, mtime)
+
+    def _set(self, key, value, mtime=None):
+        hashed = self.hashfunc(key)
+        self._data[hashed] = (time.time() if mtime is None else mtime, value)
+        self._data.move_to_end(hashed)
+
+        while self.max_entries > 0 and len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def sweep(self, limit=0):
+        if self.delta < 0:
+            return (0, 0)
+
+        now = time.time()
+        expired = [k for (k, (mtime, value)) in self._data.items()
+                   if now - mtime > self.delta]
+        if limit > 0:
+            expired = expired[:limit]
+
+        for k in expired:
+            del self._data[k]
+
+        self.stats.incr('expirations', len(expired))
+        return (len(expired), 0)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache(BaseCache):
+    """
+    Keeps hot values in a MemoryCache in front of another cache (usually a
+    DiskCache), backend is only accessed on memory misses.
+
+    Memory tier uses the same hashfunc and delta as backend. Values read
+    from backend keep their backend mtime (see get_entry()) so they don't
+    outlive the backend copy.
+    """
+    def __init__(self, backend, memory_entries=1024, logger=None):
+        self.backend = backend
+        self.memory = MemoryCache(
+            max_entries=memory_entries,
+            delta=getattr(backend, 'delta', -1),
+            hashfunc=getattr(backend, 'hashfunc', hashfunc),
+            logger=logger)
+        self.counters = {
+            'memory': {'hits': 0, 'misses': 0},
+            'backend': {'hits': 0, 'misses': 0}
+        }
+
+    def _get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.counters['memory']['hits'] += 1
+            return value
+
+        self.counters['memory']['misses'] += 1
+
+        entry = self.backend.get_entry(key)
+        if entry is None:
+            self.counters['backend']['misses'] += 1
+            return None
+
+        self.counters['backend']['hits'] += 1
+        (value, mtime) = entry
+        self.memory.set(key, value, mtime)
+        return value
+
+    def _set(self, key, value):
+        self.backend.set(key, value)
+        self.memory.set(key, value)
+
+    def _get_many(self, keys):
+        ret = {}
+        missing = []
+        for key in keys:
+            value = self.memory.get(key)
+            if value is not None:
+                ret[key] = value
+            else:
+                missing.append(key)
+
+        self.counters['memory']['hits'] += len(ret)
+        self.counters['memory']['misses'] += len(missing)
+
+        if missing:
+            found = self.backend.get_many_entries(missing)
+            self.counters['backend']['hits'] += len(found)
+            self.counters['backend']['misses'] += len(missing) - len(found)
+
+            for (key, (value, mtime)) in found.items():
+                self.memory.set(key, value, mtime)
+                ret[key] = value
+
+        return ret
+
+    def _set_many(self, mapping):
+        self.backend.set_many(mapping)
+        for (key, value) in mapping.items():
+            self.memory.set(key, value)
+
+    def sweep(self, limit=0):
+        self.memory.sweep(limit)
+        return self.backend.sweep(limit)
+
+
+class DiskCache(BaseCache):
+    """
+    Stores each entry in its own file under basedir.
+
+    Values are serialized with serializer (see SERIALIZERS) and, if they are
+    larger than compress_threshold, compressed with compression (see
+    COMPRESSORS). Both are recorded in a small header so entries written
+    with different settings remain readable.
+
+    The 'raw' serializer (or raw=True) only accepts bytes-like values, for
+    uncompressed entries of at least MMAP_THRESHOLD bytes get() returns a
+    memoryview over a mmap of the cache file so payloads are never copied
+    into memory ('pickle5' buffers are loaded the same way). Each of those
+    values keeps a file descriptor open while alive, mind it when holding
+    many of them (like in a TieredCache memory tier).
+
+    get_many() and set_many() spread file I/O over a pool of workers
+    threads.
+
+    Entries are written to a temporary file and renamed into place, so
+    several processes can share basedir and readers never see partial
+    entries. fsync controls durability: 'never' (default), 'data' (fsync
+    each entry) or 'full' (also fsync its directory after the rename). The
+    index used for budgets is kept per process, entries written by other
+    processes are only accounted after an index rebuild.
+
+    The index is saved as a snapshot plus a journal of changes. Changes are
+    appended to the journal every INDEX_SYNC_INTERVAL writes (or removals)
+    and, for reads, at most every INDEX_SYNC_SECONDS. The snapshot is only
+    rewritten once the journal outgrows it. close() (or sync()) saves
+    pending changes, they are lost if the cache is just garbage collected.
+
+    open_writer() streams chunks to disk, they are stored as a 'raw' entry
+    whatever the serializer is.
+    """
+    INDEX_FILENAME = '.index'
+    INDEX_JOURNAL_FILENAME = '.index-journal'
+    TMP_PREFIX = '.tmp-'
+    TMP_MAX_AGE = 60 * 60
+    FSYNC_POLICIES = ('never', 'data', 'full')
+    INDEX_SYNC_INTERVAL = 100
+    INDEX_SYNC_SECONDS = 30
+    INDEX_JOURNAL_MIN_BYTES = 1024 * 1024
+    EVICTION_WATERMARK = 0.9
+    MMAP_THRESHOLD = 64 * 1024
+
+    def __init__(self, basedir=None, delta=-1, hashfunc=hashfunc,
+                 logger=None, max_bytes=0, max_entries=0, eviction='lru',
+                 raw=False, serializer='pickle', compression=None,
+                 compress_threshold=1024, workers=8, fsync='never'):
         self.basedir = basedir
         self.delta = delta
+        self.serializer = 'raw' if raw else serializer
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hashfunc = hashfunc
+        self.workers = workers
+        self.fsync = fsync
         self._is_tmp = False
         self._logger = logger or utils.NullSingleton()
+        self._executor = None
+
+        # Last entry examined by sweep()
+        self.sweep_cursor = None
+
+        # The index is only maintained if some budget is set. It maps hashed
+        # keys to [size, atime, hits] lists
+        self._index_lock = threading.RLock()
+        self._index = None
+        self._index_bytes = 0
+
+        # Changes not in the journal yet (hashed key to entry, None if it
+        # was removed), writes and removals among them and journal state
+        self._index_pending = {}
+        self._index_dirty = 0
+        self._index_synced = time.monotonic()
+        self._index_snapshot_bytes = 0
+        self._index_journal_bytes = 0
+        self._index_compact = False
+
+        if self.serializer not in SERIALIZERS:
+            msg = "Invalid serializer: '{serializer}'"
+            msg = msg.format(serializer=self.serializer)
+            raise ValueError(msg)
+
+        if self.compression and self.compression not in COMPRESSORS:
+            msg = "Invalid compression: '{compression}'"
+            msg = msg.format(compression=self.compression)
+            raise ValueError(msg)
+
+        if self.fsync not in self.FSYNC_POLICIES:
+            msg = "Invalid fsync policy: '{policy}'"
+            msg = msg.format(policy=self.fsync)
+            raise ValueError(msg)
+
+        if callable(eviction):
+            self._eviction = eviction
+        else:
+            try:
+                self._eviction = EVICTION_POLICIES[eviction]
+            except KeyError as e:
+                msg = "Invalid eviction policy: '{policy}'"
+                msg = msg.format(policy=eviction)
+                raise ValueError(msg) from e
 
         if not self.basedir:
             self.basedir = tempfile.mkdtemp()
             self._is_tmp = True
 
+        if self.max_bytes > 0 or self.max_entries > 0:
+            self._index_load()
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.basedir, self.INDEX_FILENAME)
+
+    @property
+    def _index_journal_path(self):
+        return os.path.join(self.basedir, self.INDEX_JOURNAL_FILENAME)
+
+    def _index_load(self):
+        try:
+            with open(self._index_path, 'rb') as fh:
+                buff = fh.read()
+            self._index = pickle.loads(buff)
+            self._index_snapshot_bytes = len(buff)
+
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            # No index (or a broken one), this is the only case where we walk
+            # basedir. The journal is relative to the lost snapshot
+            self._index = self._index_rebuild()
+            self._index_compact = True
+
+        else:
+            self._index_replay()
+
+        self._index_bytes = sum(x[0] for x in self._index.values())
+
+    def _index_replay(self):
+        try:
+            with open(self._index_journal_path, 'rb') as fh:
+                buff = fh.read()
+        except (IOError, OSError):
+            return
+
+        self._index_journal_bytes = len(buff)
+
+        fh = io.BytesIO(buff)
+        while True:
+            try:
+                changes = pickle.load(fh)
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                # End of journal or a change set cut short by a crash
+                break
+
+            for (hashed, entry) in changes.items():
+                if entry is None:
+                    self._index.pop(hashed, None)
+                else:
+                    self._index[hashed] = entry
+
+    def _index_rebuild(self):
+        msg = "Rebuilding index for '{path}'"
+        msg = msg.format(path=self.basedir)
+        self._logger.debug(msg)
+
+        index = {}
+        for (dirpath, dirnames, filenames) in os.walk(self.basedir):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+
+                try:
+                    s = os.stat(os.path.join(dirpath, filename))
+                except (IOError, OSError):
+                    continue
+
+                index[filename] = [s.st_size, s.st_atime, 0]
+
+        return index
+
+    def _index_touch(self, hashed, size=None):
+        if self._index is None:
+            return
+
+        with self._index_lock:
+            entry = self._index.get(hashed)
+            if entry is None:
+                entry = self._index[hashed] = [0, 0, 0]
+
+            if size is not None:
+                self._index_bytes += size - entry[0]
+                entry[0] = size
+            else:
+                entry[2] += 1
+
+            entry[1] = time.time()
+            self._index_pending[hashed] = entry
+
+            # Reads are only synced from time to time
+            self._index_mark_dirty(size is not None)
+
+    def _index_remove(self, hashed):
+        if self._index is None:
+            return
+
+        with self._index_lock:
+            entry = self._index.pop(hashed, None)
+            if entry is not None:
+                self._index_bytes -= entry[0]
+                self._index_pending[hashed] = None
+                self._index_mark_dirty()
+
+    def _index_mark_dirty(self, write=True):
+        if write:
+            self._index_dirty += 1
+
+        if self._index_dirty >= self.INDEX_SYNC_INTERVAL or \
+           time.monotonic() - self._index_synced >= self.INDEX_SYNC_SECONDS:
+            self.sync()
+
+    def sync(self):
+        """
+        Writes pending index changes to disk.
+        """
+        if self._index is None:
+            return
+
+        with self._index_lock:
+            if self._index_pending:
+                buff = pickle.dumps(self._index_pending)
+                with open(self._index_journal_path, 'ab') as fh:
+                    fh.write(buff)
+                    if self.fsync != 'never':
+                        fh.flush()
+                        os.fsync(fh.fileno())
+
+                self._index_journal_bytes += len(buff)
+                self._index_pending = {}
+
+            self._index_dirty = 0
+            self._index_synced = time.monotonic()
+
+            if self._index_compact or \
+               self._index_journal_bytes > max(self.INDEX_JOURNAL_MIN_BYTES,
+                                               self._index_snapshot_bytes):
+                self._index_write_snapshot()
+
+    def _index_write_snapshot(self):
+        # Replaces snapshot and journal with a new snapshot. If we crash
+        # before removing the journal replaying it again is harmless
+        buff = pickle.dumps(self._index)
+        self._write_atomic(self._index_path, buff)
+        try:
+            os.unlink(self._index_journal_path)
+        except FileNotFoundError:
+            pass
+
+        self._index_snapshot_bytes = len(buff)
+        self._index_journal_bytes = 0
+        self._index_compact = False
+
+    def _over_budget(self, ratio=1):
+        return (
+            (self.max_bytes > 0 and
+             self._index_bytes > self.max_bytes * ratio) or
+            (self.max_entries > 0 and
+             len(self._index) > self.max_entries * ratio)
+        )
+
+    def evict(self):
+        """
+        Removes entries until cache fits into its budget.
+
+        Entries are choosen by the eviction policy and removed until the cache
+        is under EVICTION_WATERMARK of its budget so evictions don't happen on
+        every set once the cache is full.
+        """
+        if self._index is None or not self._over_budget():
+            return 0
+
+        with self._index_lock:
+            victims = sorted(
+                self._index.items(),
+                key=lambda x: self._eviction(*x[1]))
+
+            evicted = 0
+            for (hashed, entry) in victims:
+                if not self._over_budget(self.EVICTION_WATERMARK):
+                    break
+
+                self._unlink(self._on_disk_path_for_hash(hashed))
+                evicted += 1
+
+            self.sync()
+
+        msg = "Evicted {n} entries"
+        msg = msg.format(n=evicted)
+        self._logger.debug(msg)
+
+        return evicted
+
     def _on_disk_path(self, key):
-        hashed = hashfunc(key)
+        return self._on_disk_path_for_hash(self.hashfunc(key))
+
+    def _on_disk_path_for_hash(self, hashed):
         return os.path.join(
             self.basedir, hashed[:0], hashed[:1], hashed[:2], hashed)
 
-    def set(self, key, value):
+    def _map(self, fn, *iterables):
+        if self.workers <= 1:
+            return map(fn, *iterables)
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers)
+
+        return self._executor.map(fn, *iterables)
+
+    def _set(self, key, value):
         p = self._on_disk_path(key)
         dname = os.path.dirname(p)
 
-        if not os.path.exists(dname):
-            os.makedirs(dname)
+        os.makedirs(dname, exist_ok=True)
 
-        with open(p, 'wb') as fh:
-            fh.write(pickle.dumps(value))
+        self._write(p, value)
+        self.evict()
 
-    def get(self, key):
+    def _set_many(self, mapping):
+        paths = [self._on_disk_path(key) for key in mapping]
+
+        # Create each directory only once
+        for dname in set(os.path.dirname(p) for p in paths):
+            os.makedirs(dname, exist_ok=True)
+
+        for x in self._map(self._write, paths, mapping.values()):
+            pass
+
+        self.evict()
+
+    def _get_many(self, keys):
+        return {key: value
+                for (key, (value, mtime))
+                in self._get_many_entries(keys).items()}
+
+    def _get_many_entries(self, keys):
+        keys = list(keys)
+        return {key: entry
+                for (key, entry) in zip(keys, self._map(self._get_entry, keys))
+                if entry is not None}
+
+    def _write(self, p, value):
+        buff = _encode(value, self.serializer, self.compression,
+                       self.compress_threshold)
+        self._write_atomic(p, buff)
+        self._index_touch(os.path.basename(p), size=len(buff))
+        self.stats.incr('bytes_written', len(buff))
+
+    def _write_atomic(self, p, buff):
+        # Readers (from this or other processes) get the old or the new file,
+        # never a partial one. Also, mmaps of the old file stay valid
+        (fh, tmp) = self._open_tmp(p)
+        try:
+            fh.write(buff)
+        except:
+            self._abort_tmp(fh, tmp)
+            raise
+
+        self._commit_tmp(fh, tmp, p)
+
+    def _open_tmp(self, p):
+        (fd, tmp) = tempfile.mkstemp(
+            dir=os.path.dirname(p), prefix=self.TMP_PREFIX)
+        return (os.fdopen(fd, 'wb'), tmp)
+
+    def _commit_tmp(self, fh, tmp, p):
+        # Closes fh and renames tmp into p following the fsync policy
+        try:
+            if self.fsync != 'never':
+                fh.flush()
+                os.fsync(fh.fileno())
+
+            fh.close()
+            os.replace(tmp, p)
+
+        except:
+            self._abort_tmp(fh, tmp)
+            raise
+
+        if self.fsync == 'full':
+            dfd = os.open(os.path.dirname(p), os.O_RDONLY)
+            try:
+                os.fsync(dfd)
+            finally:
+                os.close(dfd)
+
+    def _abort_tmp(self, fh, tmp):
+        fh.close()
+        try:
+            os.unlink(tmp)
+        except (IOError, OSError):
+            pass
+
+    def open_writer(self, key):
+        return _DiskCacheWriter(self, key)
+
+    def _unlink(self, p, st=None):
+        # If st is given p is only removed if it's still the same file, other
+        # process could have replaced it with a fresh entry
+        try:
+            if st is None or os.stat(p).st_ino == st.st_ino:
+                os.unlink(p)
+        except (IOError, OSError):
+            pass
+
+        self._index_remove(os.path.basename(p))
+
+    def _load(self, fh, size):
+        # Files without header are from older versions, they are pickles
+        # unless this is a raw cache
+        fallback = 'raw' if self.serializer == 'raw' else 'pickle'
+
+        # Mapping files is slower than reading small ones and only pays off
+        # if values can reference the map
+        if size < self.MMAP_THRESHOLD or \
+           not _is_zero_copy(fh.read(_HEADER.size), fallback):
+            fh.seek(0)
+            return _decode(fh.read(), fallback=fallback)
+
+        return _decode(
+            mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ),
+            fallback=fallback)
+
+    def _get(self, key):
+        entry = self._get_entry(key)
+        return None if entry is None else entry[0]
+
+    def _get_entry(self, key):
         on_disk = self._on_disk_path(key)
+
+        # Stat the opened file, not the path: the path can be replaced at any
+        # time by other writers
         try:
-            s = os.stat(on_disk)
+            fh = open(on_disk, 'rb')
         except (OSError, IOError):
             return None
 
-        if self.delta >= 0 and \
-           (time.mktime(time.localtime()) - s.st_mtime > self.delta):
+        with fh:
+            s = os.fstat(fh.fileno())
+
+            if self.delta >= 0 and time.time() - s.st_mtime > self.delta:
+                msg = "Key «{key}» is outdated"
+                msg = msg.format(key=key)
+                self._logger.debug(msg)
+                self._unlink(on_disk, s)
+                self.stats.incr('expirations')
+                return None
+
+            try:
+                value = self._load(fh, s.st_size)
+
+            except (IOError, OSError) as e:
+                msg = "Error accessing «{key}»: {reason}"
+                msg = msg.format(key=key, reason=str(e))
+                self._logger.error(msg)
+                self._unlink(on_disk, s)
+                self.stats.incr('errors')
+                return None
+
+            except Exception as e:
+                msg = "Corrupted entry «{key}»: {reason}"
+                msg = msg.format(key=key, reason=repr(e))
+                self._logger.error(msg)
+                self._unlink(on_disk, s)
+                self.stats.incr('errors')
+                return None
+
+        self.stats.incr('bytes_read', s.st_size)
+
+        msg = "Found «{key}»: '{path}'"
+        msg = msg.format(key=key, path=on_disk)
+        self._logger.debug(msg)
+
+        self._index_touch(os.path.basename(on_disk))
+        return (value, s.st_mtime)
+
+    def _sweep_candidates(self):
+        # Walks leaf directories in order skipping everything up to
+        # sweep_cursor. Hashes are spread over directories by its prefix so
+        # this order is the same as the order of the hashes
+        cursor = self.sweep_cursor or ''
+
+        def listdir(path):
+            try:
+                return sorted(os.listdir(path))
+            except (IOError, OSError):
+                return []
+
+        for first in listdir(self.basedir):
+            if first.startswith('.') or first < cursor[:1]:
+                continue
+
+            for second in listdir(os.path.join(self.basedir, first)):
+                if second < cursor[:2]:
+                    continue
+
+                dname = os.path.join(self.basedir, first, second)
+                for name in listdir(dname):
+                    if name.startswith(self.TMP_PREFIX) or name > cursor:
+                        yield (dname, name)
+
+    def sweep(self, limit=0):
+        """
+        Deletes outdated entries and temporary files left by crashed
+        writers.
+
+        At most limit files (0 means no limit) are examined per call, next
+        call resumes from sweep_cursor. Once the whole cache has been walked
+        sweep_cursor is reset to None.
+        """
+        now = time.time()
+        (examined, removed, reclaimed) = (0, 0, 0)
+
+        for (dname, name) in self._sweep_candidates():
+            if limit > 0 and examined >= limit:
+                break
+
+            examined += 1
+            p = os.path.join(dname, name)
+            try:
+                s = os.stat(p)
+            except (IOError, OSError):
+                continue
+
+            if name.startswith(self.TMP_PREFIX):
+                if now - s.st_mtime <= self.TMP_MAX_AGE:
+                    continue
+
+            else:
+                self.sweep_cursor = name
+                if self.delta < 0 or now - s.st_mtime <= self.delta:
+                    continue
+
+                self.stats.incr('expirations')
+
+            self._unlink(p, s)
+            removed += 1
+            reclaimed += s.st_size
+
+        else:
+            self.sweep_cursor = None
+
+        if removed:
+            msg = "Swept {n} entries ({size} bytes)"
+            msg = msg.format(n=removed, size=reclaimed)
+            self._logger.debug(msg)
+
+        return (removed, reclaimed)
+
+    def close(self):
+        """
+        Saves pending index changes and stops workers.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+        if self._is_tmp:
+            shutil.rmtree(self.basedir)
+            self._is_tmp = False
+            return
+
+        self.sync()
+
+    def __del__(self):
+        # Index is not synced here, modules may be gone already if we are
+        # collected at interpreter shutdown
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+        if self._is_tmp:
+            shutil.rmtree(self.basedir)
+
+
+class SqliteCache(BaseCache):
+    """
+    Stores all entries in a single SQLite database (in WAL mode) instead of
+    one file per key.
+    """
+    def __init__(self, path=None, delta=-1, hashfunc=hashfunc, logger=None):
+        self.path = path
+        self.delta = delta
+        self.hashfunc = hashfunc
+        self._is_tmp = False
+        self._logger = logger or utils.NullSingleton()
+        self._lock = threading.Lock()
+
+        if not self.path:
+            (fd, self.path) = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+            self._is_tmp = True
+
+        self._conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            '  key TEXT PRIMARY KEY,'
+            '  mtime REAL NOT NULL,'
+            '  value BLOB NOT NULL)')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS cache_mtime ON cache (mtime)')
+
+    def _set(self, key, value):
+        buff = pickle.dumps(value)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache (key, mtime, value) '
+                'VALUES (?, ?, ?)',
+                (self.hashfunc(key), time.time(), buff))
+
+        self.stats.incr('bytes_written', len(buff))
+
+    def _get(self, key):
+        entry = self._get_entry(key)
+        return None if entry is None else entry[0]
+
+    def _get_entry(self, key):
+        hashed = self.hashfunc(key)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT mtime, value FROM cache WHERE key = ?',
+                (hashed,)).fetchone()
+
+        if row is None:
+            return None
+
+        (mtime, buff) = row
+        if self.delta >= 0 and time.time() - mtime > self.delta:
             msg = "Key «{key}» is outdated"
             msg = msg.format(key=key)
             self._logger.debug(msg)
-            os.unlink(on_disk)
+            with self._lock:
+                self._conn.execute(
+                    'DELETE FROM cache WHERE key = ?', (hashed,))
+            self.stats.incr('expirations')
             return None
 
-        try:
-            with open(on_disk, 'rb') as fh:
-                msg = "Found «{key}»: '{path}'"
-                msg = msg.format(key=key, path=on_disk)
-                self._logger.debug(msg)
-                return pickle.loads(fh.read())
+        msg = "Found «{key}»: '{path}'"
+        msg = msg.format(key=key, path=self.path)
+        self._logger.debug(msg)
+        self.stats.incr('bytes_read', len(buff))
+        return (pickle.loads(buff), mtime)
 
-        except (IOError, OSError) as e:
-            msg = "Error accessing «{key}»: {reason}"
-            msg = msg.format(key=key, reason=str(e))
-            self._logger.error(msg)
+    def _set_many(self, mapping):
+        now = time.time()
+        rows = [(self.hashfunc(key), now, pickle.dumps(value))
+                for (key, value) in mapping.items()]
 
+        with self._lock:
+            self._conn.execute('BEGIN')
             try:
-                os.unlink(on_disk)
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO cache (key, mtime, value) '
+                    'VALUES (?, ?, ?)',
+                    rows)
             except:
-                pass
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+        self.stats.incr('bytes_written', sum(len(x[2]) for x in rows))
+
+    def _get_many(self, keys):
+        return {key: value
+                for (key, (value, mtime))
+                in self._get_many_entries(keys).items()}
+
+    def _get_many_entries(self, keys):
+        hashed = {self.hashfunc(key): key for key in keys}
+        hashes = list(hashed)
+
+        rows = []
+        with self._lock:
+            # Keep under SQLite's default limit of 999 parameters per query
+            for idx in range(0, len(hashes), 500):
+                chunk = hashes[idx:idx + 500]
+                rows.extend(self._conn.execute(
+                    'SELECT key, mtime, value FROM cache WHERE key IN '
+                    '({})'.format(', '.join('?' * len(chunk))),
+                    chunk).fetchall())
+
+        now = time.time()
+        ret = {}
+        for (key, mtime, buff) in rows:
+            if self.delta >= 0 and now - mtime > self.delta:
+                continue
+
+            self.stats.incr('bytes_read', len(buff))
+            ret[hashed[key]] = (pickle.loads(buff), mtime)
+
+        return ret
+
+    def sweep(self, limit=0):
+        if self.delta < 0:
+            return (0, 0)
+
+        query = 'SELECT key, LENGTH(value) FROM cache WHERE mtime < ?'
+        params = (time.time() - self.delta,)
+        if limit > 0:
+            query += ' LIMIT ?'
+            params += (limit,)
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+            self._conn.executemany(
+                'DELETE FROM cache WHERE key = ?',
+                [(key,) for (key, size) in rows])
+
+        self.stats.incr('expirations', len(rows))
+        return (len(rows), sum(size for (key, size) in rows))
+
+    def expire(self):
+        """
+        Deletes all outdated entries, returns the number of deleted entries.
+        """
+        if self.delta < 0:
+            return 0
+
+        with self._lock:
+            cursor = self._conn.execute(
+                'DELETE FROM cache WHERE mtime < ?',
+                (time.time() - self.delta,))
+
+        self.stats.incr('expirations', cursor.rowcount)
+        return cursor.rowcount
+
+    def close(self):
+        if self._conn is None:
+            return
+
+        self._conn.close()
+        self._conn = None
+
+        if self._is_tmp:
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.unlink(self.path + suffix)
+                except (IOError, OSError):
+                    pass
 
     def __del__(self):
+        if getattr(self, '_conn', None) is not None:
+            self.close()
+
+
+class LogCache(BaseCache):
+    """
+    Log-structured cache.
+
+    Values are appended to large segment files and located through an
+    in-memory index of hashed key -> (segment, offset, length, mtime) which is
+    checkpointed to disk. Reads are served from mmaps of the segments.
+
+    Overwritten and outdated entries are kept on disk until compact() (called
+    periodically from a background thread if compact_interval is set)
+    rewrites live entries of segments with at least compact_ratio of dead
+    bytes into the active segment and removes those segments.
+
+    Only one process can use basedir at a time, it's locked where fcntl is
+    available.
+    """
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    CHECKPOINT_FILENAME = 'index'
+    CHECKPOINT_INTERVAL = 1000
+    LOCK_FILENAME = 'lock'
+    COMPACT_RATIO = 0.5
+
+    # flags, mtime, key length, value length
+    _RECORD_HEADER = struct.Struct('<BdHQ')
+    _FLAG_TOMBSTONE = 1
+
+    def __init__(self, basedir=None, delta=-1, hashfunc=hashfunc,
+                 logger=None, segment_size=SEGMENT_SIZE, compact_interval=0,
+                 compact_ratio=COMPACT_RATIO):
+        self.basedir = basedir
+        self.delta = delta
+        self.hashfunc = hashfunc
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self._is_tmp = False
+        self._logger = logger or utils.NullSingleton()
+        self._lock = threading.RLock()
+
+        if not self.basedir:
+            self.basedir = tempfile.mkdtemp()
+            self._is_tmp = True
+
+        os.makedirs(self.basedir, exist_ok=True)
+        self._lock_fh = self._lock_basedir()
+
+        self._index = {}
+        self._maps = {}
+        self._active = 0
+        self._active_fh = None
+        # segment -> bytes of overwritten entries and tombstones
+        self._dead = collections.Counter()
+        self._pending = 0
+
+        self._load()
+        self._open_active()
+
+        self._compactor = None
+        self._compactor_stop = threading.Event()
+        if compact_interval > 0:
+            self._compactor = threading.Thread(
+                target=self._compactor_loop, args=(compact_interval,),
+                daemon=True)
+            self._compactor.start()
+
+    def _lock_basedir(self):
+        if not _has_fcntl:
+            return None
+
+        fh = open(os.path.join(self.basedir, self.LOCK_FILENAME), 'wb')
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            fh.close()
+            msg = "Cache directory '{path}' is in use"
+            msg = msg.format(path=self.basedir)
+            raise IOError(msg) from e
+
+        return fh
+
+    def _segment_path(self, segment):
+        return os.path.join(
+            self.basedir, 'segment-{:08d}.log'.format(segment))
+
+    def _segments(self):
+        ret = []
+        for name in os.listdir(self.basedir):
+            if name.startswith('segment-') and name.endswith('.log'):
+                ret.append(int(name[len('segment-'):-len('.log')]))
+
+        return sorted(ret)
+
+    def _load(self):
+        (segment, offset) = (0, 0)
+
+        try:
+            with open(os.path.join(self.basedir,
+                                   self.CHECKPOINT_FILENAME), 'rb') as fh:
+                checkpoint = pickle.loads(fh.read())
+
+            self._index = checkpoint['index']
+            self._dead = collections.Counter(checkpoint['dead'])
+            (segment, offset) = checkpoint['position']
+
+        except (IOError, OSError, EOFError, KeyError,
+                pickle.UnpicklingError):
+            pass
+
+        # Replay records written after the checkpoint
+        for seg in self._segments():
+            if seg < segment:
+                continue
+
+            self._replay(seg, offset if seg == segment else 0)
+            self._active = seg
+
+    def _replay(self, segment, offset):
+        path = self._segment_path(segment)
+        hsize = self._RECORD_HEADER.size
+
+        with open(path, 'rb') as fh:
+            fh.seek(offset)
+            while True:
+                header = fh.read(hsize)
+                if len(header) < hsize:
+                    break
+
+                (flags, mtime, klen, vlen) = \
+                    self._RECORD_HEADER.unpack(header)
+                hashed = fh.read(klen).decode('ascii')
+                value_offset = offset + hsize + klen
+                fh.seek(vlen, os.SEEK_CUR)
+                if len(hashed) < klen or fh.tell() > os.fstat(
+                        fh.fileno()).st_size:
+                    break
+
+                self._index_update(
+                    hashed,
+                    None if flags & self._FLAG_TOMBSTONE
+                    else (segment, value_offset, vlen, mtime),
+                    segment, hsize + klen + vlen)
+                offset = value_offset + vlen
+
+        # Drop incomplete trailing records
+        if offset < os.path.getsize(path):
+            msg = "Truncating incomplete record at '{path}':{offset}"
+            msg = msg.format(path=path, offset=offset)
+            self._logger.warning(msg)
+            os.truncate(path, offset)
+
+    def _index_update(self, hashed, entry, segment, size):
+        # size is the one of the record for entry, written in segment
+        prev = self._index.pop(hashed, None)
+        if prev is not None:
+            self._dead[prev[0]] += \
+                self._RECORD_HEADER.size + len(hashed) + prev[2]
+
+        if entry is not None:
+            self._index[hashed] = entry
+        else:
+            self._dead[segment] += size
+
+    def _dead_ratio(self, segment):
+        if segment == self._active:
+            size = self._active_fh.tell()
+        else:
+            try:
+                size = os.path.getsize(self._segment_path(segment))
+            except (IOError, OSError):
+                size = 0
+
+        return self._dead[segment] / size if size else 0
+
+    def _open_active(self):
+        self._active_fh = open(self._segment_path(self._active), 'ab')
+
+    def _roll(self):
+        self._active_fh.close()
+        self._active += 1
+        self._open_active()
+
+    def _append(self, hashed, buff, mtime, flags=0, flush=True):
+        key = hashed.encode('ascii')
+        if self._active_fh.tell() >= self.segment_size:
+            self._roll()
+
+        offset = self._active_fh.tell()
+        self._active_fh.write(
+            self._RECORD_HEADER.pack(flags, mtime, len(key), len(buff)) +
+            key + buff)
+        if flush:
+            self._active_fh.flush()
+
+        self._index_update(
+            hashed,
+            None if flags & self._FLAG_TOMBSTONE
+            else (self._active, offset + self._RECORD_HEADER.size + len(key),
+                  len(buff), mtime),
+            self._active, self._RECORD_HEADER.size + len(key) + len(buff))
+
+        self._pending += 1
+        if self._pending >= self.CHECKPOINT_INTERVAL:
+            self.checkpoint()
+
+    def _read(self, entry):
+        (segment, offset, length, mtime) = entry
+
+        mm = self._maps.get(segment)
+        if mm is None or len(mm) < offset + length:
+            if mm is not None:
+                mm.close()
+
+            with open(self._segment_path(segment), 'rb') as fh:
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = mm
+
+        return mm[offset:offset + length]
+
+    def checkpoint(self):
+        """
+        Writes index to disk so opening the cache doesn't need to replay all
+        segments.
+        """
+        with self._lock:
+            checkpoint = {
+                'index': self._index,
+                'dead': dict(self._dead),
+                'position': (self._active, self._active_fh.tell())
+            }
+            path = os.path.join(self.basedir, self.CHECKPOINT_FILENAME)
+            with open(path + '.tmp', 'wb') as fh:
+                fh.write(pickle.dumps(checkpoint))
+            os.replace(path + '.tmp', path)
+
+            self._pending = 0
+
+    def _set(self, key, value):
+        buff = pickle.dumps(value)
+        with self._lock:
+            self._append(self.hashfunc(key), buff, time.time())
+
+        self.stats.incr('bytes_written', len(buff))
+
+    def _set_many(self, mapping):
+        now = time.time()
+        buffs = [(self.hashfunc(key), pickle.dumps(value))
+                 for (key, value) in mapping.items()]
+
+        with self._lock:
+            for (hashed, buff) in buffs:
+                self._append(hashed, buff, now, flush=False)
+            self._active_fh.flush()
+
+        self.stats.incr('bytes_written', sum(len(x[1]) for x in buffs))
+
+    def _get(self, key):
+        entry = self._get_entry(key)
+        return None if entry is None else entry[0]
+
+    def _get_entry(self, key):
+        hashed = self.hashfunc(key)
+        with self._lock:
+            ret = self._get_buffer(key, hashed)
+
+        if ret is None:
+            return None
+
+        (buff, mtime) = ret
+        return (pickle.loads(buff), mtime)
+
+    def _get_many(self, keys):
+        return {key: value
+                for (key, (value, mtime))
+                in self._get_many_entries(keys).items()}
+
+    def _get_many_entries(self, keys):
+        with self._lock:
+            buffs = [(key, self._get_buffer(key, self.hashfunc(key)))
+                     for key in keys]
+
+        return {key: (pickle.loads(ret[0]), ret[1])
+                for (key, ret) in buffs
+                if ret is not None}
+
+    def _get_buffer(self, key, hashed):
+        # Returns (buffer, mtime) or None
+        entry = self._index.get(hashed)
+        if entry is None:
+            return None
+
+        if self.delta >= 0 and time.time() - entry[3] > self.delta:
+            msg = "Key «{key}» is outdated"
+            msg = msg.format(key=key)
+            self._logger.debug(msg)
+            self._append(hashed, b'', time.time(),
+                         flags=self._FLAG_TOMBSTONE)
+            self.stats.incr('expirations')
+            return None
+
+        self.stats.incr('bytes_read', entry[2])
+        return (self._read(entry), entry[3])
+
+    def sweep(self, limit=0):
+        """
+        Drops outdated entries from the index. Its space in segments is
+        reclaimed by the next compact().
+        """
+        if self.delta < 0:
+            return (0, 0)
+
+        now = time.time()
+        with self._lock:
+            expired = [(k, v) for (k, v) in self._index.items()
+                       if now - v[3] > self.delta]
+            if limit > 0:
+                expired = expired[:limit]
+
+            for (hashed, entry) in expired:
+                self._append(hashed, b'', now, flags=self._FLAG_TOMBSTONE,
+                             flush=False)
+            self._active_fh.flush()
+
+        self.stats.incr('expirations', len(expired))
+        return (len(expired), sum(v[2] for (k, v) in expired))
+
+    def compact(self, min_dead_ratio=0):
+        """
+        Rewrites live entries from segments where overwritten entries and
+        tombstones take at least min_dead_ratio of the size into a new
+        active segment, dropping outdated ones, and deletes those segments.
+        With the default ratio all segments are compacted. Returns the
+        number of compacted segments.
+
+        Lock is only held per entry so readers and writers are not blocked
+        for the whole compaction.
+        """
+        with self._lock:
+            if self._active_fh.tell() > 0 and \
+               self._dead_ratio(self._active) >= min_dead_ratio:
+                self._roll()
+
+            sealed = [x for x in self._segments()
+                      if x < self._active and
+                      self._dead_ratio(x) >= min_dead_ratio]
+            if not sealed:
+                return 0
+
+            segments = set(sealed)
+            entries = [(k, v) for (k, v) in self._index.items()
+                       if v[0] in segments]
+
+        now = time.time()
+        for (hashed, entry) in entries:
+            with self._lock:
+                if self._index.get(hashed) != entry:
+                    continue
+
+                if self.delta >= 0 and now - entry[3] > self.delta:
+                    del self._index[hashed]
+                    continue
+
+                self._append(hashed, self._read(entry), entry[3])
+
+        with self._lock:
+            for segment in sealed:
+                self._dead.pop(segment, None)
+            self.checkpoint()
+
+            for segment in sealed:
+                mm = self._maps.pop(segment, None)
+                if mm is not None:
+                    mm.close()
+
+                try:
+                    os.unlink(self._segment_path(segment))
+                except (IOError, OSError):
+                    pass
+
+        msg = "Compacted {n} segments"
+        msg = msg.format(n=len(sealed))
+        self._logger.debug(msg)
+
+        return len(sealed)
+
+    def _compactor_loop(self, interval):
+        while not self._compactor_stop.wait(interval):
+            if any(self._dead.values()):
+                try:
+                    self.compact(self.compact_ratio)
+                except (IOError, OSError) as e:
+                    msg = "Error compacting '{path}': {reason}"
+                    msg = msg.format(path=self.basedir, reason=str(e))
+                    self._logger.error(msg)
+
+    def close(self):
+        if self._active_fh is None:
+            return
+
+        if self._compactor:
+            self._compactor_stop.set()
+            self._compactor.join()
+            self._compactor = None
+
+        with self._lock:
+            self.checkpoint()
+            self._active_fh.close()
+            self._active_fh = None
+
+            for mm in self._maps.values():
+                mm.close()
+            self._maps = {}
+
+        if self._lock_fh is not None:
+            self._lock_fh.close()
+            self._lock_fh = None
+
         if self._is_tmp:
             shutil.rmtree(self.basedir)
+
+    def __del__(self):
+        if getattr(self, '_active_fh', None) is not None:
+            self.close()
+
+
+class AsyncCache:
+    """
+    asyncio interface for any cache backend.
+
+    get(), set() and get_many() run on a bounded executor owned by the
+    instance and return futures so they can be awaited from coroutines.
+    Concurrent get() calls for the same key share a single backend read.
+    """
+    def __init__(self, backend, max_workers=4, loop=None):
+        self.backend = backend
+        self._loop = loop or asyncio.get_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+        self._inflight = {}
+
+    @property
+    def stats(self):
+        return self.backend.stats
+
+    def _run(self, fn, *args):
+        return self._loop.run_in_executor(self._executor, fn, *args)
+
+    def get(self, key):
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = self._run(self.backend.get, key)
+            fut.add_done_callback(lambda x: self._done(key, x))
+            self._inflight[key] = fut
+
+        # Shield the shared future, cancelling one reader must not cancel
+        # the others
+        return asyncio.shield(fut)
+
+    def _done(self, key, fut):
+        # After a set() key can belong to a newer read
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+
+    def set(self, key, value):
+        # Readers arriving after this set must not get the in-flight value
+        self._inflight.pop(key, None)
+        return self._run(self.backend.set, key, value)
+
+    def open_writer(self, key):
+        """
+        Returns the backend's CacheWriter for key, its methods are blocking
+        """
+        self._inflight.pop(key, None)
+        return self.backend.open_writer(key)
+
+    def get_many(self, keys):
+        return self._run(self.backend.get_many, list(keys))
+
+    def set_many(self, mapping):
+        for key in mapping:
+            self._inflight.pop(key, None)
+        return self._run(self.backend.set_many, dict(mapping))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class AsyncDiskCache(AsyncCache):
+    """
+    AsyncCache over a DiskCache, extra arguments are passed to DiskCache.
+    """
+    def __init__(self, *args, max_workers=4, loop=None, **kwargs):
+        super().__init__(DiskCache(*args, **kwargs),
+                         max_workers=max_workers, loop=loop)
+
+    def close(self):
+        super().close()
+        self.backend.close()
+
+
+class Sweeper:
+    """
+    Calls cache.sweep() every interval seconds, from a background thread
+    (start) or from an asyncio loop (attach).
+    """
+    def __init__(self, cache, interval=60, limit=1000, logger=None):
+        self.cache = cache
+        self.interval = interval
+        self.limit = limit
+        self.removed = 0
+        self.reclaimed = 0
+        self._logger = logger or utils.NullSingleton()
+        self._stop = threading.Event()
+        self._thread = None
+        self._handle = None
+
+    def tick(self):
+        try:
+            (removed, reclaimed) = self.cache.sweep(limit=self.limit)
+        except (IOError, OSError, sqlite3.Error) as e:
+            msg = "Error sweeping cache: {reason}"
+            msg = msg.format(reason=str(e))
+            self._logger.error(msg)
+            return (0, 0)
+
+        self.removed += removed
+        self.reclaimed += reclaimed
+
+        if removed:
+            msg = "Removed {n} entries, {size} bytes reclaimed"
+            msg = msg.format(n=removed, size=reclaimed)
+            self._logger.info(msg)
+
+        return (removed, reclaimed)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.tick()
+
+    def attach(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self._stop.clear()
+
+        def schedule(*args):
+            if not self._stop.is_set():
+                self._handle = loop.call_later(self.interval, run)
+
+        def run():
+            fut = loop.run_in_executor(None, self.tick)
+            fut.add_done_callback(schedule)
+
+        schedule()
+
+    def stop(self):
+        self._stop.set()
+
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,184 @@
+# -*- encoding: utf-8 -*-
+
+import zlib
+
+try:
+    import brotli
+    _has_brotli = True
+except ImportError:
+    try:
+        import brotlicffi as brotli
+        _has_brotli = True
+    except ImportError:
+        _has_brotli = False
+
+try:
+    import zstandard
+    _has_zstd = True
+except ImportError:
+    _has_zstd = False
+
+
+class DecodeError(Exception):
+    pass
+
+
+def _check_eof(eof):
+    # Decompressors don't complain about streams ending before their end
+    # marker
+    if not eof:
+        raise DecodeError('Truncated compressed stream')
+
+
+class _ZlibDecoder:
+    def __init__(self, wbits):
+        self._wbits = wbits
+        self._obj = zlib.decompressobj(wbits)
+        self._empty = True
+
+    def decompress(self, chunk):
+        self._empty = self._empty and not chunk
+        ret = [self._obj.decompress(chunk)]
+
+        # Concatenated gzip members
+        while self._obj.eof and self._obj.unused_data:
+            unused = self._obj.unused_data
+            self._obj = zlib.decompressobj(self._wbits)
+            ret.append(self._obj.decompress(unused))
+
+        return b''.join(ret)
+
+    def flush(self):
+        ret = self._obj.flush()
+        if not self._empty:
+            _check_eof(self._obj.eof)
+
+        return ret
+
+
+class _DeflateDecoder:
+    # Some servers send raw deflate streams instead of zlib ones, format is
+    # detected on the first chunk
+    def __init__(self):
+        self._obj = None
+
+    def decompress(self, chunk):
+        if not chunk:
+            return b''
+
+        if self._obj is None:
+            self._obj = zlib.decompressobj(zlib.MAX_WBITS)
+            try:
+                return self._obj.decompress(chunk)
+            except zlib.error:
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        return self._obj.decompress(chunk)
+
+    def flush(self):
+        if self._obj is None:
+            return b''
+
+        ret = self._obj.flush()
+        _check_eof(self._obj.eof)
+
+        return ret
+
+
+class _BrotliDecoder:
+    def __init__(self):
+        self._obj = brotli.Decompressor()
+        self._empty = True
+
+    def decompress(self, chunk):
+        self._empty = self._empty and not chunk
+        return self._obj.process(chunk)
+
+    def flush(self):
+        if not self._empty:
+            _check_eof(self._obj.is_finished())
+
+        return b''
+
+
+class _ZstdDecoder:
+    def __init__(self):
+        self._obj = zstandard.ZstdDecompressor().decompressobj()
+        self._empty = True
+
+    def decompress(self, chunk):
+        self._empty = self._empty and not chunk
+        return self._obj.decompress(chunk)
+
+    def flush(self):
+        if not self._empty:
+            _check_eof(self._obj.eof)
+
+        return b''
+
+
+# Content-Encoding tokens mapped to decoder factories, in order of preference
+DECODERS = {}
+if _has_zstd:
+    DECODERS['zstd'] = _ZstdDecoder
+if _has_brotli:
+    DECODERS['br'] = _BrotliDecoder
+DECODERS['gzip'] = lambda: _ZlibDecoder(16 + zlib.MAX_WBITS)
+DECODERS['x-gzip'] = DECODERS['gzip']
+DECODERS['deflate'] = _DeflateDecoder
+
+_DECODE_ERRORS = (zlib.error,)
+if _has_brotli:
+    _DECODE_ERRORS += (brotli.error,)
+if _has_zstd:
+    _DECODE_ERRORS += (zstandard.ZstdError,)
+
+
+def accept_encoding():
+    """
+    Value for the Accept-Encoding header listing supported encodings
+    """
+    return ', '.join(x for x in DECODERS if not x.startswith('x-'))
+
+
+class StreamDecoder:
+    """
+    Incremental decoder for a Content-Encoding header value.
+
+    Multiple encodings ('gzip, br') are undone in reverse order. Unsupported
+    encodings raise DecodeError, so do corrupted streams and, from flush(),
+    streams that end before their end marker.
+    """
+    def __init__(self, content_encoding=None):
+        self.encodings = [
+            x.strip().lower()
+            for x in (content_encoding or '').split(',')
+            if x.strip() and x.strip().lower() != 'identity']
+
+        for encoding in self.encodings:
+            if encoding not in DECODERS:
+                msg = "Unsupported content encoding: '{encoding}'"
+                msg = msg.format(encoding=encoding)
+                raise DecodeError(msg)
+
+        self._decoders = [DECODERS[x]() for x in reversed(self.encodings)]
+
+    def decompress(self, chunk):
+        try:
+            for decoder in self._decoders:
+                chunk = decoder.decompress(chunk)
+        except _DECODE_ERRORS as e:
+            raise DecodeError(str(e)) from e
+
+        return chunk
+
+    def flush(self):
+        ret = b''
+        try:
+            for decoder in self._decoders:
+                ret = decoder.decompress(ret) if ret else b''
+                ret += decoder.flush()
+        except _DECODE_ERRORS as e:
+            raise DecodeError(str(e)) from e
+
+        return ret
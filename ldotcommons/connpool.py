@@ -0,0 +1,209 @@
+# -*- encoding: utf-8 -*-
+
+import collections
+import http.client
+import ssl
+import threading
+import time
+import urllib.parse
+
+from . import tracing
+
+
+# Methods that can be sent again if a reused connection fails, we can't
+# know whether the server got the request
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class PoolError(Exception):
+    pass
+
+
+class PooledResponse:
+    """
+    Wraps a http.client.HTTPResponse, its connection goes back to the pool
+    once the body has been fully read (or closed if it wasn't)
+    """
+    def __init__(self, pool, key, conn, resp):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.msg
+
+    def getheader(self, name, default=None):
+        return self._resp.getheader(name, default)
+
+    def read(self, amt=None):
+        buff = self._resp.read(amt)
+        if self._resp.isclosed():
+            self.release()
+
+        return buff
+
+    def release(self):
+        if self._conn is None:
+            return
+
+        if self._resp.isclosed() and not self._resp.will_close:
+            self._pool._put(self._key, self._conn)
+        else:
+            self._pool._discard(self._conn)
+
+        self._conn = None
+
+    def close(self):
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class ConnectionPool:
+    """
+    Keeps up to maxsize idle keep-alive connections per (scheme, host, port).
+
+    Connections idle for more than idle_timeout seconds are discarded
+    instead of reused. Requests with idempotent methods (IDEMPOTENT_METHODS)
+    on reused connections closed by the server are transparently retried
+    once on a fresh connection, errors sending other requests are raised.
+    """
+    def __init__(self, maxsize=10, idle_timeout=60, timeout=None,
+                 ssl_context=None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._ssl_context = ssl_context
+        self._idle = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    @property
+    def stats(self):
+        with self._lock:
+            ret = {k: self._stats[k]
+                   for k in ('requests', 'created', 'reused', 'discarded')}
+            ret['idle'] = sum(len(x) for x in self._idle.values())
+
+        return ret
+
+    def _new_connection(self, key):
+        (scheme, host, port) = key
+        if scheme == 'https':
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+
+            conn = http.client.HTTPSConnection(
+                host, port, timeout=self.timeout, context=self._ssl_context)
+
+        elif scheme == 'http':
+            conn = http.client.HTTPConnection(
+                host, port, timeout=self.timeout)
+
+        else:
+            msg = "Unsupported scheme: '{scheme}'"
+            msg = msg.format(scheme=scheme)
+            raise PoolError(msg)
+
+        with self._lock:
+            self._stats['created'] += 1
+
+        return conn
+
+    def _get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                (conn, last_used) = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    self._stats['reused'] += 1
+                    return conn
+
+                self._stats['discarded'] += 1
+                conn.close()
+
+        return None
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.monotonic()))
+                return
+
+            self._stats['discarded'] += 1
+
+        conn.close()
+
+    def _discard(self, conn):
+        with self._lock:
+            self._stats['discarded'] += 1
+
+        conn.close()
+
+    def urlopen(self, method, url, headers=None, body=None, tracer=None):
+        """
+        Sends a request and returns a PooledResponse. Redirects are not
+        followed.
+
+        If tracer (a tracing.Tracer) is given new connections are
+        established apart and reported as connect events
+        """
+        parsed = urllib.parse.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname,
+               parsed.port or (443 if parsed.scheme == 'https' else 80))
+
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        with self._lock:
+            self._stats['requests'] += 1
+
+        conn = self._get(key)
+        reused = conn is not None
+
+        while True:
+            if conn is None:
+                conn = self._new_connection(key)
+                connect = tracer is not None and tracer.hooks
+            else:
+                connect = False
+
+            try:
+                if connect:
+                    with tracer.span(url, tracing.CONNECT):
+                        conn.connect()
+
+                conn.request(method, path, body=body, headers=headers or {})
+                resp = conn.getresponse()
+
+            except (http.client.HTTPException, OSError):
+                self._discard(conn)
+                conn = None
+
+                # Server may have closed an idle connection, try again on a
+                # fresh one
+                if reused and method.upper() in IDEMPOTENT_METHODS:
+                    reused = False
+                    continue
+                raise
+
+            return PooledResponse(self, key, conn, resp)
+
+    def close(self):
+        with self._lock:
+            conns = [conn
+                     for idle in self._idle.values()
+                     for (conn, last_used) in idle]
+            self._idle.clear()
+
+        for conn in conns:
+            conn.close()
@@ -1,22 +1,43 @@
 import asyncio
-import functools
-import gzip
-import io
+import collections
+import concurrent.futures
+import http.client
+import os
 import socket
 import sys
+import threading
+import time
+import urllib.parse
+import zipfile
 
 from os import path
 from urllib import request, error as urllib_error
 
 import aiohttp
 
-from . import cache, exceptions, utils
+from . import (archive, cache, compression, connpool, exceptions, httpcache,
+               ratelimit, retry, tracing, utils)
 
 
 class FetchError(exceptions.Exception):
     pass
 
 
+@asyncio.coroutine
+def _close_session(session):
+    # ClientSession.close() is a coroutine only on newer aiohttp versions
+    ret = session.close()
+    if asyncio.iscoroutine(ret) or isinstance(ret, asyncio.Future):
+        yield from ret
+
+
+def _async_cache(c, loop=None):
+    if c is None or isinstance(c, cache.AsyncCache):
+        return c
+
+    return cache.AsyncCache(c, loop=loop)
+
+
 class Fetcher:
     def __new__(cls, fetcher_name, *args, **kwargs):
         clsname = fetcher_name.replace('-', ' ').replace('_', ' ').capitalize()
@@ -27,40 +48,600 @@ class Fetcher:
         return cls(*args, **kwargs)
 
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _chunked(buff, chunk_size):
+    buff = memoryview(buff)
+    for idx in range(0, len(buff), chunk_size):
+        yield bytes(buff[idx:idx + chunk_size])
+
+
+def _body(value):
+    # Cached bodies, other values (like httpcache entries in a shared
+    # backend) are misses
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+
+    return None
+
+
+def _rate_limiter(rate_limit=0, rate_burst=1, rate_limiter=None):
+    if rate_limiter is not None:
+        return rate_limiter
+
+    if rate_limit > 0:
+        return ratelimit.HostRateLimiter(rate=rate_limit, burst=rate_burst)
+
+    return None
+
+
+def _retry_policy(policy=None):
+    # policy can be a RetryPolicy or a number of attempts
+    if isinstance(policy, retry.RetryPolicy):
+        return policy
+
+    return retry.RetryPolicy(max_attempts=policy or 1)
+
+
+def _tracer(tracer=None):
+    # tracer can be a tracing.Tracer or a hook
+    if isinstance(tracer, tracing.Tracer):
+        return tracer
+
+    return tracing.Tracer(tracer) if tracer else tracing.Tracer()
+
+
+def _trace_configs(tracer):
+    # aiohttp session options tracing connections of tracer's requests
+    config = tracing.trace_config(tracer)
+    return {'trace_configs': [config]} if config else {}
+
+
+def _trace_ctx(trace_options, url):
+    # Request options telling traced sessions which url is being fetched
+    if 'trace_configs' not in trace_options:
+        return {}
+
+    return {'trace_request_ctx': url}
+
+
+def _method(opts):
+    if opts.get('method'):
+        return opts['method']
+
+    return 'POST' if opts.get('data') is not None else 'GET'
+
+
+def _log_retry(logger, retrying, delay):
+    if not logger:
+        return
+
+    attempt = retrying.attempts[-1]
+    msg = ("Retrying «{url}» in {delay:.2f}s after attempt {n}/{max} "
+           "({elapsed:.3f}s): {reason}")
+    msg = msg.format(
+        url=retrying.url, delay=delay, n=attempt.number,
+        max=retrying.policy.max_attempts, elapsed=attempt.elapsed,
+        reason=attempt.status or attempt.error)
+    logger.warning(msg)
+
+
+@asyncio.coroutine
+def _retry_async(retrying, logger, fn, *args, **kwargs):
+    # fn is a coroutine returning (response, value). Responses with a
+    # retryable status are retried until attempts are exhausted, then the
+    # last one is returned
+    while True:
+        retrying.begin()
+        try:
+            (resp, value) = yield from fn(*args, **kwargs)
+
+        except Exception as e:
+            delay = retrying.failed(error=e)
+            if delay is None:
+                e.attempts = retrying.attempts
+                raise
+
+        else:
+            if not retrying.policy.is_retryable(status=resp.status):
+                retrying.succeeded(status=resp.status)
+                return (resp, value)
+
+            delay = retrying.failed(
+                status=resp.status,
+                retry_after=resp.headers.get('Retry-After'))
+            if delay is None:
+                return (resp, value)
+
+            yield from resp.release()
+
+        _log_retry(logger, retrying, delay)
+        yield from asyncio.sleep(delay)
+
+
+def _cacheable(policy, status):
+    # Errors and retryable responses returned once attempts are exhausted
+    # must not be served from cache
+    return status < 400 and not policy.is_retryable(status=status)
+
+
+def _recorder(record=None):
+    # record can be an archive.ArchiveWriter or a path
+    if record is None or isinstance(record, archive.ArchiveWriter):
+        return record
+
+    return archive.ArchiveWriter(record)
+
+
+# Bodies are recorded decoded, these headers don't apply to them anymore
+_UNRECORDED_HEADERS = ('content-encoding', 'content-length',
+                       'transfer-encoding')
+
+
+def _record(recorder, url, method, status, headers, body):
+    headers = {k: v for (k, v) in headers.items()
+               if k.lower() not in _UNRECORDED_HEADERS}
+    recorder.write(url, status, headers, body, method=method)
+
+
+def _host(url):
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+class HostLimiter:
+    """
+    Global and per-host concurrency limits for coroutines, 0 means no limit.
+
+    Per-host slot is acquired before the global one so requests waiting for
+    a busy host don't take global slots from other hosts. The same goes for
+    rate_limiter (a ratelimit.HostRateLimiter) waits.
+    """
+    def __init__(self, max_requests=0, max_per_host=0, rate_limiter=None):
+        self.max_requests = max_requests
+        self.max_per_host = max_per_host
+        self.rate_limiter = rate_limiter
+        self._global = \
+            asyncio.Semaphore(max_requests) if max_requests > 0 else None
+        self._hosts = {}
+        self._users = collections.Counter()
+
+    @asyncio.coroutine
+    def acquire(self, url):
+        host = _host(url)
+        if self.max_per_host > 0:
+            if host not in self._hosts:
+                self._hosts[host] = asyncio.Semaphore(self.max_per_host)
+
+            self._users[host] += 1
+            try:
+                yield from self._hosts[host].acquire()
+            except:
+                self._release_host(host, acquired=False)
+                raise
+
+        try:
+            if self.rate_limiter:
+                delay = self.rate_limiter.reserve(url)
+                if delay > 0:
+                    yield from asyncio.sleep(delay)
+
+            if self._global:
+                yield from self._global.acquire()
+
+        except:
+            self._release_host(host)
+            raise
+
+    def release(self, url):
+        if self._global:
+            self._global.release()
+
+        self._release_host(_host(url))
+
+    def _release_host(self, host, acquired=True):
+        if self.max_per_host <= 0:
+            return
+
+        if acquired:
+            self._hosts[host].release()
+
+        # Forget semaphores nobody is using
+        self._users[host] -= 1
+        if not self._users[host]:
+            del self._users[host]
+            del self._hosts[host]
+
+
+class FetchManyIterator:
+    """
+    Async iterator over (url, result) tuples in completion order.
+
+    If return_exceptions is True failed fetches yield (url, exception),
+    otherwise the exception is raised and pending fetches are cancelled.
+    """
+    def __init__(self, fetch, urls, return_exceptions=False, **opts):
+        self._return_exceptions = return_exceptions
+        self._urls = {}
+        for url in urls:
+            task = asyncio.ensure_future(fetch(url, **opts))
+            self._urls[task] = url
+
+        self._pending = set(self._urls)
+        self._done = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self._done:
+            if not self._pending:
+                raise StopAsyncIteration()
+
+            (done, self._pending) = yield from asyncio.wait(
+                self._pending, return_when=asyncio.FIRST_COMPLETED)
+            self._done.extend(done)
+
+        task = self._done.popleft()
+        url = self._urls.pop(task)
+
+        try:
+            return (url, task.result())
+        except Exception as e:
+            if self._return_exceptions:
+                return (url, e)
+
+            self.cancel()
+            raise
+
+    def cancel(self):
+        for task in self._pending:
+            task.cancel()
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for (k, v) in value.items()))
+
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(x) for x in value)
+
+    return value
+
+
+def _request_key(url, **options):
+    key = _freeze(options)
+    try:
+        hash(key)
+    except TypeError:
+        # Unhashable options, fallback to its representation
+        key = repr(key)
+
+    return (url, key)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: while a call is in flight
+    later callers wait for its result instead of doing the work again.
+
+    The shared call is shielded, cancelling one caller doesn't cancel it for
+    the others.
+    """
+    def __init__(self):
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._inflight)
+
+    @asyncio.coroutine
+    def do(self, key, fn, *args, **kwargs):
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn(*args, **kwargs))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda f: self._inflight.pop(key, None))
+
+        return (yield from asyncio.shield(fut))
+
+
 class BaseFetcher(object):
     def fetch(self, url, **opts):
         raise NotImplementedError('Method not implemented')
 
+    def fetch_many(self, urls, return_exceptions=False, **opts):
+        """
+        Generator of (url, result) tuples for urls.
+
+        If return_exceptions is True failed fetches yield (url, exception)
+        instead of raising it.
+        """
+        for url in urls:
+            try:
+                yield (url, self.fetch(url, **opts))
+            except FetchError as e:
+                if not return_exceptions:
+                    raise
+                yield (url, e)
+
+
+class AsyncFetchManyMixin:
+    """
+    fetch_many() for fetchers with a coroutine fetch(). Concurrency is
+    limited by the fetcher itself
+    """
+    def fetch_many(self, urls, return_exceptions=False, **opts):
+        """
+        Returns an async iterator of (url, result) tuples in completion
+        order, see FetchManyIterator
+        """
+        return FetchManyIterator(
+            self.fetch, urls, return_exceptions=return_exceptions, **opts)
+
+    def fetch_many_sync(self, urls, return_exceptions=False, **opts):
+        """
+        Blocking version of fetch_many(), runs the event loop and yields
+        (url, result) tuples as they complete
+        """
+        loop = asyncio.get_event_loop()
+        it = self.fetch_many(
+            urls, return_exceptions=return_exceptions, **opts)
+
+        while True:
+            try:
+                yield loop.run_until_complete(it.__anext__())
+            except StopAsyncIteration:
+                return
+
 
 class MockFetcher(BaseFetcher):
-    def __init__(self, basedir=None, **opts):
+    """
+    Serves responses from fixtures named after the slugified url
+    (utils.slugify), stored in basedir or in a zip archive.
+
+    Fixtures are indexed once, on first use. With preload=True all of them
+    are loaded into memory at that point, otherwise they are read on each
+    fetch. Bodies are returned as bytes, like other fetchers.
+
+    tracer works like in UrllibFetcher, only total events are emitted.
+    """
+    def __init__(self, basedir=None, archive=None, preload=False,
+                 tracer=None, **opts):
+        self._tracer = _tracer(tracer)
         self._basedir = basedir
+        self._archive = archive
+        self._preload = preload
+        self._index = None
+        self._zipfile = None
+        self._lock = threading.Lock()
 
-    def fetch(self, url, **opts):
-        if not self._basedir:
+    @property
+    def index(self):
+        """
+        Maps fixture names to its preloaded bodies (None if not preloaded)
+        """
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._build_index()
+
+        return self._index
+
+    def _build_index(self):
+        if self._archive:
+            self._zipfile = zipfile.ZipFile(self._archive)
+            names = [x for x in self._zipfile.namelist()
+                     if not x.endswith('/')]
+
+        elif self._basedir:
+            try:
+                names = [x.name for x in os.scandir(self._basedir)
+                         if x.is_file()]
+            except OSError as e:
+                msg = "Unable to index '{path}': {reason}"
+                msg = msg.format(path=self._basedir, reason=e)
+                raise FetchError(msg) from e
+
+        else:
             raise FetchError("MockFetcher basedir is not configured")
 
-        url = utils.slugify(url)
+        return {name: self._read(name) if self._preload else None
+                for name in names}
+
+    def _read(self, name):
+        if self._zipfile:
+            return self._zipfile.read(name)
+
+        with open(path.join(self._basedir, name), 'rb') as fh:
+            return fh.read()
+
+    def fetch(self, url, **opts):
+        with self._tracer.span(url, tracing.TOTAL):
+            return self._fetch(url)
+
+    def _fetch(self, url):
+        name = utils.slugify(url)
 
-        e = None
-        f = path.join(self._basedir, url)
         try:
-            fh = open(f)
-            buff = fh.read()
-            fh.close()
+            buff = self.index[name]
+        except KeyError:
+            # Fixtures added to basedir after indexing
+            if self._archive or \
+               not path.isfile(path.join(self._basedir, name)):
+                msg = "No fixture for «{url}» ('{name}')"
+                msg = msg.format(url=url, name=name)
+                raise FetchError(msg)
+
+            buff = self._index[name] = None
 
+        if buff is not None:
             return buff
 
-        except IOError as e:
-            msg = "{msg} '{path}' (errno {code})"
-            msg = msg.format(msg=e.args[1], code=e.args[0], path=f)
+        try:
+            return self._read(name)
+        except (IOError, KeyError) as e:
+            msg = "Unable to read fixture '{name}': {reason}"
+            msg = msg.format(name=name, reason=e)
             raise FetchError(msg) from e
 
+    def close(self):
+        if self._zipfile:
+            self._zipfile.close()
+            self._zipfile = None
+        self._index = None
+
+
+class AsyncMockFetcher(AsyncFetchManyMixin):
+    """
+    Coroutine version of MockFetcher, a stand-in for AsyncFetcher and
+    AIOHttpFetcher in tests and load tests. Each fetch waits delay seconds
+    to mimic network latency.
+    """
+    def __init__(self, basedir=None, archive=None, preload=False, delay=0,
+                 tracer=None, **opts):
+        self._tracer = _tracer(tracer)
+        self._fetcher = MockFetcher(basedir=basedir, archive=archive,
+                                    preload=preload)
+        self.delay = delay
+
+    @property
+    def index(self):
+        return self._fetcher.index
+
+    @asyncio.coroutine
+    def fetch(self, url, **options):
+        with self._tracer.span(url, tracing.TOTAL):
+            if self.delay:
+                yield from asyncio.sleep(self.delay)
+
+            return self._fetcher._fetch(url)
+
+    @asyncio.coroutine
+    def fetch_full(self, url, **options):
+        buff = yield from self.fetch(url, **options)
+        return None, buff
+
+    @asyncio.coroutine
+    def close(self):
+        self._fetcher.close()
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, *exc_info):
+        yield from self.close()
+
+
+class ArchiveFetcher(BaseFetcher):
+    """
+    Replays responses recorded by fetchers into an archive (a path or an
+    archive.Archive). Error responses raise FetchError like UrllibFetcher
+    does.
+
+    tracer works like in UrllibFetcher, archive reads are cache_get events.
+    """
+    def __init__(self, archive_path=None, tracer=None, **opts):
+        self._tracer = _tracer(tracer)
+        if archive_path is None:
+            raise FetchError("ArchiveFetcher archive is not configured")
+
+        if isinstance(archive_path, archive.Archive):
+            self._archive = archive_path
+        else:
+            try:
+                self._archive = archive.Archive(archive_path)
+            except (IOError, OSError, archive.ArchiveError) as e:
+                msg = "Unable to open archive '{path}': {reason}"
+                msg = msg.format(path=archive_path, reason=e)
+                raise FetchError(msg) from e
+
+    @property
+    def archive(self):
+        return self._archive
+
+    def fetch(self, url, **opts):
+        with self._tracer.span(url, tracing.TOTAL):
+            return self._fetch(url, **opts)
+
+    def _fetch(self, url, **opts):
+        with self._tracer.span(url, tracing.CACHE_GET) as info:
+            record = self._archive.get(url, _method(opts))
+            info['hit'] = record is not None
+
+        if record is None:
+            msg = "Not in archive: «{url}»"
+            msg = msg.format(url=url)
+            raise FetchError(msg)
+
+        if record.status >= 400:
+            msg = "HTTP Error {code}: «{url}»"
+            msg = msg.format(code=record.status, url=url)
+            raise FetchError(msg, status=record.status,
+                             headers=record.headers)
+
+        return record.body
+
+    def close(self):
+        self._archive.close()
+
 
 class UrllibFetcher(BaseFetcher):
+    """
+    Fetcher based on urllib.
+
+    Bodies are cached in cache (any cache backend) if given, otherwise with
+    enable_cache in a DiskCache under the user cache directory keeping them
+    for cache_delta seconds.
+
+    With http_cache=True the cache follows HTTP semantics: responses are
+    stored with its headers, freshness comes from Cache-Control or Expires
+    (cache_delta is used if none of them is present), outdated entries are
+    revalidated with conditional requests and, for stale_while_revalidate
+    seconds after getting outdated, served while being refreshed in
+    background.
+
+    With pool_size > 0 requests go through a ConnectionPool keeping up to
+    pool_size keep-alive connections per host (idle for at most
+    pool_idle_timeout seconds) instead of urllib.request.urlopen. Pooled
+    requests follow redirects by themselves and don't use proxies.
+
+    fetch_stream() yields the body in chunks without keeping it in memory.
+
+    Requests (not cache hits) can be rate limited per host with rate_limit
+    requests per second and bursts of rate_burst requests, or with a
+    ratelimit.HostRateLimiter shared with other fetchers passed as
+    rate_limiter.
+
+    Failed requests are retried according to retry, a retry.RetryPolicy or
+    a number of attempts (no retries by default). FetchErrors carry the
+    list of retry.Attempts in its attempts attribute.
+
+    If accept_encoding is True requests ask for every encoding supported by
+    compression.StreamDecoder (unless an Accept-Encoding header is given)
+    and responses are decoded as they are read.
+
+    If record (a path or an archive.ArchiveWriter) is set, responses got
+    from the network by fetch() are appended to that archive, see
+    ArchiveFetcher. fetch_stream() responses are not recorded.
+
+    tracer (a tracing.Tracer or a hook for one) gets timing events for
+    each phase of fetches: cache lookups and stores, rate limit waits,
+    requests (connecting, for pooled connections, is reported apart) and
+    body transfers.
+    """
+    MAX_REDIRECTS = 10
+    _REDIRECT_CODES = (301, 302, 303, 307, 308)
+
     def __init__(self,
                  user_agent=None, headers={},
-                 enable_cache=False, cache_delta=-1,
+                 cache=None, enable_cache=False, cache_delta=-1,
+                 http_cache=False, stale_while_revalidate=0,
+                 pool_size=0, pool_idle_timeout=60,
+                 rate_limit=0, rate_burst=1, rate_limiter=None,
+                 retry=None, accept_encoding=True, record=None, tracer=None,
                  logger=None, **opts):
 
         # Configure logger
@@ -77,56 +658,566 @@ class UrllibFetcher(BaseFetcher):
         if user_agent:
             self._headers['User-Agent'] = user_agent
 
-        # Setup cache
-        if enable_cache:
-            cache_path = utils.user_path(
-                'cache', 'urllibfetcher', create=True, is_folder=True)
+        # Setup cache, caches created here are closed with the fetcher
+        if cache is not None:
+            self._cache = cache
+        else:
+            self._cache = self._default_cache(
+                enable_cache, cache_delta, http_cache)
+        self._cache_owned = self._cache is not cache
 
-            self._cache = cache.DiskCache(
-                basedir=cache_path, delta=cache_delta,
-                logger=self._logger.getChild('cache'))
+        if http_cache:
+            self._http_cache = httpcache.HTTPCache(
+                self._cache, default_ttl=cache_delta,
+                stale_while_revalidate=stale_while_revalidate)
+        else:
+            self._http_cache = None
+
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
 
-            msg = 'UrllibFetcher using cache {path}'
-            msg = msg.format(path=cache_path)
-            self._logger.debug(msg)
+        # Setup connection pool
+        if pool_size > 0:
+            self._pool = connpool.ConnectionPool(
+                maxsize=pool_size, idle_timeout=pool_idle_timeout)
         else:
-            self._cache = cache.NullCache()
+            self._pool = None
+
+        self._rate_limiter = _rate_limiter(
+            rate_limit, rate_burst, rate_limiter)
+        self._retry = _retry_policy(retry)
+        self._accept_encoding = accept_encoding
+        self._recorder = _recorder(record)
+        self._recorder_owned = isinstance(record, str)
+        self._tracer = _tracer(tracer)
+
+    def _default_cache(self, enable_cache, cache_delta, http_cache):
+        if not enable_cache:
+            return cache.NullCache()
+
+        # HTTP cache entries are not plain bodies, keep them apart. Not in a
+        # subdirectory, the plain cache would sweep and evict its files
+        cache_path = utils.user_path(
+            'cache', 'urllibfetcher-http' if http_cache else 'urllibfetcher',
+            create=True, is_folder=True)
+
+        msg = 'UrllibFetcher using cache {path}'
+        msg = msg.format(path=cache_path)
+        self._logger.debug(msg)
+
+        # HTTP cache handles freshness by itself
+        return cache.DiskCache(
+            basedir=cache_path, delta=-1 if http_cache else cache_delta,
+            logger=self._logger.getChild('cache'))
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def pool_stats(self):
+        return self._pool.stats if self._pool else None
+
+    def close(self):
+        if self._pool:
+            self._pool.close()
+
+        if self._cache_owned:
+            self._cache.close()
+
+        if self._recorder_owned:
+            self._recorder.close()
 
     def fetch(self, url, **opts):
-        buff = self._cache.get(url)
+        with self._tracer.span(url, tracing.TOTAL):
+            if self._http_cache:
+                return self._fetch_http_cached(url, **opts)
+
+            return self._fetch(url, **opts)
+
+    def _fetch(self, url, **opts):
+        with self._tracer.span(url, tracing.CACHE_GET) as info:
+            buff = _body(self._cache.get(url))
+            info['hit'] = bool(buff)
+
         if buff:
             self._logger.debug("found in cache: {}".format(url))
-            return buff
+            # Streamed entries are loaded as memoryviews
+            return bytes(buff)
+
+        (status, headers, buff) = self._request(url, **opts)
+
+        self._logger.debug("stored in cache: {}".format(url))
+        with self._tracer.span(url, tracing.CACHE_SET):
+            self._cache.set(url, buff)
 
+        return buff
+
+    def fetch_stream(self, url, chunk_size=STREAM_CHUNK_SIZE, **opts):
+        """
+        Generator of url's body chunks, decoded as they arrive.
+
+        Cached entries are streamed from the cache, fetched bodies are
+        written to it while being read and only stored if they are read
+        completely. With http_cache the cache is not used.
+        """
+        if not self._http_cache:
+            with self._tracer.span(url, tracing.CACHE_GET) as info:
+                buff = _body(self._cache.get(url))
+                info['hit'] = bool(buff)
+
+            if buff:
+                self._logger.debug("found in cache: {}".format(url))
+                yield from _chunked(buff, chunk_size)
+                return
+
+        resp = self._with_retry(url, _method(opts), self._open, url, **opts)
+        writer = None
+        try:
+            if resp.status == 304:
+                return
+
+            if not self._http_cache:
+                writer = self._cache.open_writer(url)
+
+            for chunk in self._iter_body(resp, chunk_size):
+                if writer:
+                    writer.write(chunk)
+                yield chunk
+
+            if writer:
+                self._logger.debug("stored in cache: {}".format(url))
+                writer.commit()
+                writer = None
+
+        finally:
+            if writer:
+                writer.abort()
+            resp.close()
+
+    def _with_retry(self, url, method, fn, *args, **kwargs):
+        retrying = self._retry.start(url, method)
+        while True:
+            retrying.begin()
+            try:
+                ret = fn(*args, **kwargs)
+
+            except FetchError as e:
+                delay = retrying.failed(
+                    status=getattr(e, 'status', None),
+                    error=e.__cause__,
+                    retry_after=getattr(e, 'headers', {}).get('Retry-After'))
+                if delay is None:
+                    e.attempts = retrying.attempts
+                    raise
+
+            else:
+                retrying.succeeded()
+                return ret
+
+            _log_retry(self._logger, retrying, delay)
+            time.sleep(delay)
+
+    def _request(self, url, extra_headers=None, **opts):
+        """
+        Returns (status, headers, body). 304 responses are returned, other
+        HTTP errors raise FetchError
+        """
+        return self._with_retry(url, _method(opts), self._request_once,
+                                url, extra_headers=extra_headers, **opts)
+
+    def _request_once(self, url, extra_headers=None, **opts):
+        resp = self._open(url, extra_headers=extra_headers, **opts)
+        with resp:
+            if resp.status == 304:
+                return (304, dict(resp.headers), b'')
+
+            with self._tracer.span(url, tracing.BODY):
+                buff = b''.join(self._iter_body(resp))
+
+        if self._recorder:
+            _record(self._recorder, url, _method(opts), resp.status,
+                    resp.headers, buff)
+
+        return (resp.status, dict(resp.headers), buff)
+
+    def _record_error(self, url, method, resp):
+        try:
+            buff = b''.join(self._iter_body(resp))
+        except FetchError:
+            buff = b''
+
+        _record(self._recorder, url, method, resp.status, resp.headers, buff)
+
+    def _open(self, url, extra_headers=None, **opts):
+        """
+        Returns the response for url. 304 responses are returned, other HTTP
+        errors raise FetchError
+        """
         headers = self._headers.copy()
-        if 'headers' in opts:
-            headers.update(opts['headers'])
+        headers.update(opts.pop('headers', {}))
+        headers.update(extra_headers or {})
 
         if 'user_agent' in opts:
-            headers['User-Agent'] = opts['user_agent']
+            headers['User-Agent'] = opts.pop('user_agent')
+
+        if self._accept_encoding and \
+           not any(k.lower() == 'accept-encoding' for k in headers):
+            headers['Accept-Encoding'] = compression.accept_encoding()
+
+        if self._rate_limiter:
+            with self._tracer.span(url, tracing.QUEUE):
+                self._rate_limiter.acquire(url)
 
         try:
-            req = request.Request(url, headers=headers, **opts)
-            resp = request.urlopen(req)
-            if resp.getheader('Content-Encoding') == 'gzip':
-                bi = io.BytesIO(resp.read())
-                gf = gzip.GzipFile(fileobj=bi, mode="rb")
-                buff = gf.read()
-            else:
-                buff = resp.read()
-        except (socket.error, urllib_error.HTTPError) as e:
-            raise FetchError("{message}".format(message=e))
+            with self._tracer.span(url, tracing.REQUEST) as info:
+                if self._pool:
+                    resp = self._pool_urlopen(url, headers, **opts)
+                else:
+                    req = request.Request(url, headers=headers, **opts)
+                    resp = request.urlopen(req)
+
+                info['status'] = resp.status
+
+        except urllib_error.HTTPError as e:
+            # HTTPError is a response too
+            if e.code == 304:
+                return e
+
+            with e:
+                if self._recorder:
+                    self._record_error(url, _method(opts), e)
+
+            raise FetchError("{message}".format(message=e),
+                             status=e.code, headers=e.headers)
+        except (socket.error, http.client.HTTPException,
+                connpool.PoolError) as e:
+            raise FetchError("{message}".format(message=e)) from e
+
+        # urlopen raises HTTPError by itself, pooled responses don't
+        if resp.status >= 400:
+            with resp:
+                if self._recorder:
+                    self._record_error(url, _method(opts), resp)
+                else:
+                    resp.read()
+
+            msg = "HTTP Error {code}: {reason}"
+            msg = msg.format(code=resp.status, reason=resp.reason)
+            raise FetchError(msg, status=resp.status, headers=resp.headers)
+
+        return resp
+
+    def _iter_body(self, resp, chunk_size=STREAM_CHUNK_SIZE):
+        try:
+            decoder = compression.StreamDecoder(
+                resp.headers.get('Content-Encoding'))
+
+            while True:
+                chunk = resp.read(chunk_size)
+                if not chunk:
+                    break
+
+                chunk = decoder.decompress(chunk)
+                if chunk:
+                    yield chunk
+
+            chunk = decoder.flush()
+            if chunk:
+                yield chunk
+
+        except (socket.error, http.client.HTTPException,
+                compression.DecodeError) as e:
+            raise FetchError("{message}".format(message=e)) from e
+
+    def _pool_urlopen(self, url, headers, data=None, method=None, **opts):
+        method = method or ('POST' if data is not None else 'GET')
+
+        for x in range(self.MAX_REDIRECTS + 1):
+            resp = self._pool.urlopen(method, url, headers=headers, body=data,
+                                      tracer=self._tracer)
+            location = resp.getheader('Location')
+            if resp.status not in self._REDIRECT_CODES or not location:
+                return resp
+
+            resp.read()
+            url = urllib.parse.urljoin(url, location)
+            if resp.status == 303 or \
+               (resp.status in (301, 302) and method == 'POST'):
+                (method, data) = ('GET', None)
+
+        msg = "Too many redirects: {url}"
+        msg = msg.format(url=url)
+        raise FetchError(msg)
+
+    def _fetch_http_cached(self, url, **opts):
+        with self._tracer.span(url, tracing.CACHE_GET) as info:
+            (entry, state) = self._http_cache.lookup(url)
+            info['hit'] = state in (httpcache.FRESH, httpcache.STALE)
+
+        if state == httpcache.FRESH:
+            self._logger.debug("found in cache: {}".format(url))
+            return entry['body']
+
+        if state == httpcache.STALE:
+            self._logger.debug("serving stale: {}".format(url))
+            self._revalidate_in_background(url, entry, **opts)
+            return entry['body']
+
+        return self._revalidate(url, entry, **opts)
+
+    def _revalidate(self, url, entry, **opts):
+        (status, headers, buff) = self._request(
+            url,
+            extra_headers=self._http_cache.conditional_headers(entry),
+            **opts)
+
+        if status == 304 and entry is not None:
+            self._logger.debug("not modified: {}".format(url))
+            with self._tracer.span(url, tracing.CACHE_SET):
+                return self._http_cache.refresh(url, entry, headers)['body']
 
         self._logger.debug("stored in cache: {}".format(url))
-        self._cache.set(url, buff)
+        with self._tracer.span(url, tracing.CACHE_SET):
+            self._http_cache.store(url, headers, buff)
+
         return buff
 
+    def _revalidate_in_background(self, url, entry, **opts):
+        with self._revalidating_lock:
+            if url in self._revalidating:
+                return
+            self._revalidating.add(url)
+
+        def revalidate():
+            try:
+                self._revalidate(url, entry, **opts)
+            except FetchError as e:
+                msg = "Unable to revalidate «{url}»: {reason}"
+                msg = msg.format(url=url, reason=str(e))
+                self._logger.warning(msg)
+            finally:
+                with self._revalidating_lock:
+                    self._revalidating.discard(url)
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+
+def _as_completed(futures):
+    try:
+        yield from concurrent.futures.as_completed(futures)
+    finally:
+        # Consumer gave up, don't fetch what's left
+        for fut in futures:
+            fut.cancel()
+
+
+def _results(futures, return_exceptions):
+    for fut in futures:
+        try:
+            yield (fut.url, fut.result())
+        except FetchError as e:
+            if not return_exceptions:
+                raise
+            yield (fut.url, e)
+
+
+class ThreadedUrllibFetcher(UrllibFetcher):
+    """
+    UrllibFetcher running fetches on a pool of workers threads.
+
+    All threads share the fetcher's connection pool (pool_size defaults to
+    workers), cache and rate limiter. submit() returns a future for one
+    fetch, map() futures for many urls in completion order (each one has
+    the url in its url attribute) and fetch_many() (url, result) tuples in
+    completion order. map() and fetch_many() start fetching when called,
+    closing the iterators they return cancels fetches not started yet.
+    """
+    def __init__(self, workers=8, **kwargs):
+        kwargs.setdefault('pool_size', workers)
+        super().__init__(**kwargs)
+        self.workers = workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+
+    def submit(self, url, **opts):
+        fut = self._executor.submit(self.fetch, url, **opts)
+        fut.url = url
+
+        return fut
+
+    def map(self, urls, **opts):
+        # Fetches start now, not when the result is first iterated
+        futures = [self.submit(url, **opts) for url in urls]
+        return _as_completed(futures)
+
+    def fetch_many(self, urls, return_exceptions=False, **opts):
+        return _results(self.map(urls, **opts), return_exceptions)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        super().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AIOHttpStream:
+    """
+    Async iterator over the body chunks of url. Bodies are decoded by
+    aiohttp as they arrive.
+
+    If cache (an AsyncCache) is given cached entries are streamed from it and
+    fetched bodies are written to it while being read, they are only stored
+    if they are read completely. Use it as an async context manager (or
+    call close()) to release the response if iteration is stopped early.
+    """
+    def __init__(self, session, url, cache=None,
+                 chunk_size=STREAM_CHUNK_SIZE, rate_limiter=None, retry=None,
+                 tracer=None, logger=None, loop=None, **options):
+        self.url = url
+        self.chunk_size = chunk_size
+        self._session = session
+        self._cache = cache
+        self._rate_limiter = rate_limiter
+        self._retry = _retry_policy(retry)
+        self._tracer = _tracer(tracer)
+        self._logger = logger
+        self._loop = loop or asyncio.get_event_loop()
+        self._options = options
+
+        self._started = False
+        self._cached = None
+        self._resp = None
+        self._writer = None
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, *exc_info):
+        yield from self.close()
+
+    @asyncio.coroutine
+    def _start(self):
+        if self._cache:
+            with self._tracer.span(self.url, tracing.CACHE_GET) as info:
+                buff = yield from self._cache.get(self.url)
+                info['hit'] = bool(buff)
+
+            if buff:
+                self._cached = _chunked(buff, self.chunk_size)
+                return
+
+        (self._resp, _) = yield from _retry_async(
+            self._retry.start(self.url), self._logger, self._open)
+
+        if self._cache and _cacheable(self._retry, self._resp.status):
+            self._writer = self._cache.open_writer(self.url)
+
+    @asyncio.coroutine
+    def _open(self):
+        if self._rate_limiter:
+            with self._tracer.span(self.url, tracing.QUEUE):
+                yield from asyncio.sleep(
+                    self._rate_limiter.reserve(self.url))
+
+        with self._tracer.span(self.url, tracing.REQUEST) as info:
+            resp = yield from self._session.get(self.url, **self._options)
+            info['status'] = resp.status
+
+        return (resp, None)
 
-class AIOHttpFetcher:
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self._started:
+            self._started = True
+            yield from self._start()
+
+        if self._cached is not None:
+            try:
+                return next(self._cached)
+            except StopIteration:
+                raise StopAsyncIteration()
+
+        if self._resp is None:
+            raise StopAsyncIteration()
+
+        try:
+            chunk = yield from self._resp.content.read(self.chunk_size)
+            if chunk and self._writer:
+                yield from self._loop.run_in_executor(
+                    None, self._writer.write, chunk)
+
+        except:
+            yield from self.close()
+            raise
+
+        if not chunk:
+            if self._writer:
+                (writer, self._writer) = (self._writer, None)
+                yield from self._loop.run_in_executor(None, writer.commit)
+
+            yield from self.close()
+            raise StopAsyncIteration()
+
+        return chunk
+
+    @asyncio.coroutine
+    def close(self):
+        if self._writer:
+            self._writer.abort()
+            self._writer = None
+
+        if self._resp is not None:
+            (resp, self._resp) = (self._resp, None)
+            yield from resp.release()
+
+
+class AIOHttpFetcher(AsyncFetchManyMixin):
+    """
+    Fetcher based on aiohttp.
+
+    All requests share one ClientSession (and its connection pool, DNS
+    cache and keep-alive connections). Its connector is configured with
+    limit (total connections), limit_per_host (0 means no limit) and
+    dns_ttl (seconds to cache DNS lookups). The session is created on first
+    use and must be released with close() or by using the fetcher as an
+    async context manager:
+
+        async with AIOHttpFetcher() as fetcher:
+            buff = await fetcher.fetch(url)
+
+    limit and limit_per_host also cap concurrency of fetch_many().
+
+    fetch_stream() returns an async iterator over body chunks, see
+    AIOHttpStream.
+
+    cache (a cache backend or an AsyncCache) and enable_cache work like in
+    UrllibFetcher, with the cache under its own user cache directory.
+
+    rate_limit, rate_burst and rate_limiter work like in UrllibFetcher. So
+    do retry (responses with a retryable status are returned, but not
+    cached, once attempts are exhausted), record and tracer. Error
+    responses are not cached either. If aiohttp supports it tracer also
+    gets events for DNS lookups, new connections and waits for a free
+    connection (see tracing.trace_config).
+
+    Concurrent fetches of the same url and options share a single request.
+    """
     def __init__(self,
                  user_agent=None, headers={},
-                 enable_cache=False, cache_delta=-1,
-                 logger=None, **opts):
+                 cache=None, enable_cache=False, cache_delta=-1,
+                 limit=100, limit_per_host=0, dns_ttl=10,
+                 rate_limit=0, rate_burst=1, rate_limiter=None,
+                 retry=None, record=None, tracer=None, logger=None, **opts):
         # Configure logger
         self._logger = logger or utils.NullSingleton()
 
@@ -141,61 +1232,202 @@ class AIOHttpFetcher:
         if user_agent:
             self._headers['User-Agent'] = user_agent
 
-        # Setup cache
-        if enable_cache:
-            cache_path = utils.user_path(
-                'cache', 'aiohttpfetcher', create=True, is_folder=True)
+        self._loop = asyncio.get_event_loop()
 
-            self._cache = cache.DiskCache(
-                basedir=cache_path, delta=cache_delta,
-                logger=self._logger.getChild('cache'))
+        # Setup session, it's created on first use
+        self._connector_options = {
+            'limit': limit,
+            'limit_per_host': limit_per_host,
+            'ttl_dns_cache': dns_ttl,
+        }
+        self._session = None
+        self._inflight = SingleFlight()
+        self._rate_limiter = _rate_limiter(
+            rate_limit, rate_burst, rate_limiter)
+        self._retry = _retry_policy(retry)
+        self._recorder = _recorder(record)
+        self._recorder_owned = isinstance(record, str)
+        self._tracer = _tracer(tracer)
+        self._trace_options = _trace_configs(self._tracer) if tracer else {}
 
-            msg = 'AIOHttpFetcher using cache {path}'
-            msg = msg.format(path=cache_path)
-            self._logger.debug(msg)
+        # Setup cache. Caches and AsyncCache wrappers created here are
+        # closed with the fetcher
+        if cache is not None:
+            self._cache = _async_cache(cache, loop=self._loop)
         else:
-            self._cache = cache.NullCache()
+            self._cache = self._default_cache(enable_cache, cache_delta)
+        self._cache_owned = self._cache is not cache
 
-        self._loop = asyncio.get_event_loop()
+    def _default_cache(self, enable_cache, cache_delta):
+        if not enable_cache:
+            return None
+
+        cache_path = utils.user_path(
+            'cache', 'aiohttpfetcher', create=True, is_folder=True)
+
+        msg = 'AIOHttpFetcher using cache {path}'
+        msg = msg.format(path=cache_path)
+        self._logger.debug(msg)
+
+        return cache.AsyncDiskCache(
+            basedir=cache_path, delta=cache_delta,
+            logger=self._logger.getChild('cache'),
+            loop=self._loop)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                loop=self._loop, **self._connector_options)
+            self._session = aiohttp.ClientSession(
+                connector=connector, headers=self._headers, loop=self._loop,
+                **self._trace_options)
+
+        return self._session
+
+    @asyncio.coroutine
+    def close(self):
+        if self._session is not None:
+            yield from _close_session(self._session)
+            self._session = None
+
+        if self._cache and self._cache_owned:
+            self._cache.close()
+
+        if self._recorder_owned:
+            self._recorder.close()
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, *exc_info):
+        yield from self.close()
 
     @asyncio.coroutine
     def fetch(self, url, **options):
-        buff = yield from self._loop.run_in_executor(
-            None,
-            functools.partial(self._cache.get, url)
-        )
-        if buff:
-            return buff
+        return (yield from self._inflight.do(
+            _request_key(url, **options), self._fetch, url, **options))
 
-        opts = {'headers': self._headers}
-        opts.update(opts)
+    @asyncio.coroutine
+    def _fetch(self, url, **options):
+        with self._tracer.span(url, tracing.TOTAL):
+            return (yield from self._fetch_traced(url, **options))
 
-        with aiohttp.ClientSession(**opts) as client:
-            resp = yield from client.get(url)
-            buff = yield from resp.content.read()
-            yield from resp.release()
+    @asyncio.coroutine
+    def _fetch_traced(self, url, **options):
+        if self._cache:
+            with self._tracer.span(url, tracing.CACHE_GET) as info:
+                buff = yield from self._cache.get(url)
+                info['hit'] = bool(buff)
+
+            if buff:
+                # Streamed entries are loaded as memoryviews
+                return bytes(buff)
+
+        (resp, buff) = yield from _retry_async(
+            self._retry.start(url), self._logger, self._request, url,
+            **options)
+
+        if self._recorder:
+            yield from self._loop.run_in_executor(
+                None, _record, self._recorder, url, 'GET', resp.status,
+                resp.headers, buff)
 
-        yield from self._loop.run_in_executor(
-            None,
-            functools.partial(self._cache.set, url, buff)
-        )
+        if self._cache and _cacheable(self._retry, resp.status):
+            with self._tracer.span(url, tracing.CACHE_SET):
+                yield from self._cache.set(url, buff)
 
         return buff
 
+    @asyncio.coroutine
+    def _request(self, url, **options):
+        if self._rate_limiter:
+            with self._tracer.span(url, tracing.QUEUE):
+                yield from asyncio.sleep(self._rate_limiter.reserve(url))
+
+        with self._tracer.span(url, tracing.REQUEST) as info:
+            resp = yield from self.session.get(
+                url, **_trace_ctx(self._trace_options, url), **options)
+            info['status'] = resp.status
+
+        try:
+            with self._tracer.span(url, tracing.BODY):
+                buff = yield from resp.content.read()
+        finally:
+            yield from resp.release()
 
-class AsyncFetcher:
+        return (resp, buff)
+
+    def fetch_stream(self, url, chunk_size=STREAM_CHUNK_SIZE, **options):
+        return AIOHttpStream(self.session, url, cache=self._cache,
+                             chunk_size=chunk_size,
+                             rate_limiter=self._rate_limiter,
+                             retry=self._retry, tracer=self._tracer,
+                             logger=self._logger, loop=self._loop,
+                             **_trace_ctx(self._trace_options, url),
+                             **options)
+
+
+class AsyncFetcher(AsyncFetchManyMixin):
+    """
+    Concurrent calls to fetch_full() (or fetch()) with the same url and
+    options are coalesced into one request and one cache write.
+
+    rate_limit, rate_burst and rate_limiter work like in UrllibFetcher,
+    requests waiting for its host's rate don't hold global slots. retry
+    works like in AIOHttpFetcher, timeouts apply to each attempt and
+    retries don't hold slots while waiting. record and tracer work like in
+    AIOHttpFetcher, waits for slots are queue events.
+    """
     def __init__(self, logger=None, cache=None, max_requests=1,
-                 timeout=-1,
-                 **session_options):
+                 max_requests_per_host=0, timeout=-1,
+                 rate_limit=0, rate_burst=1, rate_limiter=None, retry=None,
+                 record=None, tracer=None, **session_options):
         self._logger = logger
-        self._cache = cache
-        self._semaphore = asyncio.Semaphore(max_requests)
+        self._cache = _async_cache(cache)
+        # AsyncCache wrappers created here are closed with the fetcher
+        self._cache_owned = self._cache is not cache
+        self._limiter = HostLimiter(
+            max_requests, max_requests_per_host,
+            rate_limiter=_rate_limiter(rate_limit, rate_burst, rate_limiter))
+        self._inflight = SingleFlight()
+        self._retry = _retry_policy(retry)
+        self._recorder = _recorder(record)
+        self._recorder_owned = isinstance(record, str)
+        self._tracer = _tracer(tracer)
+        self._trace_options = _trace_configs(self._tracer) if tracer else {}
+        session_options.update(self._trace_options)
         self._session = aiohttp.ClientSession(**session_options)
 
     @property
     def session(self):
         return self._session
 
+    @asyncio.coroutine
+    def close(self):
+        if not self._session.closed:
+            yield from _close_session(self._session)
+
+        if self._cache and self._cache_owned:
+            self._cache.close()
+
+        if self._recorder_owned:
+            self._recorder.close()
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, *exc_info):
+        yield from self.close()
+
     @asyncio.coroutine
     def fetch(self, url, **request_options):
         resp, content = yield from self.fetch_full(url,
@@ -205,31 +1437,80 @@ class AsyncFetcher:
 
     @asyncio.coroutine
     def fetch_full(self, url, skip_cache=False, timeout=0, **request_options):
+        key = _request_key(url, skip_cache=skip_cache, timeout=timeout,
+                           **request_options)
+
+        return (yield from self._inflight.do(
+            key, self._fetch_full, url,
+            skip_cache=skip_cache, timeout=timeout, **request_options))
+
+    @asyncio.coroutine
+    def _fetch_full(self, url, skip_cache=False, timeout=0,
+                    **request_options):
+        with self._tracer.span(url, tracing.TOTAL):
+            return (yield from self._fetch_full_traced(
+                url, skip_cache=skip_cache, timeout=timeout,
+                **request_options))
+
+    @asyncio.coroutine
+    def _fetch_full_traced(self, url, skip_cache=False, timeout=0,
+                           **request_options):
         use_cache = not skip_cache and self._cache
 
         if use_cache:
-            buff = self._cache.get(url)
+            with self._tracer.span(url, tracing.CACHE_GET) as info:
+                buff = yield from self._cache.get(url)
+                info['hit'] = bool(buff)
+
             if buff:
                 return None, buff
 
-        with (yield from self._semaphore):
+        resp, buff = yield from _retry_async(
+            self._retry.start(url), self._logger, self._request, url,
+            timeout, **request_options)
+
+        if self._recorder:
+            yield from asyncio.get_event_loop().run_in_executor(
+                None, _record, self._recorder, url, 'GET', resp.status,
+                resp.headers, buff)
+
+        if use_cache and _cacheable(self._retry, resp.status):
+            with self._tracer.span(url, tracing.CACHE_SET):
+                yield from self._cache.set(url, buff)
+
+        return resp, buff
+
+    @asyncio.coroutine
+    def _request(self, url, timeout, **request_options):
+        with self._tracer.span(url, tracing.QUEUE):
+            yield from self._limiter.acquire(url)
+
+        try:
             with AsyncTimeout(timeout):
                 if self._logger:
                     msg = "Fetching «{url}»"
                     msg = msg.format(url=url)
                     self._logger.info(msg)
 
-                resp = yield from self.session.get(url, **request_options)
-                buff = yield from resp.content.read()
-                yield from resp.release()
+                with self._tracer.span(url, tracing.REQUEST) as info:
+                    resp = yield from self.session.get(
+                        url, **_trace_ctx(self._trace_options, url),
+                        **request_options)
+                    info['status'] = resp.status
 
-        if use_cache:
-            self._cache.set(url, buff)
+                with self._tracer.span(url, tracing.BODY):
+                    buff = yield from resp.content.read()
+
+                yield from resp.release()
+        finally:
+            self._limiter.release(url)
 
         return resp, buff
 
     def __del__(self):
-        self.session.close()
+        # Prefer close() or async with, this is only a fallback
+        if not self.session.closed:
+            self.session.close()
 
 
 class AsyncTimeout(aiohttp.Timeout):
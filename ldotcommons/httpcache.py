@@ -0,0 +1,167 @@
+# -*- encoding: utf-8 -*-
+
+import email.utils
+import time
+
+
+FRESH = 'fresh'
+STALE = 'stale'
+EXPIRED = 'expired'
+MISS = 'miss'
+
+
+def parse_cache_control(value):
+    """
+    Parses a Cache-Control header into a dict, directives without value are
+    mapped to True
+    """
+    ret = {}
+    for directive in (value or '').split(','):
+        directive = directive.strip()
+        if not directive:
+            continue
+
+        if '=' in directive:
+            (k, v) = directive.split('=', 1)
+            v = v.strip().strip('"')
+            try:
+                v = int(v)
+            except ValueError:
+                pass
+            ret[k.strip().lower()] = v
+        else:
+            ret[directive.lower()] = True
+
+    return ret
+
+
+def _seconds(value):
+    # Cache-Control delta-seconds value or None if it isn't valid
+    if isinstance(value, int) and not isinstance(value, bool) and \
+       value >= 0:
+        return value
+
+    return None
+
+
+def _is_entry(entry):
+    # Backends may be shared with plain caches storing raw bodies
+    return isinstance(entry, dict) and \
+        all(k in entry for k in ('body', 'headers', 'stored', 'ttl', 'swr'))
+
+
+def _parse_http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class HTTPCache:
+    """
+    HTTP semantics on top of a cache backend.
+
+    Entries keep body and response headers. Freshness is taken from
+    Cache-Control (max-age, no-cache, no-store, stale-while-revalidate) or
+    Expires, falling back to default_ttl (negative means entries never get
+    outdated). Outdated entries are not removed: they are used to build
+    conditional requests (If-None-Match, If-Modified-Since) and, during
+    stale_while_revalidate seconds, can be served while being refreshed.
+
+    Backend must not expire entries by itself. Values in it that are not
+    HTTPCache entries (like bodies stored by plain caches) are misses.
+    """
+    def __init__(self, backend, default_ttl=-1, stale_while_revalidate=0):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.stale_while_revalidate = stale_while_revalidate
+
+    def lookup(self, url):
+        """
+        Returns (entry, state) for url, state is one of FRESH, STALE
+        (outdated but can be served while revalidating), EXPIRED (must be
+        revalidated) or MISS
+        """
+        entry = self.backend.get(url)
+        if not _is_entry(entry):
+            return (None, MISS)
+
+        if entry['ttl'] < 0:
+            return (entry, FRESH)
+
+        age = time.time() - entry['stored']
+        if age <= entry['ttl']:
+            return (entry, FRESH)
+
+        if age <= entry['ttl'] + entry['swr']:
+            return (entry, STALE)
+
+        return (entry, EXPIRED)
+
+    def conditional_headers(self, entry):
+        ret = {}
+        if entry is None:
+            return ret
+
+        if 'etag' in entry['headers']:
+            ret['If-None-Match'] = entry['headers']['etag']
+        if 'last-modified' in entry['headers']:
+            ret['If-Modified-Since'] = entry['headers']['last-modified']
+
+        return ret
+
+    def store(self, url, headers, body):
+        """
+        Stores a 200 response, returns the new entry or None if response
+        can't be stored
+        """
+        headers = {k.lower(): v for (k, v) in headers.items()}
+        cc = parse_cache_control(headers.get('cache-control'))
+        if 'no-store' in cc:
+            return None
+
+        entry = {
+            'body': body,
+            'headers': headers,
+            'stored': time.time(),
+            'ttl': self._ttl(headers, cc),
+            'swr': self._swr(cc)
+        }
+        self.backend.set(url, entry)
+
+        return entry
+
+    def refresh(self, url, entry, headers):
+        """
+        Updates entry after a 304 Not Modified response
+        """
+        entry['headers'].update({k.lower(): v for (k, v) in headers.items()})
+        cc = parse_cache_control(entry['headers'].get('cache-control'))
+        entry['stored'] = time.time()
+        entry['ttl'] = self._ttl(entry['headers'], cc)
+        entry['swr'] = self._swr(cc)
+        self.backend.set(url, entry)
+
+        return entry
+
+    def _ttl(self, headers, cc):
+        if 'no-cache' in cc:
+            return 0
+
+        max_age = _seconds(cc.get('max-age'))
+        if max_age is not None:
+            return max_age
+
+        if 'expires' in headers:
+            expires = _parse_http_date(headers['expires'])
+            date = _parse_http_date(headers.get('date')) or time.time()
+            if expires is None:
+                return 0
+
+            return max(0, expires - date)
+
+        return self.default_ttl
+
+    def _swr(self, cc):
+        swr = _seconds(cc.get('stale-while-revalidate'))
+        return self.stale_while_revalidate if swr is None else swr
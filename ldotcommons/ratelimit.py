@@ -0,0 +1,120 @@
+# -*- encoding: utf-8 -*-
+
+import threading
+import time
+import urllib.parse
+
+
+class TokenBucket:
+    """
+    Token bucket allowing rate requests per second with bursts of up to burst
+    requests.
+
+    reserve() never blocks: it takes a token (going into debt if there are
+    none left) and returns how long the caller must wait before using it, so
+    it can be used from threads (acquire()) and coroutines alike:
+
+        yield from asyncio.sleep(bucket.reserve())
+    """
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        if rate <= 0:
+            msg = "Invalid rate: {rate}"
+            msg = msg.format(rate=rate)
+            raise ValueError(msg)
+
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._clock = clock
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    @property
+    def idle(self):
+        """
+        True if the bucket is full, that is, it has no effect right now
+        """
+        with self._lock:
+            self._refill()
+            return self._tokens >= self.burst
+
+    def reserve(self, n=1):
+        """
+        Takes n tokens and returns the delay (in seconds) before they can be
+        used
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0
+
+            return -self._tokens / self.rate
+
+    def acquire(self, n=1):
+        """
+        Blocking version of reserve()
+        """
+        delay = self.reserve(n)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class HostRateLimiter:
+    """
+    One TokenBucket per host, hosts don't wait for each other.
+
+    rate and burst apply to every host, hosts maps host names (as in the URL,
+    with port if any) to (rate, burst) tuples overriding them. A rate of 0
+    means no limit.
+    """
+    # Full buckets are forgotten once there are more than this many
+    MAX_IDLE_BUCKETS = 1024
+
+    def __init__(self, rate=0, burst=1, hosts=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.hosts = dict(hosts or {})
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url):
+        """
+        Returns the TokenBucket for url's host or None if it's not limited
+        """
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        (rate, burst) = self.hosts.get(host, (self.rate, self.burst))
+        if rate <= 0:
+            return None
+
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_IDLE_BUCKETS:
+                    self._purge()
+
+                bucket = TokenBucket(rate, burst, clock=self._clock)
+                self._buckets[host] = bucket
+
+        return bucket
+
+    def _purge(self):
+        for (host, bucket) in list(self._buckets.items()):
+            if bucket.idle:
+                del self._buckets[host]
+
+    def reserve(self, url):
+        bucket = self.bucket(url)
+        return bucket.reserve() if bucket else 0
+
+    def acquire(self, url):
+        bucket = self.bucket(url)
+        if bucket:
+            bucket.acquire()
@@ -0,0 +1,175 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import collections
+import email.utils
+import http.client
+import random
+import time
+
+try:
+    import aiohttp
+    _has_aiohttp = True
+except ImportError:
+    _has_aiohttp = False
+
+
+TRANSIENT_EXCEPTIONS = (OSError, http.client.HTTPException,
+                        asyncio.TimeoutError)
+if _has_aiohttp:
+    TRANSIENT_EXCEPTIONS += (aiohttp.ClientError,)
+
+
+# number starts at 1, elapsed is in seconds, status and error are None if
+# not available and delay is the time waited before the next attempt (None
+# for the last one)
+Attempt = collections.namedtuple(
+    'Attempt', ['number', 'elapsed', 'status', 'error', 'delay'])
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parses a Retry-After header (seconds or HTTP date) into seconds from now,
+    returns None if value can't be parsed
+    """
+    if value is None:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    try:
+        when = email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+    return max(0, when - (time.time() if now is None else now))
+
+
+class RetryPolicy:
+    """
+    Decides if and when failed requests are retried.
+
+    Requests are attempted up to max_attempts times. Responses with a status
+    in statuses and errors that are instances of exceptions are retried,
+    only for methods in methods (idempotent ones by default).
+
+    Delays grow exponentially from backoff up to backoff_max seconds and are
+    randomly reduced by up to jitter (0 to 1) of its value so clients
+    don't retry in lockstep. If retry_after is True a Retry-After header
+    replaces the computed delay, requests asking to wait more than
+    retry_after_max seconds are not retried.
+
+    If hook is set it's called as hook(url, attempt) for every attempt, see
+    Attempt.
+    """
+    STATUSES = (408, 429, 500, 502, 503, 504)
+    METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE')
+
+    def __init__(self, max_attempts=3, statuses=STATUSES,
+                 exceptions=TRANSIENT_EXCEPTIONS, methods=METHODS,
+                 backoff=0.5, backoff_max=30, jitter=0.5,
+                 retry_after=True, retry_after_max=120, hook=None):
+        self.max_attempts = max(1, max_attempts)
+        self.statuses = tuple(statuses)
+        self.exceptions = tuple(exceptions)
+        self.methods = tuple(x.upper() for x in methods)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.retry_after = retry_after
+        self.retry_after_max = retry_after_max
+        self.hook = hook
+
+    def is_retryable(self, status=None, error=None):
+        if status is not None:
+            return status in self.statuses
+
+        return error is not None and isinstance(error, self.exceptions)
+
+    def backoff_delay(self, number):
+        """
+        Delay after the number-th attempt
+        """
+        delay = min(self.backoff_max, self.backoff * 2 ** (number - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def delay(self, number, status=None, error=None, retry_after=None,
+              method='GET'):
+        """
+        Returns the delay before retrying after the number-th attempt failed
+        with status or error, or None if it must not be retried
+        """
+        if number >= self.max_attempts or \
+           (method or 'GET').upper() not in self.methods or \
+           not self.is_retryable(status, error):
+            return None
+
+        if self.retry_after:
+            retry_after = parse_retry_after(retry_after)
+            if retry_after is not None:
+                if retry_after > self.retry_after_max:
+                    return None
+
+                return retry_after
+
+        return self.backoff_delay(number)
+
+    def start(self, url, method='GET'):
+        return Retrying(self, url, method)
+
+
+class Retrying:
+    """
+    Attempts of one request under a RetryPolicy:
+
+        retrying = policy.start(url)
+        while True:
+            retrying.begin()
+            try:
+                ret = request(url)
+            except Exception as e:
+                delay = retrying.failed(error=e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            else:
+                retrying.succeeded()
+                return ret
+    """
+    def __init__(self, policy, url, method='GET'):
+        self.policy = policy
+        self.url = url
+        self.method = method
+        self.attempts = []
+        self._t0 = None
+
+    @property
+    def number(self):
+        return len(self.attempts) + 1
+
+    def begin(self):
+        self._t0 = time.monotonic()
+
+    def _record(self, status, error, delay):
+        attempt = Attempt(self.number, time.monotonic() - self._t0, status,
+                          error, delay)
+        self.attempts.append(attempt)
+        if self.policy.hook:
+            self.policy.hook(self.url, attempt)
+
+    def succeeded(self, status=None):
+        self._record(status, None, None)
+
+    def failed(self, status=None, error=None, retry_after=None):
+        """
+        Records a failed attempt, returns the delay before the next one or
+        None if request must not be retried
+        """
+        delay = self.policy.delay(self.number, status=status, error=error,
+                                  retry_after=retry_after,
+                                  method=self.method)
+        self._record(status, error, delay)
+
+        return delay
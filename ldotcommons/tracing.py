@@ -0,0 +1,224 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import collections
+import contextlib
+import threading
+import time
+import urllib.parse
+
+try:
+    import aiohttp
+    _has_trace_config = hasattr(aiohttp, 'TraceConfig')
+except ImportError:
+    _has_trace_config = False
+
+
+# Phases of a fetch. REQUEST goes from sending the request to getting the
+# response headers (server time) and includes CONNECT, which includes DNS
+# (and the TLS handshake). QUEUE is time spent waiting for concurrency
+# slots or rate limits. TOTAL covers the whole fetch, cache and retries
+# included
+CACHE_GET = 'cache_get'
+CACHE_SET = 'cache_set'
+QUEUE = 'queue'
+DNS = 'dns'
+CONNECT = 'connect'
+REQUEST = 'request'
+BODY = 'body'
+TOTAL = 'total'
+
+PHASES = (CACHE_GET, CACHE_SET, QUEUE, DNS, CONNECT, REQUEST, BODY, TOTAL)
+
+
+# start and elapsed are in seconds (start from Tracer.clock), info holds
+# phase details like hit (cache lookups), status or error
+Event = collections.namedtuple(
+    'Event', ['url', 'phase', 'start', 'elapsed', 'info'])
+
+
+class Tracer:
+    """
+    Sends timing Events to hooks, callables called as hook(event) from the
+    thread (or loop) running the fetch.
+
+        report = LatencyReport()
+        fetcher = UrllibFetcher(tracer=Tracer(print, report))
+
+    Without hooks nothing is measured.
+    """
+    def __init__(self, *hooks, clock=time.monotonic):
+        self.hooks = list(hooks)
+        self.clock = clock
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def emit(self, url, phase, start, elapsed, **info):
+        event = Event(url, phase, start, elapsed, info)
+        for hook in self.hooks:
+            hook(event)
+
+    @contextlib.contextmanager
+    def span(self, url, phase, **info):
+        """
+        Context manager emitting an event for phase when exiting. It yields
+        the info dict so details can be added to the event, exceptions are
+        added as error
+        """
+        if not self.hooks:
+            yield info
+            return
+
+        start = self.clock()
+        try:
+            yield info
+        except Exception as e:
+            info['error'] = e
+            raise
+        finally:
+            self.emit(url, phase, start, self.clock() - start, **info)
+
+
+def trace_config(tracer):
+    """
+    Returns an aiohttp.TraceConfig emitting DNS, CONNECT and QUEUE (waits
+    for a free connection) events to tracer, or None if aiohttp doesn't
+    support tracing. aiohttp doesn't tell the TLS handshake apart from
+    connecting.
+
+    Events are emitted for the url passed as trace_request_ctx to requests,
+    or the requested one as aiohttp normalizes it.
+    """
+    if not _has_trace_config:
+        return None
+
+    @asyncio.coroutine
+    def on_request_start(session, ctx, params):
+        ctx.url = ctx.trace_request_ctx or str(params.url)
+
+    def _begin(name):
+        @asyncio.coroutine
+        def handler(session, ctx, params):
+            setattr(ctx, name, tracer.clock())
+
+        return handler
+
+    def _end(name, phase):
+        @asyncio.coroutine
+        def handler(session, ctx, params):
+            start = getattr(ctx, name, None)
+            if start is not None:
+                tracer.emit(ctx.url, phase, start, tracer.clock() - start)
+
+        return handler
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_connection_queued_start.append(_begin('queued_start'))
+    config.on_connection_queued_end.append(_end('queued_start', QUEUE))
+    config.on_connection_create_start.append(_begin('connect_start'))
+    config.on_connection_create_end.append(_end('connect_start', CONNECT))
+    config.on_dns_resolvehost_start.append(_begin('dns_start'))
+    config.on_dns_resolvehost_end.append(_end('dns_start', DNS))
+
+    return config
+
+
+Stats = collections.namedtuple(
+    'Stats', ['count', 'errors', 'mean', 'p50', 'p90', 'p99', 'max'])
+
+
+class _Samples:
+    def __init__(self, max_samples):
+        self.count = 0
+        self.errors = 0
+        self.total = 0
+        self.max = 0
+        self.recent = collections.deque(maxlen=max_samples)
+
+    def add(self, elapsed, error):
+        self.count += 1
+        self.errors += int(error)
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.recent.append(elapsed)
+
+    def stats(self):
+        recent = sorted(self.recent)
+
+        def percentile(p):
+            if not recent:
+                return 0
+
+            return recent[int(round(p / 100 * (len(recent) - 1)))]
+
+        return Stats(self.count, self.errors,
+                     self.total / self.count if self.count else 0,
+                     percentile(50), percentile(90), percentile(99),
+                     self.max)
+
+
+class LatencyReport:
+    """
+    Tracer hook aggregating event times per host and phase.
+
+    Counts, errors, means and maximums cover every event, percentiles are
+    computed over the last max_samples events of each host and phase.
+    """
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        key = (urllib.parse.urlsplit(event.url).netloc.lower(), event.phase)
+        with self._lock:
+            if key not in self._samples:
+                self._samples[key] = _Samples(self.max_samples)
+
+            self._samples[key].add(event.elapsed, 'error' in event.info)
+
+    def hosts(self):
+        with self._lock:
+            return sorted(set(host for (host, phase) in self._samples))
+
+    def stats(self):
+        """
+        Returns {host: {phase: Stats}}
+        """
+        ret = collections.defaultdict(dict)
+        with self._lock:
+            for ((host, phase), samples) in self._samples.items():
+                ret[host][phase] = samples.stats()
+
+        return dict(ret)
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+    def format(self):
+        """
+        Returns the report as a text table, times in milliseconds
+        """
+        def order(phase):
+            return (PHASES.index(phase) if phase in PHASES else len(PHASES),
+                    phase)
+
+        fmt = '{:<24} {:<10} {:>7} {:>6} {:>9} {:>9} {:>9} {:>9}\n'
+        ret = fmt.format('host', 'phase', 'count', 'errors', 'mean', 'p50',
+                         'p99', 'max')
+
+        for (host, phases) in sorted(self.stats().items()):
+            for phase in sorted(phases, key=order):
+                s = phases[phase]
+                ret += fmt.format(
+                    host, phase, s.count, s.errors,
+                    *['{:.2f}'.format(x * 1000)
+                      for x in (s.mean, s.p50, s.p99, s.max)])
+
+        return ret
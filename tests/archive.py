@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ldotcommons import archive
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.path = os.path.join(self.basedir, 'crawl.arc')
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_roundtrip(self):
+        with archive.ArchiveWriter(self.path) as w:
+            w.write('http://a/', 200, {'X-Foo': 'bar'}, b'a' * 10000,
+                    timestamp=1)
+            w.write('http://b/', 404, {}, b'', method='HEAD')
+
+        with archive.Archive(self.path) as a:
+            self.assertEqual(len(a), 2)
+            self.assertTrue('http://a/' in a)
+            self.assertEqual(
+                a.get('http://a/'),
+                archive.Record('http://a/', 'GET', 200, {'X-Foo': 'bar'},
+                               b'a' * 10000, 1))
+            self.assertEqual(a.get('http://b/', 'HEAD').status, 404)
+            self.assertEqual(a.get('http://c/'), None)
+
+        # Large compressible bodies are compressed
+        self.assertTrue(os.path.getsize(self.path) < 1000)
+
+    def test_last_record_wins(self):
+        with archive.ArchiveWriter(self.path) as w:
+            w.write('http://a/', 200, {}, b'old')
+            w.write('http://b/', 200, {}, b'b')
+            w.write('http://a/', 200, {}, b'new')
+
+        with archive.Archive(self.path) as a:
+            self.assertEqual(a.get('http://a/').body, b'new')
+            self.assertEqual([x.body for x in a], [b'old', b'b', b'new'])
+
+    def test_index(self):
+        with archive.ArchiveWriter(self.path) as w:
+            w.write('http://a/', 200, {}, b'a')
+
+        archive.Archive(self.path).close()
+        self.assertTrue(os.path.exists(self.path + archive.INDEX_SUFFIX))
+
+        # Index is updated with appended records
+        with archive.ArchiveWriter(self.path) as w:
+            w.write('http://b/', 200, {}, b'b')
+
+        with archive.Archive(self.path) as a:
+            self.assertEqual(sorted(a.urls()), ['http://a/', 'http://b/'])
+
+    def test_refresh(self):
+        w = archive.ArchiveWriter(self.path)
+        a = archive.Archive(self.path)
+        self.assertEqual(len(a), 0)
+
+        w.write('http://a/', 200, {}, b'a')
+        a.refresh()
+        self.assertEqual(a.get('http://a/').body, b'a')
+
+        a.close()
+        w.close()
+
+    def test_truncated(self):
+        with archive.ArchiveWriter(self.path) as w:
+            w.write('http://a/', 200, {}, b'a')
+            w.write('http://b/', 200, {}, b'b' * 100)
+
+        with open(self.path, 'r+b') as fh:
+            fh.truncate(os.path.getsize(self.path) - 10)
+
+        with archive.Archive(self.path, save_index=False) as a:
+            self.assertEqual(a.urls(), ['http://a/'])
+
+        # Writers drop the broken record before appending
+        with archive.ArchiveWriter(self.path) as w:
+            w.write('http://c/', 200, {}, b'c')
+
+        with archive.Archive(self.path) as a:
+            self.assertEqual(sorted(a.urls()), ['http://a/', 'http://c/'])
+
+    def test_replaced_archive(self):
+        with archive.ArchiveWriter(self.path) as w:
+            for x in range(10):
+                w.write('http://old/{}'.format(x), 200, {}, b'x' * 100)
+        archive.Archive(self.path).close()
+        with open(self.path + archive.INDEX_SUFFIX, 'rb') as fh:
+            index = fh.read()
+
+        os.unlink(self.path)
+        with archive.ArchiveWriter(self.path) as w:
+            w.write('http://new/', 200, {}, b'new' * 100)
+
+        # Writers remove indexes of previous archives
+        self.assertFalse(
+            os.path.exists(self.path + archive.INDEX_SUFFIX))
+
+        # Stale indexes are not trusted, even by writers
+        with open(self.path + archive.INDEX_SUFFIX, 'wb') as fh:
+            fh.write(index)
+        size = os.path.getsize(self.path)
+        archive.ArchiveWriter(self.path).close()
+        self.assertEqual(os.path.getsize(self.path), size)
+
+        with archive.Archive(self.path) as a:
+            self.assertEqual(a.urls(), ['http://new/'])
+            self.assertEqual(a.get('http://new/').body, b'new' * 100)
+
+    def test_methods(self):
+        with archive.ArchiveWriter(self.path) as w:
+            w.write('http://a/', 200, {}, b'get')
+            w.write('http://a/', 201, {}, b'post', method='post')
+
+        with archive.Archive(self.path) as a:
+            self.assertEqual(a.get('http://a/').body, b'get')
+            self.assertEqual(a.get('http://a/', 'POST').body, b'post')
+            self.assertEqual(sorted(a.keys()),
+                             [('GET', 'http://a/'), ('POST', 'http://a/')])
+            self.assertEqual(a.urls(), ['http://a/'])
+
+    def test_not_an_archive(self):
+        with open(self.path, 'wb') as fh:
+            fh.write(b'foo bar')
+
+        with self.assertRaises(archive.ArchiveError):
+            archive.Archive(self.path)
+
+        with self.assertRaises(archive.ArchiveError):
+            archive.ArchiveWriter(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,953 @@
+#!/usr/bin/python3
+
+import unittest
+
+import asyncio
+import mmap
+import multiprocessing
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from ldotcommons import cache
+
+
+def _concurrent_worker(basedir, n, errors):
+    c = cache.DiskCache(basedir=basedir, workers=1)
+    for x in range(50):
+        try:
+            c.set('key', [n] * 100000)
+            value = c.get('key')
+        except Exception:
+            errors.put(n)
+            continue
+
+        if value is None or len(value) != 100000 or len(set(value)) != 1:
+            errors.put(n)
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_get_set(self):
+        c = cache.DiskCache(basedir=self.basedir)
+        c.set('foo', {'bar': 1})
+        self.assertEqual(c.get('foo'), {'bar': 1})
+        self.assertEqual(c.get('nothing'), None)
+
+    def test_raw(self):
+        c = cache.DiskCache(basedir=self.basedir, raw=True)
+        c.set('foo', b'bar' * 1000)
+        c.set('empty', b'')
+
+        value = c.get('foo')
+        self.assertTrue(isinstance(value, memoryview))
+        self.assertEqual(value, b'bar' * 1000)
+        self.assertEqual(c.get('empty'), b'')
+
+        # Overwrite doesn't break previous views
+        c.set('foo', b'x')
+        self.assertEqual(value[:3], b'bar')
+        self.assertEqual(c.get('foo'), b'x')
+
+        with self.assertRaises(TypeError):
+            c.set('foo', 'str')
+
+    def test_mmap_threshold(self):
+        c = cache.DiskCache(basedir=self.basedir, raw=True)
+        c.MMAP_THRESHOLD = 1000
+        c.set('small', b'x' * 100)
+        c.set('big', b'x' * 1000)
+
+        # Only big values are mapped
+        self.assertTrue(isinstance(c.get('big').obj, mmap.mmap))
+        self.assertFalse(isinstance(c.get('small').obj, mmap.mmap))
+
+        c = cache.DiskCache(basedir=self.basedir)
+        c.MMAP_THRESHOLD = 1000
+        c.set('big', b'x' * 1000)
+        self.assertEqual(c.get('big'), b'x' * 1000)
+
+    def test_serializers(self):
+        for serializer in cache.SERIALIZERS:
+            if serializer == 'raw':
+                continue
+
+            c = cache.DiskCache(basedir=self.basedir, serializer=serializer)
+            c.set('foo', {'bar': [1, 2, 3]})
+            self.assertEqual(c.get('foo'), {'bar': [1, 2, 3]})
+
+    @unittest.skipUnless('pickle5' in cache.SERIALIZERS,
+                         'pickle protocol 5 not available')
+    def test_pickle5_buffers(self):
+        c = cache.DiskCache(basedir=self.basedir, serializer='pickle5')
+        c.set('foo', [bytearray(b'x' * 10000), 'y'])
+        self.assertEqual(c.get('foo'), [bytearray(b'x' * 10000), 'y'])
+
+    def test_compression(self):
+        for compression in cache.COMPRESSORS:
+            c = cache.DiskCache(basedir=self.basedir,
+                                compression=compression,
+                                compress_threshold=100)
+            c.set('big', 'x' * 10000)
+            c.set('small', 'x')
+
+            self.assertTrue(
+                os.path.getsize(c._on_disk_path('big')) < 1000)
+            self.assertEqual(c.get('big'), 'x' * 10000)
+            self.assertEqual(c.get('small'), 'x')
+
+    def test_compressed_raw(self):
+        c = cache.DiskCache(basedir=self.basedir, raw=True,
+                            compression='zlib', compress_threshold=0)
+        c.set('foo', b'x' * 10000)
+        self.assertEqual(c.get('foo'), b'x' * 10000)
+
+    def test_mixed_settings(self):
+        c = cache.DiskCache(basedir=self.basedir, serializer='json',
+                            compression='lzma', compress_threshold=0)
+        c.set('foo', [1, 2])
+
+        c = cache.DiskCache(basedir=self.basedir)
+        self.assertEqual(c.get('foo'), [1, 2])
+
+    def test_headerless_entries(self):
+        c = cache.DiskCache(basedir=self.basedir)
+        os.makedirs(os.path.dirname(c._on_disk_path('foo')))
+        with open(c._on_disk_path('foo'), 'wb') as fh:
+            fh.write(pickle.dumps({'old': True}))
+
+        self.assertEqual(c.get('foo'), {'old': True})
+
+    def test_invalid_serializer(self):
+        with self.assertRaises(ValueError):
+            cache.DiskCache(basedir=self.basedir, serializer='foo')
+
+        with self.assertRaises(ValueError):
+            cache.DiskCache(basedir=self.basedir, compression='foo')
+
+    def test_corrupted_entry(self):
+        c = cache.DiskCache(basedir=self.basedir)
+        c.set('foo', 1)
+        with open(c._on_disk_path('foo'), 'wb') as fh:
+            fh.write(b'garbage')
+
+        self.assertEqual(c.get('foo'), None)
+        self.assertFalse(os.path.exists(c._on_disk_path('foo')))
+
+    def test_fsync(self):
+        for policy in cache.DiskCache.FSYNC_POLICIES:
+            c = cache.DiskCache(basedir=self.basedir, fsync=policy)
+            c.set('foo', policy)
+            self.assertEqual(c.get('foo'), policy)
+
+        with self.assertRaises(ValueError):
+            cache.DiskCache(basedir=self.basedir, fsync='foo')
+
+    def test_no_leftovers(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=10)
+        c.set('foo', 1)
+        c.sync()
+
+        for (dirpath, dirnames, filenames) in os.walk(self.basedir):
+            for filename in filenames:
+                self.assertFalse(
+                    filename.startswith(cache.DiskCache.TMP_PREFIX))
+
+    def test_concurrent_processes(self):
+        errors = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=_concurrent_worker, args=(self.basedir, n, errors))
+            for n in range(4)]
+
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+        self.assertTrue(errors.empty())
+        self.assertTrue(
+            cache.DiskCache(basedir=self.basedir).get('key') is not None)
+
+    def test_max_entries(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=10)
+        for x in range(25):
+            c.set(str(x), x)
+
+        self.assertTrue(len(c._index) <= 10)
+        self.assertEqual(c.get('24'), 24)
+        self.assertEqual(c.get('0'), None)
+
+    def test_max_bytes(self):
+        c = cache.DiskCache(basedir=self.basedir, max_bytes=1000)
+        for x in range(20):
+            c.set(str(x), b'x' * 100)
+
+        self.assertTrue(c._index_bytes <= 1000)
+        self.assertEqual(c._index_bytes,
+                         sum(x[0] for x in c._index.values()))
+
+    def test_lru(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=3,
+                            eviction='lru')
+        c.set('a', 1)
+        c.set('b', 2)
+        c.set('c', 3)
+        c.get('a')
+        c.set('d', 4)
+
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('b'), None)
+
+    def test_lfu(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=3,
+                            eviction='lfu')
+        c.set('a', 1)
+        c.set('b', 2)
+        c.set('c', 3)
+        for x in range(3):
+            c.get('a')
+            c.get('c')
+        c.get('b')
+        c.set('d', 4)
+
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('b'), None)
+
+    def test_invalid_eviction(self):
+        with self.assertRaises(ValueError):
+            cache.DiskCache(basedir=self.basedir, max_entries=1,
+                            eviction='foo')
+
+    def test_persistent_index(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=10)
+        c.set('a', 1)
+        c.sync()
+        del c
+
+        self.assertTrue(os.path.exists(
+            os.path.join(self.basedir, cache.DiskCache.INDEX_FILENAME)))
+
+        c = cache.DiskCache(basedir=self.basedir, max_entries=10)
+        self.assertEqual(list(c._index.keys()), [cache.hashfunc('a')])
+
+    def test_index_journal(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=100)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.sync()
+        snapshot = os.path.join(self.basedir, cache.DiskCache.INDEX_FILENAME)
+        mtime = os.stat(snapshot).st_mtime_ns
+
+        # Changes go to the journal, the snapshot is not rewritten
+        c._unlink(c._on_disk_path('a'))
+        c.set('c', 3)
+        c.sync()
+        self.assertEqual(os.stat(snapshot).st_mtime_ns, mtime)
+
+        # A change set cut short by a crash is ignored
+        journal = os.path.join(self.basedir,
+                               cache.DiskCache.INDEX_JOURNAL_FILENAME)
+        with open(journal, 'ab') as fh:
+            fh.write(b'\x80\x04garbage')
+
+        c = cache.DiskCache(basedir=self.basedir, max_entries=100)
+        self.assertEqual(
+            sorted(c._index.keys()),
+            sorted([cache.hashfunc('b'), cache.hashfunc('c')]))
+
+    def test_index_hits(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=100)
+        c.set('a', 1)
+        c.sync()
+
+        # Hits don't count towards INDEX_SYNC_INTERVAL
+        for x in range(cache.DiskCache.INDEX_SYNC_INTERVAL * 2):
+            c.get('a')
+        self.assertEqual(list(c._index_pending), [cache.hashfunc('a')])
+
+        c.INDEX_SYNC_SECONDS = 0
+        c.get('a')
+        self.assertEqual(c._index_pending, {})
+        self.assertEqual(
+            cache.DiskCache(basedir=self.basedir,
+                            max_entries=100)._index[cache.hashfunc('a')][2],
+            201)
+
+    def test_index_compaction(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=100)
+        c.INDEX_JOURNAL_MIN_BYTES = 0
+        for x in range(10):
+            c.set(str(x), x)
+            c.sync()
+
+            # Snapshot is rewritten once the journal outgrows it
+            self.assertTrue(
+                c._index_journal_bytes <= c._index_snapshot_bytes)
+
+        self.assertEqual(
+            len(cache.DiskCache(basedir=self.basedir,
+                                max_entries=100)._index), 10)
+
+    def test_close(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=100)
+        c.set('a', 1)
+        c.close()
+
+        c = cache.DiskCache(basedir=self.basedir, max_entries=100)
+        self.assertEqual(list(c._index), [cache.hashfunc('a')])
+
+        # Caches alive at interpreter exit don't write anything
+        code = ('from ldotcommons import cache\n'
+                'c = cache.DiskCache(basedir={!r}, max_entries=100)\n'
+                'c.set("b", 2)\n').format(self.basedir)
+        proc = subprocess.run([sys.executable, '-c', code],
+                              stderr=subprocess.PIPE)
+        self.assertEqual(proc.stderr, b'')
+        self.assertFalse(
+            [x for x in os.listdir(self.basedir)
+             if x.startswith(cache.DiskCache.TMP_PREFIX)])
+
+    def test_index_rebuild(self):
+        c = cache.DiskCache(basedir=self.basedir)
+        c.set('a', 1)
+        c.set('b', 2)
+
+        c = cache.DiskCache(basedir=self.basedir, max_entries=10)
+        self.assertEqual(
+            sorted(c._index.keys()),
+            sorted([cache.hashfunc('a'), cache.hashfunc('b')]))
+
+
+class TestMemoryCache(unittest.TestCase):
+    def test_get_set(self):
+        c = cache.MemoryCache()
+        c.set('foo', 1)
+        self.assertEqual(c.get('foo'), 1)
+        self.assertEqual(c.get('bar'), None)
+
+    def test_max_entries(self):
+        c = cache.MemoryCache(max_entries=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('b'), None)
+
+    def test_delta(self):
+        c = cache.MemoryCache(delta=0)
+        c.set('a', 1)
+        c._data[cache.hashfunc('a')] = (0, 1)
+        self.assertEqual(c.get('a'), None)
+
+
+class TestWriter(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def tmp_files(self):
+        return [f
+                for (dirpath, dirnames, filenames) in os.walk(self.basedir)
+                for f in filenames
+                if f.startswith(cache.DiskCache.TMP_PREFIX)]
+
+    def test_disk_commit(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=10)
+        with c.open_writer('foo') as w:
+            for x in range(10):
+                w.write(b'bar' * 100)
+
+        self.assertEqual(c.get('foo'), b'bar' * 1000)
+        self.assertEqual(self.tmp_files(), [])
+        self.assertEqual(
+            c._index[cache.hashfunc('foo')][0],
+            os.stat(c._on_disk_path('foo')).st_size)
+
+    def test_disk_abort(self):
+        c = cache.DiskCache(basedir=self.basedir)
+        c.set('foo', b'old')
+
+        with self.assertRaises(ValueError):
+            with c.open_writer('foo') as w:
+                w.write(b'new')
+                raise ValueError()
+
+        self.assertEqual(c.get('foo'), b'old')
+        self.assertEqual(self.tmp_files(), [])
+
+    def test_memory(self):
+        c = cache.MemoryCache()
+        w = c.open_writer('foo')
+        w.write(b'foo')
+        w.write(memoryview(b'bar'))
+        self.assertEqual(c.get('foo'), None)
+        w.commit()
+        self.assertEqual(c.get('foo'), b'foobar')
+
+    def test_null(self):
+        c = cache.NullCache()
+        with c.open_writer('foo') as w:
+            w.write(b'foo')
+        self.assertEqual(c.get('foo'), None)
+
+
+class TestTieredCache(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_tiers(self):
+        disk = cache.DiskCache(basedir=self.basedir)
+        disk.set('a', 1)
+
+        c = cache.TieredCache(disk, memory_entries=10)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('b'), None)
+
+        self.assertEqual(c.counters['memory'], {'hits': 1, 'misses': 2})
+        self.assertEqual(c.counters['backend'], {'hits': 1, 'misses': 1})
+
+    def test_set(self):
+        disk = cache.DiskCache(basedir=self.basedir)
+        c = cache.TieredCache(disk)
+        c.set('a', 1)
+
+        self.assertEqual(disk.get('a'), 1)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.counters['memory']['hits'], 1)
+
+    def test_promoted_expiration(self):
+        backends = [
+            cache.DiskCache(basedir=self.basedir, delta=10),
+            cache.SqliteCache(delta=10),
+            cache.LogCache(delta=10),
+        ]
+
+        now = time.time()
+        for backend in backends:
+            # Entries stored 8 seconds ago
+            with mock.patch('time.time', return_value=now - 8):
+                backend.set('a', 1)
+                backend.set('b', 2)
+
+            if isinstance(backend, cache.DiskCache):
+                for key in ('a', 'b'):
+                    os.utime(backend._on_disk_path(key), (now - 8, now - 8))
+
+            entry = backend.get_entry('a')
+            self.assertEqual(entry[0], 1)
+            self.assertAlmostEqual(entry[1], now - 8, delta=1)
+
+            c = cache.TieredCache(backend)
+            self.assertEqual(c.get('a'), 1)
+            self.assertEqual(c.get_many(['b']), {'b': 2})
+
+            # Memory copies expire along with backend ones
+            with mock.patch('time.time', return_value=now + 3):
+                self.assertEqual(backend.get('a'), None)
+                self.assertEqual(c.get('a'), None)
+                self.assertEqual(c.get('b'), None)
+
+
+class TestSqliteCache(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.path = os.path.join(self.basedir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_get_set(self):
+        c = cache.SqliteCache(self.path)
+        c.set('foo', {'bar': 1})
+        c.set('foo', {'bar': 2})
+        self.assertEqual(c.get('foo'), {'bar': 2})
+        self.assertEqual(c.get('nothing'), None)
+        c.close()
+
+        c = cache.SqliteCache(self.path)
+        self.assertEqual(c.get('foo'), {'bar': 2})
+
+    def test_delta(self):
+        c = cache.SqliteCache(self.path, delta=10)
+        c.set('a', 1)
+        c.set('b', 2)
+        c._conn.execute('UPDATE cache SET mtime = 0 WHERE key = ?',
+                        (cache.hashfunc('a'),))
+
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(c.get('b'), 2)
+
+    def test_expire(self):
+        c = cache.SqliteCache(self.path, delta=10)
+        c.set('a', 1)
+        c.set('b', 2)
+        c._conn.execute('UPDATE cache SET mtime = 0')
+        c.set('c', 3)
+
+        self.assertEqual(c.expire(), 2)
+        self.assertEqual(c.get('c'), 3)
+
+    def test_tmp(self):
+        c = cache.SqliteCache()
+        path = c.path
+        c.set('a', 1)
+        c.close()
+        self.assertFalse(os.path.exists(path))
+
+
+class TestLogCache(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_get_set(self):
+        c = cache.LogCache(basedir=self.basedir)
+        c.set('foo', {'bar': 1})
+        c.set('foo', {'bar': 2})
+        self.assertEqual(c.get('foo'), {'bar': 2})
+        self.assertEqual(c.get('nothing'), None)
+
+    def test_segments(self):
+        c = cache.LogCache(basedir=self.basedir, segment_size=100)
+        for x in range(10):
+            c.set(str(x), b'x' * 50)
+
+        self.assertTrue(len(c._segments()) > 1)
+        for x in range(10):
+            self.assertEqual(c.get(str(x)), b'x' * 50)
+
+    def test_checkpoint_and_replay(self):
+        c = cache.LogCache(basedir=self.basedir)
+        c.set('a', 1)
+        c.checkpoint()
+        c.set('b', 2)
+        c.set('a', 3)
+        c._active_fh.close()
+        c._active_fh = None
+        c._lock_fh.close()
+        c._lock_fh = None
+
+        # Without close, b and a=3 are only in the log
+        c = cache.LogCache(basedir=self.basedir)
+        self.assertEqual(c.get('a'), 3)
+        self.assertEqual(c.get('b'), 2)
+
+    def test_truncated_record(self):
+        c = cache.LogCache(basedir=self.basedir)
+        c.set('a', 1)
+        c.close()
+
+        with open(c._segment_path(0), 'ab') as fh:
+            fh.write(b'garbage')
+
+        c = cache.LogCache(basedir=self.basedir)
+        self.assertEqual(c.get('a'), 1)
+        c.set('b', 2)
+        c.close()
+
+        c = cache.LogCache(basedir=self.basedir)
+        self.assertEqual(c.get('b'), 2)
+
+    def test_compact(self):
+        c = cache.LogCache(basedir=self.basedir, delta=10)
+        c.set('a', 1)
+        c.set('a', 2)
+        c.set('b', 3)
+        c.set('c', 4)
+        c._index[cache.hashfunc('c')] = \
+            c._index[cache.hashfunc('c')][:3] + (0,)
+        c.compact()
+
+        self.assertEqual(c._segments(), [c._active])
+        self.assertEqual(c.get('a'), 2)
+        self.assertEqual(c.get('b'), 3)
+        self.assertEqual(c.get('c'), None)
+        c.close()
+
+        c = cache.LogCache(basedir=self.basedir, delta=10)
+        self.assertEqual(c.get('a'), 2)
+        self.assertEqual(c.get('c'), None)
+
+    def test_compact_ratio(self):
+        c = cache.LogCache(basedir=self.basedir, segment_size=100)
+        for x in range(4):
+            c.set(str(x), b'x' * 100)
+        c.set('0', b'y' * 100)
+
+        # Only the segment with the overwritten value is rewritten
+        (first, second) = c._segments()[:2]
+        self.assertEqual(c.compact(0.5), 1)
+        self.assertNotIn(first, c._segments())
+        self.assertIn(second, c._segments())
+        self.assertEqual(c.compact(0.5), 0)
+
+        self.assertEqual(c.get('0'), b'y' * 100)
+        self.assertEqual(c.get('1'), b'x' * 100)
+        c.close()
+
+        c = cache.LogCache(basedir=self.basedir, segment_size=100)
+        self.assertEqual(c.get('0'), b'y' * 100)
+        self.assertEqual(c.get('1'), b'x' * 100)
+
+    def test_locked(self):
+        c = cache.LogCache(basedir=self.basedir)
+        with self.assertRaises(IOError):
+            cache.LogCache(basedir=self.basedir)
+
+        c.close()
+        cache.LogCache(basedir=self.basedir).close()
+
+    def test_tmp(self):
+        c = cache.LogCache()
+        basedir = c.basedir
+        c.set('a', 1)
+        c.close()
+        self.assertFalse(os.path.exists(basedir))
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def check_backend(self, c):
+        data = {str(x): x for x in range(50)}
+        c.set_many(data)
+
+        self.assertEqual(c.get('7'), 7)
+        self.assertEqual(c.get_many(list(data) + ['missing']), data)
+        self.assertEqual(c.get_many([]), {})
+
+    def test_null(self):
+        c = cache.NullCache()
+        c.set_many({'a': 1})
+        self.assertEqual(c.get_many(['a']), {})
+
+    def test_memory(self):
+        self.check_backend(cache.MemoryCache())
+
+    def test_disk(self):
+        self.check_backend(cache.DiskCache(basedir=self.basedir))
+
+    def test_disk_without_workers(self):
+        self.check_backend(cache.DiskCache(basedir=self.basedir, workers=1))
+
+    def test_disk_with_budget(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=10)
+        c.set_many({str(x): x for x in range(50)})
+        self.assertTrue(len(c._index) <= 10)
+
+    def test_sqlite(self):
+        self.check_backend(
+            cache.SqliteCache(os.path.join(self.basedir, 'cache.sqlite')))
+
+    def test_sqlite_large_batch(self):
+        c = cache.SqliteCache(os.path.join(self.basedir, 'cache.sqlite'))
+        data = {str(x): x for x in range(2000)}
+        c.set_many(data)
+        self.assertEqual(c.get_many(data), data)
+
+    def test_log(self):
+        self.check_backend(cache.LogCache(basedir=self.basedir))
+
+    def test_tiered(self):
+        c = cache.TieredCache(cache.DiskCache(basedir=self.basedir))
+        self.check_backend(c)
+        self.assertEqual(c.counters['backend']['misses'], 1)
+
+
+class TestAsyncCache(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.basedir)
+
+    def test_get_set(self):
+        c = cache.AsyncDiskCache(basedir=self.basedir, loop=self.loop)
+        self.loop.run_until_complete(c.set('a', 1))
+        self.loop.run_until_complete(c.set_many({'b': 2, 'c': 3}))
+
+        self.assertEqual(self.loop.run_until_complete(c.get('a')), 1)
+        self.assertEqual(self.loop.run_until_complete(c.get('x')), None)
+        self.assertEqual(
+            self.loop.run_until_complete(c.get_many(['a', 'b', 'x'])),
+            {'a': 1, 'b': 2})
+        c.close()
+
+    def test_inflight_dedup(self):
+        class CountingCache(cache.MemoryCache):
+            reads = 0
+
+            def get(self, key):
+                CountingCache.reads += 1
+                return super().get(key)
+
+        backend = CountingCache()
+        backend.set('a', 1)
+
+        c = cache.AsyncCache(backend, loop=self.loop)
+        res = self.loop.run_until_complete(
+            asyncio.gather(*[c.get('a') for x in range(10)]))
+
+        self.assertEqual(res, [1] * 10)
+        self.assertEqual(CountingCache.reads, 1)
+        self.assertEqual(c._inflight, {})
+        c.close()
+
+    def test_inflight_after_set(self):
+        events = [threading.Event(), threading.Event()]
+        for event in events:
+            self.addCleanup(event.set)
+
+        class SlowCache(cache.MemoryCache):
+            def __init__(self):
+                super().__init__()
+                self.reads = 0
+
+            def get(self, key):
+                events[self.reads].wait()
+                return super().get(key)
+
+        backend = SlowCache()
+        c = cache.AsyncCache(backend, loop=self.loop)
+
+        first = c.get('a')
+        time.sleep(0.05)
+        backend.reads = 1
+        self.loop.run_until_complete(c.set('a', 2))
+        second = c.get('a')
+
+        # Finishing the old read keeps the new one shared
+        events[0].set()
+        self.loop.run_until_complete(first)
+        self.assertIn('a', c._inflight)
+
+        events[1].set()
+        self.assertEqual(self.loop.run_until_complete(second), 2)
+        c.close()
+
+
+class TestSweep(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def outdate(self, c, key):
+        os.utime(c._on_disk_path(key), (0, 0))
+
+    def test_disk(self):
+        c = cache.DiskCache(basedir=self.basedir, delta=10)
+        for x in range(20):
+            c.set(str(x), x)
+        for x in range(10):
+            self.outdate(c, str(x))
+
+        size = sum(os.path.getsize(c._on_disk_path(str(x)))
+                   for x in range(10))
+
+        self.assertEqual(c.sweep(), (10, size))
+        self.assertEqual(c.sweep_cursor, None)
+        self.assertEqual(c.get_many([str(x) for x in range(20)]),
+                         {str(x): x for x in range(10, 20)})
+
+    def test_disk_incremental(self):
+        c = cache.DiskCache(basedir=self.basedir, delta=10)
+        for x in range(20):
+            c.set(str(x), x)
+            self.outdate(c, str(x))
+
+        removed = 0
+        for x in range(3):
+            removed += c.sweep(limit=5)[0]
+            self.assertNotEqual(c.sweep_cursor, None)
+
+        removed += c.sweep(limit=5)[0]
+        self.assertEqual(removed, 20)
+        self.assertEqual(c.sweep_cursor, None)
+
+    def test_disk_stale_tmp_files(self):
+        c = cache.DiskCache(basedir=self.basedir)
+        c.set('foo', 1)
+
+        dname = os.path.dirname(c._on_disk_path('foo'))
+        stale = os.path.join(dname, cache.DiskCache.TMP_PREFIX + 'x')
+        fresh = os.path.join(dname, cache.DiskCache.TMP_PREFIX + 'y')
+        for p in (stale, fresh):
+            with open(p, 'wb') as fh:
+                fh.write(b'x')
+        os.utime(stale, (0, 0))
+
+        self.assertEqual(c.sweep(), (1, 1))
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+        self.assertEqual(c.get('foo'), 1)
+
+    def test_sqlite(self):
+        c = cache.SqliteCache(os.path.join(self.basedir, 'cache.sqlite'),
+                              delta=10)
+        c.set('a', b'x')
+        c.set('b', b'y')
+        c._conn.execute('UPDATE cache SET mtime = 0 WHERE key = ?',
+                        (cache.hashfunc('a'),))
+
+        (removed, reclaimed) = c.sweep()
+        self.assertEqual(removed, 1)
+        self.assertTrue(reclaimed > 0)
+        self.assertEqual(c.get('b'), b'y')
+
+    def test_log(self):
+        c = cache.LogCache(basedir=self.basedir, delta=10)
+        c.set('a', 1)
+        c.set('b', 2)
+        c._index[cache.hashfunc('a')] = \
+            c._index[cache.hashfunc('a')][:3] + (0,)
+
+        self.assertEqual(c.sweep()[0], 1)
+        c.close()
+
+        c = cache.LogCache(basedir=self.basedir, delta=10)
+        self.assertEqual(list(c._index), [cache.hashfunc('b')])
+
+    def test_sweeper_thread(self):
+        c = cache.DiskCache(basedir=self.basedir, delta=10)
+        c.set('a', 1)
+        self.outdate(c, 'a')
+
+        sweeper = cache.Sweeper(c, interval=0.01)
+        sweeper.start()
+        for x in range(100):
+            if sweeper.removed:
+                break
+            time.sleep(0.01)
+        sweeper.stop()
+
+        self.assertEqual(sweeper.removed, 1)
+        self.assertFalse(os.path.exists(c._on_disk_path('a')))
+
+    def test_sweeper_loop(self):
+        c = cache.DiskCache(basedir=self.basedir, delta=10)
+        c.set('a', 1)
+        self.outdate(c, 'a')
+
+        loop = asyncio.new_event_loop()
+        sweeper = cache.Sweeper(c, interval=0.01)
+        sweeper.attach(loop)
+        loop.run_until_complete(asyncio.sleep(0.1))
+        sweeper.stop()
+        loop.close()
+
+        self.assertEqual(sweeper.removed, 1)
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def check_backend(self, c):
+        c.set('a', b'x' * 100)
+        c.get('a')
+        c.get('b')
+        c.set_many({'c': 1, 'd': 2})
+        c.get_many(['c', 'd', 'e'])
+
+        stats = c.stats.snapshot()
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(sum(stats['latency']['get']), 2)
+        self.assertEqual(sum(stats['latency']['set']), 1)
+        self.assertEqual(sum(stats['latency']['get_many']), 1)
+        self.assertEqual(c.stats.hit_ratio, 3 / 5)
+
+        return stats
+
+    def test_null(self):
+        c = cache.NullCache()
+        c.get('a')
+        self.assertEqual(c.stats.snapshot()['misses'], 1)
+
+    def test_memory(self):
+        self.check_backend(cache.MemoryCache())
+
+    def test_disk(self):
+        stats = self.check_backend(cache.DiskCache(basedir=self.basedir))
+        self.assertTrue(stats['bytes_written'] > 100)
+        self.assertTrue(stats['bytes_read'] > 100)
+
+    def test_sqlite(self):
+        stats = self.check_backend(
+            cache.SqliteCache(os.path.join(self.basedir, 'cache.sqlite')))
+        self.assertTrue(stats['bytes_written'] > 100)
+
+    def test_log(self):
+        stats = self.check_backend(cache.LogCache(basedir=self.basedir))
+        self.assertTrue(stats['bytes_read'] > 100)
+
+    def test_expirations_and_errors(self):
+        c = cache.DiskCache(basedir=self.basedir, delta=10)
+        c.set('a', 1)
+        c.set('b', 1)
+        os.utime(c._on_disk_path('a'), (0, 0))
+        with open(c._on_disk_path('b'), 'wb') as fh:
+            fh.write(b'garbage')
+
+        c.get('a')
+        c.get('b')
+        stats = c.stats.snapshot()
+        self.assertEqual(stats['expirations'], 1)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_reset(self):
+        c = cache.MemoryCache()
+        c.get('a')
+        c.stats.reset()
+
+        stats = c.stats.snapshot()
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(sum(stats['latency']['get']), 0)
+
+    def test_hook(self):
+        events = []
+        c = cache.MemoryCache()
+        c.stats.hook = lambda name, value: events.append(name)
+        c.set('a', 1)
+        c.get('a')
+
+        self.assertEqual(events, ['set', 'get', 'hits'])
+
+
+if __name__ == '__main__':
+    unittest.main()
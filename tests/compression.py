@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+import gzip
+import os
+import unittest
+import zlib
+
+from ldotcommons import compression
+
+
+class TestStreamDecoder(unittest.TestCase):
+    data = os.urandom(16 * 1024) * 16
+
+    def decode(self, content_encoding, buff, chunk_size=1000):
+        decoder = compression.StreamDecoder(content_encoding)
+        ret = [decoder.decompress(buff[idx:idx + chunk_size])
+               for idx in range(0, len(buff), chunk_size)]
+        ret.append(decoder.flush())
+
+        return b''.join(ret)
+
+    def test_identity(self):
+        self.assertEqual(self.decode(None, self.data), self.data)
+        self.assertEqual(self.decode('identity', self.data), self.data)
+
+    def test_gzip(self):
+        self.assertEqual(self.decode('gzip', gzip.compress(self.data)),
+                         self.data)
+
+        # Concatenated members
+        self.assertEqual(self.decode('GZIP', gzip.compress(self.data) * 2),
+                         self.data * 2)
+
+    def test_deflate(self):
+        buff = zlib.compress(self.data)
+        self.assertEqual(self.decode('deflate', buff), self.data)
+
+        # Raw deflate stream
+        self.assertEqual(self.decode('deflate', buff[2:-4]), self.data)
+
+    def test_chained(self):
+        buff = gzip.compress(zlib.compress(self.data))
+        self.assertEqual(self.decode('deflate, gzip', buff), self.data)
+
+    @unittest.skipUnless(compression._has_brotli, 'brotli not available')
+    def test_brotli(self):
+        buff = compression.brotli.compress(self.data)
+        self.assertEqual(self.decode('br', buff), self.data)
+
+    @unittest.skipUnless(compression._has_zstd, 'zstandard not available')
+    def test_zstd(self):
+        buff = compression.zstandard.ZstdCompressor().compress(self.data)
+        self.assertEqual(self.decode('zstd', buff), self.data)
+
+    def test_unsupported(self):
+        with self.assertRaises(compression.DecodeError):
+            compression.StreamDecoder('gzip, foo')
+
+    def test_corrupted(self):
+        with self.assertRaises(compression.DecodeError):
+            self.decode('gzip', b'not gzip at all')
+
+    def test_truncated(self):
+        buff = gzip.compress(self.data)
+        with self.assertRaises(compression.DecodeError):
+            self.decode('gzip', buff[:len(buff) // 2])
+
+        buff = zlib.compress(self.data)
+        with self.assertRaises(compression.DecodeError):
+            self.decode('deflate', buff[:len(buff) // 2])
+        with self.assertRaises(compression.DecodeError):
+            self.decode('deflate', buff[2:len(buff) // 2])
+
+    @unittest.skipUnless(compression._has_brotli, 'brotli not available')
+    def test_truncated_brotli(self):
+        buff = compression.brotli.compress(self.data)
+        with self.assertRaises(compression.DecodeError):
+            self.decode('br', buff[:len(buff) // 2])
+        self.assertEqual(self.decode('br', b''), b'')
+
+    @unittest.skipUnless(compression._has_zstd, 'zstandard not available')
+    def test_truncated_zstd(self):
+        buff = compression.zstandard.ZstdCompressor().compress(self.data)
+        with self.assertRaises(compression.DecodeError):
+            self.decode('zstd', buff[:len(buff) // 2])
+        self.assertEqual(self.decode('zstd', b''), b'')
+
+    def test_empty(self):
+        self.assertEqual(self.decode('gzip', b''), b'')
+        self.assertEqual(self.decode('deflate', b''), b'')
+
+
+class TestAcceptEncoding(unittest.TestCase):
+    def test_accept_encoding(self):
+        encodings = compression.accept_encoding().split(', ')
+        self.assertEqual(encodings[-2:], ['gzip', 'deflate'])
+        self.assertEqual(set(encodings),
+                         set(compression.DECODERS) - {'x-gzip'})
+
+
+if __name__ == '__main__':
+    unittest.main()
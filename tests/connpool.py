@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+import unittest
+
+from ldotcommons import connpool
+from tests.httpserver import LocalServerTestCase
+
+
+class TestConnectionPool(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server.routes['/'] = lambda h: (200, {}, b'foo')
+        self.pool = connpool.ConnectionPool(maxsize=2)
+
+    def tearDown(self):
+        self.pool.close()
+        super().tearDown()
+
+    def test_reuse(self):
+        for x in range(5):
+            resp = self.pool.urlopen('GET', self.url('/'))
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(resp.read(), b'foo')
+
+        stats = self.pool.stats
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 4)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_unread_response_is_discarded(self):
+        resp = self.pool.urlopen('GET', self.url('/'))
+        resp.release()
+        self.pool.urlopen('GET', self.url('/')).read()
+
+        self.assertEqual(self.pool.stats['created'], 2)
+        self.assertEqual(self.pool.stats['discarded'], 1)
+
+    def test_maxsize(self):
+        resps = [self.pool.urlopen('GET', self.url('/')) for x in range(3)]
+        for resp in resps:
+            resp.read()
+
+        self.assertEqual(self.pool.stats['idle'], 2)
+        self.assertEqual(self.pool.stats['discarded'], 1)
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = -1
+        self.pool.urlopen('GET', self.url('/')).read()
+        self.pool.urlopen('GET', self.url('/')).read()
+
+        self.assertEqual(self.pool.stats['created'], 2)
+        self.assertEqual(self.pool.stats['reused'], 0)
+
+    def test_server_closed_connection(self):
+        self.pool.urlopen('GET', self.url('/')).read()
+        for (conn, last_used) in self.pool._idle[
+                ('http', '127.0.0.1', self.server.server_address[1])]:
+            conn.sock.close()
+
+        resp = self.pool.urlopen('GET', self.url('/'))
+        self.assertEqual(resp.read(), b'foo')
+
+    def test_server_closed_connection_post(self):
+        # Non-idempotent requests are not sent again
+        self.pool.urlopen('GET', self.url('/')).read()
+        for (conn, last_used) in self.pool._idle[
+                ('http', '127.0.0.1', self.server.server_address[1])]:
+            conn.sock.close()
+
+        with self.assertRaises(OSError):
+            self.pool.urlopen('POST', self.url('/'), body=b'x')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_invalid_scheme(self):
+        with self.assertRaises(connpool.PoolError):
+            self.pool.urlopen('GET', 'ftp://127.0.0.1/')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,11 +2,21 @@
 
 import unittest
 
+import asyncio
+import collections
+import gzip
 import os
+import shutil
 import tempfile
+import time
 import random
+import zipfile
+import zlib
+from unittest import mock
 
-from ldotcommons import fetchers, logging, utils
+from ldotcommons import (archive, cache, compression, fetchers, logging,
+                         ratelimit, retry, tracing, utils)
+from tests.httpserver import LocalServerTestCase
 
 
 class TestFactory(unittest.TestCase):
@@ -22,21 +32,80 @@ class TestFactory(unittest.TestCase):
 
 
 class TestMock(unittest.TestCase):
+    url = 'http://this-is-a-fake-url.com/sample.html'
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.body = str(random.random()).encode('ascii')
+        with open(os.path.join(self.basedir, utils.slugify(self.url)),
+                  'wb') as fh:
+            fh.write(self.body)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
     def test_fetch(self):
-        url = 'http://this-is-a-fake-url.com/sample.html'
+        fetcher = fetchers.MockFetcher(basedir=self.basedir)
+        self.assertEqual(fetcher.fetch(self.url), self.body)
+        self.assertEqual(fetcher.index, {utils.slugify(self.url): None})
+
+        with self.assertRaises(fetchers.FetchError):
+            fetcher.fetch('http://this-is-a-fake-url.com/missing')
+
+    def test_added_after_index(self):
+        fetcher = fetchers.MockFetcher(basedir=self.basedir)
+        fetcher.fetch(self.url)
+
+        url = 'http://this-is-a-fake-url.com/new'
+        with open(os.path.join(self.basedir, utils.slugify(url)),
+                  'wb') as fh:
+            fh.write(b'new')
+
+        self.assertEqual(fetcher.fetch(url), b'new')
 
-        base = tempfile.mkdtemp()
-        mockfile = os.path.join(base, utils.slugify(url))
+    def test_preload(self):
+        fetcher = fetchers.MockFetcher(basedir=self.basedir, preload=True)
+        self.assertEqual(fetcher.index, {utils.slugify(self.url): self.body})
 
-        randstr = str(random.random())
-        with open(mockfile, 'w+') as fh:
-            fh.write(randstr)
-            fh.close()
+        # Served from memory
+        shutil.rmtree(self.basedir)
+        os.mkdir(self.basedir)
+        self.assertEqual(fetcher.fetch(self.url), self.body)
 
-        fetcher = fetchers.MockFetcher(basedir=base)
-        buff = fetcher.fetch(url)
+    def test_archive(self):
+        archive = os.path.join(self.basedir, 'fixtures.zip')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr(utils.slugify(self.url), self.body)
 
-        self.assertEqual(buff, randstr)
+        for preload in (False, True):
+            fetcher = fetchers.MockFetcher(archive=archive, preload=preload)
+            self.assertEqual(fetcher.fetch(self.url), self.body)
+            with self.assertRaises(fetchers.FetchError):
+                fetcher.fetch(self.url + '?missing')
+            fetcher.close()
+
+    def test_not_configured(self):
+        with self.assertRaises(fetchers.FetchError):
+            fetchers.MockFetcher().fetch(self.url)
+
+    def test_async(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        @asyncio.coroutine
+        def run():
+            fetcher = fetchers.AsyncMockFetcher(basedir=self.basedir,
+                                                delay=0.01)
+            ret = yield from asyncio.gather(
+                fetcher.fetch(self.url), fetcher.fetch_full(self.url))
+            yield from fetcher.close()
+            return ret
+
+        try:
+            self.assertEqual(loop.run_until_complete(run()),
+                             [self.body, (None, self.body)])
+        finally:
+            loop.close()
 
 
 class TestUrllib(unittest.TestCase):
@@ -49,6 +118,937 @@ class TestUrllib(unittest.TestCase):
 
 
 
+class TestHTTPCache(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fetcher = fetchers.UrllibFetcher(
+            http_cache=True, stale_while_revalidate=60)
+        self.fetcher._http_cache.backend = cache.MemoryCache()
+
+    def etag_route(self, handler):
+        if handler.headers.get('If-None-Match') == '"v1"':
+            return (304, {'ETag': '"v1"', 'Cache-Control': 'max-age=0'},
+                    b'')
+
+        return (200, {'ETag': '"v1"', 'Cache-Control': 'max-age=0'}, b'foo')
+
+    def test_fresh(self):
+        self.server.routes['/'] = \
+            lambda h: (200, {'Cache-Control': 'max-age=60'}, b'foo')
+
+        self.assertEqual(self.fetcher.fetch(self.url('/')), b'foo')
+        self.assertEqual(self.fetcher.fetch(self.url('/')), b'foo')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_revalidate(self):
+        self.fetcher._http_cache.stale_while_revalidate = 0
+        self.server.routes['/'] = self.etag_route
+
+        self.assertEqual(self.fetcher.fetch(self.url('/')), b'foo')
+        self.assertEqual(self.fetcher.fetch(self.url('/')), b'foo')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(
+            self.server.requests[1][1].get('If-None-Match'), '"v1"')
+
+    def test_stale_while_revalidate(self):
+        self.server.routes['/'] = self.etag_route
+
+        self.assertEqual(self.fetcher.fetch(self.url('/')), b'foo')
+        self.assertEqual(self.fetcher.fetch(self.url('/')), b'foo')
+
+        for x in range(100):
+            if len(self.server.requests) == 2:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(len(self.server.requests), 2)
+
+
+    def test_shared_backend(self):
+        self.server.routes['/'] = \
+            lambda h: (200, {'Cache-Control': 'max-age=60'}, b'foo')
+        backend = self.fetcher._http_cache.backend
+
+        # Plain bodies are misses for the HTTP cache...
+        backend.set(self.url('/'), b'old')
+        self.assertEqual(self.fetcher.fetch(self.url('/')), b'foo')
+
+        # ...and HTTP cache entries for plain caches
+        fetcher = fetchers.UrllibFetcher(cache=backend)
+        self.assertEqual(fetcher.fetch(self.url('/')), b'foo')
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class TestDefaultCaches(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.basedir = tempfile.mkdtemp()
+        self.environ = mock.patch.dict(
+            os.environ, {'XDG_CACHE_HOME': self.basedir})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.basedir)
+        super().tearDown()
+
+    def test_plain_and_http(self):
+        for path in ('/', '/0', '/1', '/2'):
+            self.server.routes[path] = \
+                lambda h: (200, {'Cache-Control': 'max-age=60'}, b'foo')
+
+        http = fetchers.UrllibFetcher(enable_cache=True, http_cache=True)
+        plain = fetchers.UrllibFetcher(enable_cache=True, cache_delta=0)
+        basedirs = [http.cache.basedir, plain.cache.basedir]
+        self.assertEqual(os.path.commonpath(basedirs),
+                         os.path.dirname(basedirs[0]))
+
+        for x in range(3):
+            http.fetch(self.url('/' + str(x)))
+        http.cache.sync()
+
+        # Sweeping and evicting in the plain cache leave HTTP entries alone
+        plain.fetch(self.url('/'))
+        time.sleep(0.01)
+        self.assertEqual(plain.cache.sweep()[0], 1)
+        c = cache.DiskCache(basedir=plain.cache.basedir, max_entries=10)
+        for x in range(12):
+            c.set(str(x), x)
+        self.assertTrue(len(c._index) <= 10)
+        self.assertEqual(c.get('11'), 11)
+
+        for x in range(3):
+            self.assertEqual(http.fetch(self.url('/' + str(x))), b'foo')
+        self.assertEqual(len(self.server.requests), 4)
+
+
+class TestPooledUrllib(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fetcher = fetchers.UrllibFetcher(pool_size=2)
+
+    def tearDown(self):
+        self.fetcher.close()
+        super().tearDown()
+
+    def test_fetch(self):
+        self.server.routes['/'] = lambda h: (200, {}, b'foo')
+        for x in range(3):
+            self.assertEqual(self.fetcher.fetch(self.url('/')), b'foo')
+
+        self.assertEqual(self.fetcher.pool_stats['created'], 1)
+        self.assertEqual(self.fetcher.pool_stats['reused'], 2)
+
+    def test_redirect(self):
+        self.server.routes['/a'] = lambda h: (302, {'Location': '/b'}, b'')
+        self.server.routes['/b'] = lambda h: (200, {}, b'bar')
+        self.assertEqual(self.fetcher.fetch(self.url('/a')), b'bar')
+
+    def test_error(self):
+        self.server.routes['/'] = lambda h: (404, {}, b'not found')
+        with self.assertRaises(fetchers.FetchError):
+            self.fetcher.fetch(self.url('/'))
+
+
+class TestAIOHttp(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def test_shared_session(self):
+        self.server.routes['/'] = lambda h: (200, {}, b'foo')
+        fetcher = fetchers.AIOHttpFetcher(limit_per_host=1)
+
+        @asyncio.coroutine
+        def run():
+            f = yield from fetcher.__aenter__()
+            ret = []
+            for x in range(3):
+                ret.append((yield from f.fetch(self.url('/'))))
+            session = f.session
+            yield from f.__aexit__(None, None, None)
+
+            return (ret, session)
+
+        (ret, session) = self.loop.run_until_complete(run())
+        self.assertEqual(ret, [b'foo'] * 3)
+        self.assertTrue(session.closed)
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_close_cache(self):
+        # Only AsyncCache wrappers created by fetchers are closed by them
+        @asyncio.coroutine
+        def run():
+            shared = cache.AsyncCache(cache.MemoryCache())
+            ret = []
+            for cls in (fetchers.AIOHttpFetcher, fetchers.AsyncFetcher):
+                for c in (cache.MemoryCache(), shared):
+                    fetcher = cls(cache=c)
+                    yield from fetcher.close()
+                    ret.append(fetcher._cache._executor._shutdown)
+
+            return ret
+
+        self.assertEqual(self.loop.run_until_complete(run()),
+                         [True, False] * 2)
+
+
+class TestFetchMany(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def async_fetcher(self, **kwargs):
+        @asyncio.coroutine
+        def build():
+            return fetchers.AsyncFetcher(**kwargs)
+
+        return self.loop.run_until_complete(build())
+
+    def test_host_limiter(self):
+        limiter = fetchers.HostLimiter(max_requests=3, max_per_host=1)
+        running = collections.Counter()
+        peak = collections.Counter()
+
+        @asyncio.coroutine
+        def task(url):
+            yield from limiter.acquire(url)
+            try:
+                host = fetchers._host(url)
+                running[host] += 1
+                running['*'] += 1
+                for k in (host, '*'):
+                    peak[k] = max(peak[k], running[k])
+                yield from asyncio.sleep(0.01)
+                running[host] -= 1
+                running['*'] -= 1
+            finally:
+                limiter.release(url)
+
+        urls = ['http://host{}/{}'.format(x % 4, x) for x in range(20)]
+        self.loop.run_until_complete(
+            asyncio.gather(*[task(url) for url in urls]))
+
+        self.assertEqual(peak['*'], 3)
+        self.assertEqual(
+            max(v for (k, v) in peak.items() if k != '*'), 1)
+        self.assertEqual(limiter._hosts, {})
+
+    def test_fetch_many(self):
+        for x in range(5):
+            self.server.routes['/' + str(x)] = \
+                lambda h, x=x: (200, {}, str(x).encode('ascii'))
+
+        urls = [self.url('/' + str(x)) for x in range(5)]
+
+        @asyncio.coroutine
+        def run():
+            fetcher = fetchers.AsyncFetcher(max_requests=4,
+                                            max_requests_per_host=2)
+            ret = {}
+            it = fetcher.fetch_many(urls)
+            while True:
+                try:
+                    (url, buff) = yield from it.__anext__()
+                except StopAsyncIteration:
+                    break
+                ret[url] = buff
+
+            yield from fetcher.close()
+            return ret
+
+        ret = self.loop.run_until_complete(run())
+        self.assertEqual(
+            ret,
+            {url: str(x).encode('ascii') for (x, url) in enumerate(urls)})
+
+    def test_fetch_many_sync(self):
+        self.server.routes['/'] = lambda h: (200, {}, b'foo')
+        fetcher = self.async_fetcher(max_requests=2)
+        bad = 'http://127.0.0.1:1/'
+
+        ret = dict(fetcher.fetch_many_sync(
+            [self.url('/'), bad], return_exceptions=True))
+        self.loop.run_until_complete(fetcher.close())
+
+        self.assertEqual(ret[self.url('/')], b'foo')
+        self.assertTrue(isinstance(ret[bad], Exception))
+
+    def test_fetch_many_raises(self):
+        fetcher = self.async_fetcher()
+        with self.assertRaises(Exception):
+            list(fetcher.fetch_many_sync(['http://127.0.0.1:1/']))
+        self.loop.run_until_complete(fetcher.close())
+
+    def test_sequential_fetch_many(self):
+        self.server.routes['/'] = lambda h: (200, {}, b'foo')
+        fetcher = fetchers.UrllibFetcher(pool_size=1)
+        bad = self.url('/missing')
+
+        ret = list(fetcher.fetch_many([self.url('/'), bad],
+                                      return_exceptions=True))
+        fetcher.close()
+
+        self.assertEqual(ret[0], (self.url('/'), b'foo'))
+        self.assertTrue(isinstance(ret[1][1], fetchers.FetchError))
+
+
+class TestSingleFlight(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def slow_route(self, handler):
+        time.sleep(0.1)
+        return (200, {}, b'foo')
+
+    def test_coalesce(self):
+        self.server.routes['/'] = self.slow_route
+        c = cache.MemoryCache()
+        sets = []
+        orig_set = c.set
+        c.set = lambda k, v: sets.append(k) or orig_set(k, v)
+
+        @asyncio.coroutine
+        def run():
+            fetcher = fetchers.AsyncFetcher(cache=c, max_requests=10)
+            ret = yield from asyncio.gather(
+                *[fetcher.fetch(self.url('/')) for x in range(5)])
+            inflight = len(fetcher._inflight)
+            yield from fetcher.close()
+            return (ret, inflight)
+
+        (ret, inflight) = self.loop.run_until_complete(run())
+        self.assertEqual(ret, [b'foo'] * 5)
+        self.assertEqual(inflight, 0)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(sets, [self.url('/')])
+
+    def test_different_options(self):
+        self.server.routes['/'] = self.slow_route
+
+        @asyncio.coroutine
+        def run():
+            fetcher = fetchers.AIOHttpFetcher()
+            ret = yield from asyncio.gather(
+                fetcher.fetch(self.url('/'), headers={'X-Foo': '1'}),
+                fetcher.fetch(self.url('/'), headers={'X-Foo': '1'}),
+                fetcher.fetch(self.url('/'), headers={'X-Foo': '2'}))
+            yield from fetcher.close()
+            return ret
+
+        ret = self.loop.run_until_complete(run())
+        self.assertEqual(ret, [b'foo'] * 3)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_cancel_one_caller(self):
+        self.server.routes['/'] = self.slow_route
+
+        @asyncio.coroutine
+        def run():
+            fetcher = fetchers.AsyncFetcher(max_requests=10)
+            a = asyncio.ensure_future(fetcher.fetch(self.url('/')))
+            b = asyncio.ensure_future(fetcher.fetch(self.url('/')))
+            yield from asyncio.sleep(0.01)
+            a.cancel()
+            ret = yield from b
+            yield from fetcher.close()
+            return (a.cancelled(), ret)
+
+        self.assertEqual(self.loop.run_until_complete(run()),
+                         (True, b'foo'))
+
+
+class TestStream(LocalServerTestCase):
+    data = os.urandom(64 * 1024) * 4
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.basedir = tempfile.mkdtemp()
+        self.server.routes['/'] = lambda h: (200, {}, self.data)
+        self.server.routes['/gzip'] = lambda h: (
+            200, {'Content-Encoding': 'gzip'}, gzip.compress(self.data))
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.basedir)
+        super().tearDown()
+
+    def test_stream(self):
+        fetcher = fetchers.UrllibFetcher(pool_size=1)
+        for path in ('/', '/gzip'):
+            chunks = list(fetcher.fetch_stream(self.url(path),
+                                               chunk_size=16 * 1024))
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual(b''.join(chunks), self.data)
+
+        self.assertEqual(fetcher.fetch(self.url('/gzip')), self.data)
+        fetcher.close()
+
+    def test_tee(self):
+        fetcher = fetchers.UrllibFetcher(
+            cache=cache.DiskCache(basedir=self.basedir))
+
+        # Partially read bodies are not stored
+        stream = fetcher.fetch_stream(self.url('/gzip'), chunk_size=1024)
+        next(stream)
+        stream.close()
+        self.assertEqual(fetcher.cache.get(self.url('/gzip')), None)
+
+        for x in range(2):
+            chunks = list(fetcher.fetch_stream(self.url('/gzip')))
+            self.assertEqual(b''.join(chunks), self.data)
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(fetcher.fetch(self.url('/gzip')), self.data)
+
+    def test_error(self):
+        self.server.routes['/'] = lambda h: (500, {}, b'')
+        fetcher = fetchers.UrllibFetcher()
+        with self.assertRaises(fetchers.FetchError):
+            list(fetcher.fetch_stream(self.url('/')))
+
+    def test_truncated(self):
+        buff = gzip.compress(self.data)
+        self.server.routes['/gzip'] = lambda h: (
+            200, {'Content-Encoding': 'gzip'}, buff[:len(buff) // 2])
+
+        fetcher = fetchers.UrllibFetcher(
+            cache=cache.DiskCache(basedir=self.basedir))
+        with self.assertRaises(fetchers.FetchError):
+            list(fetcher.fetch_stream(self.url('/gzip')))
+        with self.assertRaises(fetchers.FetchError):
+            fetcher.fetch(self.url('/gzip'))
+
+        self.assertEqual(fetcher.cache.get(self.url('/gzip')), None)
+
+    def test_async_stream(self):
+        @asyncio.coroutine
+        def consume(fetcher, path):
+            chunks = []
+            stream = fetcher.fetch_stream(self.url(path), chunk_size=1024)
+            while True:
+                try:
+                    chunks.append((yield from stream.__anext__()))
+                except StopAsyncIteration:
+                    return chunks
+
+        @asyncio.coroutine
+        def run():
+            fetcher = fetchers.AIOHttpFetcher(
+                cache=cache.DiskCache(basedir=self.basedir))
+
+            ret = []
+            for path in ('/', '/gzip', '/gzip'):
+                ret.append((yield from consume(fetcher, path)))
+            buff = yield from fetcher.fetch(self.url('/gzip'))
+            yield from fetcher.close()
+            return (ret, buff)
+
+        (ret, buff) = self.loop.run_until_complete(run())
+        for chunks in ret:
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual(b''.join(chunks), self.data)
+
+        self.assertEqual(buff, self.data)
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class TestRateLimit(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server.routes['/'] = lambda h: (200, {}, b'foo')
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def test_host_limiter(self):
+        limiter = fetchers.HostLimiter(
+            max_requests=2,
+            rate_limiter=ratelimit.HostRateLimiter(rate=10))
+        started = collections.defaultdict(list)
+
+        @asyncio.coroutine
+        def task(url):
+            yield from limiter.acquire(url)
+            started[fetchers._host(url)].append(time.monotonic() - t0)
+            limiter.release(url)
+
+        t0 = time.monotonic()
+        urls = ['http://a/1', 'http://a/2', 'http://a/3', 'http://b/1']
+        self.loop.run_until_complete(
+            asyncio.gather(*[task(url) for url in urls]))
+
+        self.assertTrue(started['b'][0] < 0.05)
+        self.assertTrue(started['a'][2] >= 0.19)
+
+    def test_urllib(self):
+        limiter = ratelimit.HostRateLimiter(rate=20)
+        fetcher = fetchers.UrllibFetcher(rate_limiter=limiter)
+
+        t0 = time.monotonic()
+        for x in range(3):
+            fetcher.fetch(self.url('/'))
+        self.assertTrue(time.monotonic() - t0 >= 0.09)
+
+    def test_async(self):
+        @asyncio.coroutine
+        def run():
+            fetcher = fetchers.AsyncFetcher(max_requests=3, rate_limit=20)
+            t0 = time.monotonic()
+            yield from asyncio.gather(
+                *[fetcher.fetch(self.url('/?' + str(x)))
+                  for x in range(3)])
+            elapsed = time.monotonic() - t0
+            yield from fetcher.close()
+            return elapsed
+
+        self.server.routes.update(
+            {'/?' + str(x): self.server.routes['/'] for x in range(3)})
+        self.assertTrue(self.loop.run_until_complete(run()) >= 0.09)
+
+
+class TestRetry(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.policy = retry.RetryPolicy(max_attempts=3, backoff=0.01)
+        self.failures = 2
+        self.server.routes['/'] = self.flaky_route
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def flaky_route(self, handler):
+        if len(self.server.requests) <= self.failures:
+            return (503, {'Retry-After': '0'}, b'')
+
+        return (200, {}, b'foo')
+
+    def test_urllib(self):
+        fetcher = fetchers.UrllibFetcher(retry=self.policy)
+        self.assertEqual(fetcher.fetch(self.url('/')), b'foo')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_urllib_exhausted(self):
+        self.failures = 5
+        fetcher = fetchers.UrllibFetcher(pool_size=1, retry=self.policy)
+        with self.assertRaises(fetchers.FetchError) as cm:
+            fetcher.fetch(self.url('/'))
+        fetcher.close()
+
+        self.assertEqual([x.status for x in cm.exception.attempts],
+                         [503, 503, 503])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_urllib_retry_after(self):
+        # Header names are case-insensitive
+        self.server.routes['/'] = lambda h: (
+            (503, {'retry-after': '0'}, b'')
+            if len(self.server.requests) == 1 else (200, {}, b'foo'))
+
+        policy = retry.RetryPolicy(max_attempts=2, backoff=60)
+        for pool_size in (0, 1):
+            fetcher = fetchers.UrllibFetcher(pool_size=pool_size,
+                                             retry=policy)
+            self.assertEqual(fetcher.fetch(self.url('/')), b'foo')
+            fetcher.close()
+            self.server.requests.clear()
+
+    def test_urllib_connection_error(self):
+        fetcher = fetchers.UrllibFetcher(retry=self.policy)
+        with self.assertRaises(fetchers.FetchError) as cm:
+            fetcher.fetch('http://127.0.0.1:1/')
+
+        self.assertEqual(len(cm.exception.attempts), 3)
+        self.assertTrue(
+            all(isinstance(x.error, OSError)
+                for x in cm.exception.attempts))
+
+    def test_no_retry(self):
+        fetcher = fetchers.UrllibFetcher()
+        with self.assertRaises(fetchers.FetchError) as cm:
+            fetcher.fetch(self.url('/'))
+
+        self.assertEqual(len(cm.exception.attempts), 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_async(self):
+        @asyncio.coroutine
+        def run():
+            fetcher = fetchers.AsyncFetcher(retry=self.policy)
+            (resp, buff) = yield from fetcher.fetch_full(self.url('/'))
+            yield from fetcher.close()
+            return (resp.status, buff)
+
+        self.assertEqual(self.loop.run_until_complete(run()), (200, b'foo'))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_async_not_cached(self):
+        # Responses returned once attempts are exhausted are not cached
+        self.failures = 5
+        policy = retry.RetryPolicy(max_attempts=2, backoff=0.01)
+
+        @asyncio.coroutine
+        def run():
+            ret = []
+            for cls in (fetchers.AIOHttpFetcher, fetchers.AsyncFetcher):
+                c = cache.MemoryCache()
+                fetcher = cls(cache=c, retry=policy)
+                yield from fetcher.fetch(self.url('/'))
+                yield from fetcher.close()
+                ret.append(c.get(self.url('/')))
+
+            return ret
+
+        self.assertEqual(self.loop.run_until_complete(run()), [None, None])
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_async_connection_error(self):
+        @asyncio.coroutine
+        def run():
+            fetcher = fetchers.AsyncFetcher(retry=self.policy)
+            try:
+                yield from fetcher.fetch('http://127.0.0.1:1/')
+            finally:
+                yield from fetcher.close()
+
+        with self.assertRaises(Exception) as cm:
+            self.loop.run_until_complete(run())
+
+        self.assertEqual(len(cm.exception.attempts), 3)
+
+    def test_aiohttp(self):
+        self.failures = 5
+
+        @asyncio.coroutine
+        def run():
+            fetcher = fetchers.AIOHttpFetcher(retry=self.policy)
+            buff = yield from fetcher.fetch(self.url('/'))
+            yield from fetcher.close()
+            return buff
+
+        self.assertEqual(self.loop.run_until_complete(run()), b'')
+        self.assertEqual(len(self.server.requests), 3)
+
+
+class TestCompression(LocalServerTestCase):
+    data = b'foo bar ' * 1000
+
+    def test_accept_encoding(self):
+        self.server.routes['/'] = lambda h: (
+            200, {'Content-Encoding': 'deflate'}, zlib.compress(self.data))
+
+        fetcher = fetchers.UrllibFetcher()
+        self.assertEqual(fetcher.fetch(self.url('/')), self.data)
+        self.assertEqual(
+            self.server.requests[0][1]['Accept-Encoding'],
+            compression.accept_encoding())
+
+    def test_explicit_accept_encoding(self):
+        self.server.routes['/'] = lambda h: (200, {}, self.data)
+
+        fetcher = fetchers.UrllibFetcher(pool_size=1)
+        fetcher.fetch(self.url('/'), headers={'accept-encoding': 'gzip'})
+        fetcher.close()
+
+        fetcher = fetchers.UrllibFetcher(accept_encoding=False)
+        fetcher.fetch(self.url('/'))
+
+        self.assertEqual(
+            [{k.lower(): v for (k, v) in x[1].items()}['accept-encoding']
+             for x in self.server.requests],
+            ['gzip', 'identity'])
+
+    def test_unsupported(self):
+        self.server.routes['/'] = lambda h: (
+            200, {'Content-Encoding': 'foo'}, self.data)
+
+        fetcher = fetchers.UrllibFetcher()
+        with self.assertRaises(fetchers.FetchError):
+            fetcher.fetch(self.url('/'))
+
+
+class TestThreadedUrllib(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.basedir = tempfile.mkdtemp()
+        self.fetcher = fetchers.ThreadedUrllibFetcher(
+            workers=4, cache=cache.DiskCache(basedir=self.basedir))
+
+        for x in range(8):
+            self.server.routes['/' + str(x)] = self.route
+
+    def tearDown(self):
+        self.fetcher.close()
+        shutil.rmtree(self.basedir)
+        super().tearDown()
+
+    def route(self, handler):
+        # Higher paths are faster
+        time.sleep(0.2 - int(handler.path[1:]) * 0.02)
+        return (200, {}, handler.path.encode('ascii'))
+
+    def slow_route(self, handler):
+        time.sleep(0.2)
+        return (200, {}, b'')
+
+    def test_fetch_many(self):
+        urls = [self.url('/' + str(x)) for x in range(8)]
+
+        t0 = time.monotonic()
+        ret = list(self.fetcher.fetch_many(urls))
+        elapsed = time.monotonic() - t0
+
+        self.assertTrue(elapsed < 0.2 * 4)
+        self.assertEqual(
+            dict(ret),
+            {url: '/{}'.format(x).encode('ascii')
+             for (x, url) in enumerate(urls)})
+        self.assertTrue(self.fetcher.pool_stats['created'] <= 4)
+
+        # Results are in completion order
+        self.assertEqual(ret[0][0], urls[3])
+
+        # Cache is shared
+        list(self.fetcher.fetch_many(urls))
+        self.assertEqual(len(self.server.requests), 8)
+
+    def test_map(self):
+        self.server.routes['/missing'] = lambda h: (404, {}, b'')
+        urls = [self.url('/0'), self.url('/missing')]
+
+        futures = list(self.fetcher.map(urls))
+        self.assertEqual([x.url for x in futures], urls[::-1])
+        self.assertTrue(
+            isinstance(futures[0].exception(), fetchers.FetchError))
+        self.assertEqual(futures[1].result(), b'/0')
+
+        ret = dict(self.fetcher.fetch_many(urls, return_exceptions=True))
+        self.assertTrue(isinstance(ret[urls[1]], fetchers.FetchError))
+
+    def test_map_eager(self):
+        urls = [self.url('/' + str(x)) for x in range(8)]
+
+        # Fetching starts before iterating...
+        futures = self.fetcher.map(urls[:4])
+        time.sleep(0.3)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(len(list(futures)), 4)
+
+        # ...and what isn't started yet is cancelled when giving up
+        for x in range(16):
+            self.server.routes['/slow/' + str(x)] = self.slow_route
+        futures = self.fetcher.map(
+            [self.url('/slow/' + str(x)) for x in range(16)])
+        next(futures)
+        futures.close()
+        self.fetcher.close()
+        self.assertTrue(len(self.server.requests) < 4 + 16)
+
+    def test_submit(self):
+        fut = self.fetcher.submit(self.url('/7'))
+        self.assertEqual(fut.result(), b'/7')
+
+
+class TestArchive(LocalServerTestCase):
+    data = b'foo bar ' * 1000
+
+    def setUp(self):
+        super().setUp()
+        self.basedir = tempfile.mkdtemp()
+        self.path = os.path.join(self.basedir, 'crawl.arc')
+
+        self.server.routes['/'] = lambda h: (
+            200, {'Content-Encoding': 'gzip', 'X-Foo': 'bar'},
+            gzip.compress(self.data))
+        self.server.routes['/missing'] = lambda h: (404, {}, b'not found')
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+        super().tearDown()
+
+    def assertReplays(self):
+        fetcher = fetchers.Fetcher('archive', self.path)
+        self.assertEqual(fetcher.fetch(self.url('/')), self.data)
+
+        with self.assertRaises(fetchers.FetchError) as cm:
+            fetcher.fetch(self.url('/missing'))
+        self.assertEqual(cm.exception.status, 404)
+
+        with self.assertRaises(fetchers.FetchError):
+            fetcher.fetch(self.url('/other'))
+
+        # Bodies are recorded decoded
+        record = fetcher.archive.get(self.url('/'))
+        self.assertEqual(record.headers['X-Foo'], 'bar')
+        self.assertFalse('Content-Encoding' in record.headers)
+        self.assertEqual(
+            fetcher.archive.get(self.url('/missing')).body, b'not found')
+
+        fetcher.close()
+
+    def test_urllib(self):
+        for pool_size in (0, 1):
+            fetcher = fetchers.UrllibFetcher(record=self.path,
+                                             pool_size=pool_size)
+            fetcher.fetch(self.url('/'))
+            with self.assertRaises(fetchers.FetchError):
+                fetcher.fetch(self.url('/missing'))
+            fetcher.close()
+
+            self.assertReplays()
+
+    def test_async(self):
+        @asyncio.coroutine
+        def run(cls):
+            fetcher = cls(record=self.path)
+            yield from fetcher.fetch(self.url('/'))
+            yield from fetcher.fetch(self.url('/missing'))
+            yield from fetcher.close()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for cls in (fetchers.AIOHttpFetcher, fetchers.AsyncFetcher):
+            loop.run_until_complete(run(cls))
+            self.assertReplays()
+        loop.close()
+
+    def test_shared_writer(self):
+        writer = archive.ArchiveWriter(self.path)
+        fetcher = fetchers.UrllibFetcher(record=writer)
+        fetcher.fetch(self.url('/'))
+        fetcher.close()
+
+        # Writers given by the caller are not closed
+        writer.write(self.url('/foo'), 200, {}, b'foo')
+        writer.close()
+
+        fetcher = fetchers.ArchiveFetcher(self.path)
+        self.assertEqual(fetcher.fetch(self.url('/foo')), b'foo')
+        fetcher.close()
+
+    def test_not_configured(self):
+        with self.assertRaises(fetchers.FetchError):
+            fetchers.ArchiveFetcher()
+
+        with self.assertRaises(fetchers.FetchError):
+            fetchers.ArchiveFetcher(os.path.join(self.basedir, 'missing'))
+
+
+class TestTracing(LocalServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.basedir = tempfile.mkdtemp()
+        self.events = []
+        self.report = tracing.LatencyReport()
+        self.tracer = tracing.Tracer(self.events.append, self.report)
+        self.server.routes['/'] = lambda h: (200, {}, b'foo')
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+        super().tearDown()
+
+    def phases(self):
+        return [(x.phase, x.info) for x in self.events]
+
+    def test_urllib(self):
+        fetcher = fetchers.UrllibFetcher(
+            tracer=self.tracer, pool_size=1,
+            cache=cache.DiskCache(basedir=self.basedir))
+
+        for x in range(2):
+            fetcher.fetch(self.url('/'))
+        fetcher.close()
+
+        self.assertEqual(
+            [x[0] for x in self.phases()],
+            [tracing.CACHE_GET, tracing.CONNECT, tracing.REQUEST,
+             tracing.BODY, tracing.CACHE_SET, tracing.TOTAL,
+             tracing.CACHE_GET, tracing.TOTAL])
+        self.assertEqual(self.events[0].info, {'hit': False})
+        self.assertEqual(self.events[2].info, {'status': 200})
+        self.assertEqual(self.events[6].info, {'hit': True})
+        self.assertTrue(self.events[5].elapsed >= self.events[2].elapsed)
+
+        host = self.report.hosts()[0]
+        self.assertEqual(
+            self.report.stats()[host][tracing.TOTAL].count, 2)
+
+    def test_urllib_error(self):
+        self.server.routes['/missing'] = lambda h: (404, {}, b'')
+
+        fetcher = fetchers.UrllibFetcher(tracer=self.events.append)
+        with self.assertRaises(fetchers.FetchError):
+            fetcher.fetch(self.url('/missing'))
+
+        self.assertEqual(
+            [x[0] for x in self.phases()],
+            [tracing.CACHE_GET, tracing.REQUEST, tracing.TOTAL])
+        self.assertTrue(
+            isinstance(self.events[-1].info['error'], fetchers.FetchError))
+
+    def test_async(self):
+        @asyncio.coroutine
+        def run(cls, tracer):
+            fetcher = cls(tracer=tracer)
+            yield from fetcher.fetch(self.url('/'))
+            yield from fetcher.close()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for (cls, tracer) in [(fetchers.AIOHttpFetcher, self.tracer),
+                              (fetchers.AsyncFetcher, self.events.append)]:
+            del self.events[:]
+            loop.run_until_complete(run(cls, tracer))
+
+            phases = [x[0] for x in self.phases()]
+            self.assertEqual(phases[-2:], [tracing.BODY, tracing.TOTAL])
+            self.assertTrue(tracing.REQUEST in phases)
+            if tracing._has_trace_config:
+                self.assertTrue(tracing.CONNECT in phases)
+
+            self.assertEqual(
+                set(x.url for x in self.events), set([self.url('/')]))
+
+        loop.close()
+
+    def test_archive(self):
+        with archive.ArchiveWriter(os.path.join(self.basedir, 'a')) as w:
+            w.write(self.url('/'), 200, {}, b'foo')
+
+        fetcher = fetchers.ArchiveFetcher(os.path.join(self.basedir, 'a'),
+                                          tracer=self.tracer)
+        fetcher.fetch(self.url('/'))
+        fetcher.close()
+
+        self.assertEqual(self.phases(),
+                         [(tracing.CACHE_GET, {'hit': True}),
+                          (tracing.TOTAL, {})])
+
+
 if __name__ == '__main__':
     logging.set_level(0)
     unittest.main()
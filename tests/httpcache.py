@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+import unittest
+
+from ldotcommons import cache, httpcache
+
+
+class TestParseCacheControl(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            httpcache.parse_cache_control(
+                'public, max-age=60, stale-while-revalidate=30, no-cache'),
+            {'public': True, 'max-age': 60, 'stale-while-revalidate': 30,
+             'no-cache': True})
+
+    def test_empty(self):
+        self.assertEqual(httpcache.parse_cache_control(None), {})
+        self.assertEqual(httpcache.parse_cache_control(''), {})
+
+
+class TestHTTPCache(unittest.TestCase):
+    def setUp(self):
+        self.c = httpcache.HTTPCache(cache.MemoryCache(), default_ttl=10)
+
+    def test_miss(self):
+        self.assertEqual(self.c.lookup('http://x/'), (None, httpcache.MISS))
+
+    def test_foreign_entries(self):
+        # Plain caches sharing the backend store raw bodies
+        for value in (b'foo', memoryview(b'foo'), {'foo': 1}):
+            self.c.backend.set('http://x/', value)
+            self.assertEqual(self.c.lookup('http://x/'),
+                             (None, httpcache.MISS))
+
+    def test_invalid_directives(self):
+        entry = self.c.store('http://x/', {
+            'Cache-Control': 'max-age=abc, stale-while-revalidate=abc'
+        }, b'foo')
+        self.assertEqual((entry['ttl'], entry['swr']), (10, 0))
+
+        entry['stored'] -= 20
+        self.assertEqual(self.c.lookup('http://x/')[1], httpcache.EXPIRED)
+
+        entry = self.c.store('http://x/', {
+            'Cache-Control': 'max-age=-5, stale-while-revalidate=30'
+        }, b'foo')
+        self.assertEqual((entry['ttl'], entry['swr']), (10, 30))
+
+    def test_max_age(self):
+        self.c.store('http://x/', {'Cache-Control': 'max-age=60'}, b'foo')
+        (entry, state) = self.c.lookup('http://x/')
+        self.assertEqual(state, httpcache.FRESH)
+        self.assertEqual(entry['body'], b'foo')
+        self.assertEqual(entry['ttl'], 60)
+
+    def test_default_ttl(self):
+        entry = self.c.store('http://x/', {}, b'foo')
+        self.assertEqual(entry['ttl'], 10)
+
+    def test_expires(self):
+        entry = self.c.store('http://x/', {
+            'Date': 'Sun, 06 Nov 1994 08:49:37 GMT',
+            'Expires': 'Sun, 06 Nov 1994 08:50:37 GMT'
+        }, b'foo')
+        self.assertEqual(entry['ttl'], 60)
+
+    def test_no_store(self):
+        self.assertEqual(
+            self.c.store('http://x/', {'Cache-Control': 'no-store'}, b'foo'),
+            None)
+        self.assertEqual(self.c.lookup('http://x/')[1], httpcache.MISS)
+
+    def test_states(self):
+        entry = self.c.store('http://x/', {
+            'Cache-Control': 'max-age=10, stale-while-revalidate=10'
+        }, b'foo')
+
+        entry['stored'] -= 15
+        self.assertEqual(self.c.lookup('http://x/')[1], httpcache.STALE)
+
+        entry['stored'] -= 10
+        self.assertEqual(self.c.lookup('http://x/')[1], httpcache.EXPIRED)
+
+    def test_conditional_headers(self):
+        entry = self.c.store('http://x/', {
+            'ETag': '"abc"',
+            'Last-Modified': 'Sun, 06 Nov 1994 08:49:37 GMT'
+        }, b'foo')
+
+        self.assertEqual(self.c.conditional_headers(entry), {
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Sun, 06 Nov 1994 08:49:37 GMT'
+        })
+        self.assertEqual(self.c.conditional_headers(None), {})
+
+    def test_refresh(self):
+        entry = self.c.store('http://x/', {'Cache-Control': 'no-cache'},
+                             b'foo')
+        entry['stored'] -= 100
+        self.assertEqual(self.c.lookup('http://x/')[1], httpcache.EXPIRED)
+
+        self.c.refresh('http://x/', entry, {'Cache-Control': 'max-age=60'})
+        (entry, state) = self.c.lookup('http://x/')
+        self.assertEqual(state, httpcache.FRESH)
+        self.assertEqual(entry['body'], b'foo')
+
+
+if __name__ == '__main__':
+    unittest.main()
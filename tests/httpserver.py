@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+
+import http.server
+import socketserver
+import threading
+import unittest
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        self.server.clients.add(self.client_address)
+        (status, headers, body) = self.server.routes[self.path](self)
+
+        self.send_response(status)
+        for (k, v) in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.requests = []
+        self.server.clients = set()
+        self.server.routes = {}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{port}{path}'.format(
+            port=self.server.server_address[1], path=path)
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+import unittest
+
+from ldotcommons import ratelimit
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        clock = FakeClock()
+        bucket = ratelimit.TokenBucket(rate=2, clock=clock)
+
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0.5)
+        self.assertEqual(bucket.reserve(), 1)
+
+        clock.now = 1
+        self.assertEqual(bucket.reserve(), 0.5)
+
+    def test_burst(self):
+        clock = FakeClock()
+        bucket = ratelimit.TokenBucket(rate=1, burst=3, clock=clock)
+
+        self.assertEqual([bucket.reserve() for x in range(4)], [0, 0, 0, 1])
+
+        # Tokens don't accumulate over burst
+        clock.now = 100
+        self.assertTrue(bucket.idle)
+        self.assertEqual([bucket.reserve() for x in range(4)], [0, 0, 0, 1])
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            ratelimit.TokenBucket(rate=0)
+
+
+class TestHostRateLimiter(unittest.TestCase):
+    def test_hosts(self):
+        clock = FakeClock()
+        limiter = ratelimit.HostRateLimiter(
+            rate=1, hosts={'b.com': (10, 1), 'c.com': (0, 0)}, clock=clock)
+
+        self.assertEqual(limiter.reserve('http://a.com/1'), 0)
+        self.assertEqual(limiter.reserve('http://a.com/2'), 1)
+        self.assertEqual(limiter.reserve('http://A.com:80/2'), 0)
+        self.assertEqual(limiter.reserve('http://b.com/1'), 0)
+        self.assertEqual(limiter.reserve('http://b.com/2'), 0.1)
+        self.assertEqual(limiter.reserve('http://c.com/'), 0)
+        self.assertEqual(limiter.reserve('http://c.com/'), 0)
+        self.assertEqual(limiter.bucket('http://c.com/'), None)
+
+    def test_purge(self):
+        clock = FakeClock()
+        limiter = ratelimit.HostRateLimiter(rate=1, clock=clock)
+        limiter.MAX_IDLE_BUCKETS = 2
+
+        limiter.reserve('http://a.com/')
+        limiter.reserve('http://b.com/')
+        clock.now = 10
+        limiter.reserve('http://c.com/')
+
+        self.assertEqual(list(limiter._buckets), ['c.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()
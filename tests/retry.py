@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+import email.utils
+import unittest
+
+from ldotcommons import retry
+
+
+class TestParseRetryAfter(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(retry.parse_retry_after('120'), 120)
+        self.assertEqual(retry.parse_retry_after(' 0 '), 0)
+
+    def test_date(self):
+        value = email.utils.formatdate(1000 + 30, usegmt=True)
+        self.assertEqual(retry.parse_retry_after(value, now=1000), 30)
+        self.assertEqual(retry.parse_retry_after(value, now=2000), 0)
+
+    def test_invalid(self):
+        self.assertEqual(retry.parse_retry_after(None), None)
+        self.assertEqual(retry.parse_retry_after('soon'), None)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_backoff(self):
+        policy = retry.RetryPolicy(
+            max_attempts=10, backoff=1, backoff_max=5, jitter=0)
+        self.assertEqual([policy.backoff_delay(n) for n in range(1, 6)],
+                         [1, 2, 4, 5, 5])
+
+    def test_jitter(self):
+        policy = retry.RetryPolicy(backoff=1, jitter=0.5)
+        for x in range(100):
+            self.assertTrue(1 <= policy.backoff_delay(2) <= 2)
+
+    def test_delay(self):
+        policy = retry.RetryPolicy(max_attempts=3, backoff=1, jitter=0)
+
+        self.assertEqual(policy.delay(1, status=503), 1)
+        self.assertEqual(policy.delay(2, error=ConnectionResetError()), 2)
+        self.assertEqual(policy.delay(3, status=503), None)
+        self.assertEqual(policy.delay(1, status=404), None)
+        self.assertEqual(policy.delay(1, error=ValueError()), None)
+        self.assertEqual(policy.delay(1, status=503, method='POST'), None)
+
+    def test_retry_after(self):
+        policy = retry.RetryPolicy(backoff=1, jitter=0, retry_after_max=60)
+
+        self.assertEqual(policy.delay(1, status=429, retry_after='5'), 5)
+        self.assertEqual(policy.delay(1, status=429, retry_after='90'), None)
+
+        policy.retry_after = False
+        self.assertEqual(policy.delay(1, status=429, retry_after='90'), 1)
+
+
+class TestRetrying(unittest.TestCase):
+    def test_attempts(self):
+        hooked = []
+        policy = retry.RetryPolicy(
+            max_attempts=3, backoff=1, jitter=0,
+            hook=lambda url, attempt: hooked.append((url, attempt)))
+
+        retrying = policy.start('http://a/')
+        retrying.begin()
+        self.assertEqual(retrying.failed(status=503), 1)
+        retrying.begin()
+        self.assertEqual(retrying.failed(error=TimeoutError()), 2)
+        retrying.begin()
+        retrying.succeeded(status=200)
+
+        self.assertEqual([x.number for x in retrying.attempts], [1, 2, 3])
+        self.assertEqual([x.status for x in retrying.attempts],
+                         [503, None, 200])
+        self.assertEqual([x.delay for x in retrying.attempts], [1, 2, None])
+        self.assertTrue(all(x.elapsed >= 0 for x in retrying.attempts))
+        self.assertEqual(hooked, [('http://a/', x)
+                                  for x in retrying.attempts])
+
+
+if __name__ == '__main__':
+    unittest.main()
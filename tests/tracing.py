@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+import unittest
+
+from ldotcommons import tracing
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.events = []
+        self.tracer = tracing.Tracer(self.events.append, clock=self.clock)
+
+    def test_span(self):
+        with self.tracer.span('http://a/', tracing.CACHE_GET) as info:
+            self.clock.now = 2
+            info['hit'] = True
+
+        self.assertEqual(
+            self.events,
+            [tracing.Event('http://a/', tracing.CACHE_GET, 0, 2,
+                           {'hit': True})])
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with self.tracer.span('http://a/', tracing.REQUEST):
+                raise ValueError()
+
+        self.assertTrue(
+            isinstance(self.events[0].info['error'], ValueError))
+
+    def test_no_hooks(self):
+        tracer = tracing.Tracer()
+        with tracer.span('http://a/', tracing.TOTAL) as info:
+            info['foo'] = 1
+
+        tracer.add_hook(self.events.append)
+        tracer.emit('http://a/', tracing.TOTAL, 0, 1)
+        tracer.remove_hook(self.events.append)
+        tracer.emit('http://a/', tracing.TOTAL, 0, 1)
+
+        self.assertEqual(len(self.events), 1)
+
+
+class TestLatencyReport(unittest.TestCase):
+    def test_stats(self):
+        report = tracing.LatencyReport()
+        tracer = tracing.Tracer(report)
+
+        for x in range(1, 101):
+            tracer.emit('http://A/{}'.format(x), tracing.REQUEST, 0, x / 100)
+        tracer.emit('http://b/', tracing.REQUEST, 0, 1, error=Exception())
+        tracer.emit('http://b/', tracing.BODY, 0, 0.5)
+
+        self.assertEqual(report.hosts(), ['a', 'b'])
+
+        stats = report.stats()
+        self.assertEqual(stats['a'][tracing.REQUEST].count, 100)
+        self.assertAlmostEqual(stats['a'][tracing.REQUEST].mean, 0.505)
+        self.assertEqual(stats['a'][tracing.REQUEST].p50, 0.51)
+        self.assertEqual(stats['a'][tracing.REQUEST].max, 1)
+        self.assertEqual(stats['b'][tracing.REQUEST].errors, 1)
+        self.assertEqual(
+            sorted(stats['b']), [tracing.BODY, tracing.REQUEST])
+
+        lines = report.format().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[-2].split()[:2], ['b', tracing.REQUEST])
+
+        report.reset()
+        self.assertEqual(report.stats(), {})
+
+    def test_max_samples(self):
+        report = tracing.LatencyReport(max_samples=2)
+        for x in (10, 1, 2):
+            report(tracing.Event('http://a/', tracing.TOTAL, 0, x, {}))
+
+        stats = report.stats()['a'][tracing.TOTAL]
+        self.assertEqual((stats.count, stats.max, stats.p99), (3, 10, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()